@@ -10,11 +10,13 @@ import os
 os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 
 import torch
+import numpy as np
 import pyautogui
 import tkinter as tk
 from tkinter import scrolledtext
 from PIL import Image, ImageGrab
 import threading
+import functools
 import queue
 import time
 import sys
@@ -23,8 +25,10 @@ import json
 from datetime import datetime
 from pynput import keyboard
 from transformers import AutoProcessor
+from qwen_vl_utils import smart_resize
 from gui_actor.modeling import Qwen2VLForConditionalGenerationWithPointer
-from gui_actor.inference import inference
+from gui_actor.inference import ground
+from gui_actor.cache import PrefixKVCache
 
 # macOS-specific fix for Tkinter threading
 if sys.platform == 'darwin':
@@ -39,11 +43,21 @@ if sys.platform == 'darwin':
 
 MODEL_PATH = "microsoft/GUI-Actor-2B-Qwen2-VL"
 TOPK_PREDICTIONS = 3
+AGENT_SYSTEM_MESSAGE = "You are a GUI agent. You are given a task and a screenshot of the screen. You need to perform a series of pyautogui actions to complete the task."
 CONFIDENCE_THRESHOLD = 0.7
-ACTION_DELAY = 0.5  # Delay between actions in seconds
+SETTLE_STABLE_TIME = 0.3  # Screen must be unchanged this long to count as settled (seconds)
+SETTLE_MIN_WAIT = 1.0  # Until a change is seen, wait at least this long: the UI may not have started reacting yet (seconds)
+SETTLE_TIMEOUT = 3.0  # Give up waiting for the screen to settle after this long (seconds)
+SETTLE_POLL_INTERVAL = 0.05  # Time between settle checks (seconds)
+SETTLE_HASH_SIZE = 32  # Frames are compared as SETTLE_HASH_SIZE x SETTLE_HASH_SIZE grayscale thumbnails
+SETTLE_DIFF_THRESHOLD = 1.0  # Mean absolute thumbnail difference (0-255) that counts as a change
 SCREEN_SCALE = 1.0  # Adjust if you have display scaling
 MAX_SCREENSHOT_SIZE = 768  # Max width/height for screenshots (reduced for MPS stability)
+SCREENSHOT_RESAMPLE = Image.Resampling.BILINEAR  # Filter of the single screenshot resize (LANCZOS is sharper but slower)
+SCREENSHOT_REDUCING_GAP = 2.0  # Box-reduce by an integer factor before resampling (see PIL Image.resize)
 LOG_DIR = "command_logs"  # Base directory for command logs
+LOG_QUEUE_SIZE = 16  # Max pending log writes before logging calls block
+LOG_FAST_ENCODING = True  # Save log PNGs with zlib level 1 (several times faster, slightly larger files)
 
 # ============================================================================
 # GLOBAL STATE
@@ -61,12 +75,49 @@ command_counter = 0  # Counter for command logging
 # ============================================================================
 
 class CommandLogger:
-    """Logger for capturing all command execution details"""
+    """Logger for capturing all command execution details
     
-    def __init__(self, base_dir=LOG_DIR):
+    File writes (PNG encoding, copies, the JSON log and summary) are queued to a
+    background writer thread, so logging does not delay the action itself. The
+    queue is bounded: if the writer falls behind, logging calls block until a
+    slot frees up. Call flush() to wait for all pending writes (e.g. on exit).
+    """
+    
+    def __init__(self, base_dir=LOG_DIR, queue_size=LOG_QUEUE_SIZE, fast_encoding=LOG_FAST_ENCODING):
         self.base_dir = base_dir
         self.current_log_dir = None
         self.log_data = {}
+        self.fast_encoding = fast_encoding
+        self.write_queue = queue.Queue(maxsize=queue_size)
+        self.writer_thread = None
+        
+    def _writer_loop(self):
+        """Run queued writes in order until the process exits"""
+        while True:
+            task, args = self.write_queue.get()
+            try:
+                task(*args)
+            except Exception as e:
+                log_status(f"⚠️  Log write failed: {e}")
+            finally:
+                self.write_queue.task_done()
+    
+    def submit(self, task, *args):
+        """Queue task(*args) to run on the writer thread"""
+        if self.writer_thread is None:
+            self.writer_thread = threading.Thread(target=self._writer_loop, daemon=True)
+            self.writer_thread.start()
+        self.write_queue.put((task, args))
+    
+    def flush(self):
+        """Block until every queued write has finished"""
+        if self.writer_thread is not None:
+            self.write_queue.join()
+    
+    def save_image(self, image, path):
+        """Queue saving a PNG; the image must not be modified afterwards"""
+        compress_level = 1 if self.fast_encoding else 6
+        self.submit(functools.partial(image.save, path, "PNG", compress_level=compress_level))
         
     def start_command_log(self, command_num, command_text):
         """Initialize a new command log directory"""
@@ -103,9 +154,9 @@ class CommandLogger:
         """Save the screenshot sent to VLM"""
         if screenshot and self.current_log_dir:
             screenshot_path = os.path.join(self.current_log_dir, "screenshot.png")
-            screenshot.save(screenshot_path)
+            self.save_image(screenshot, screenshot_path)
             self.log_data["screenshot_path"] = screenshot_path
-            log_status(f"💾 Screenshot saved: {screenshot_path}")
+            log_status(f"💾 Screenshot queued: {screenshot_path}")
             return screenshot_path
         return None
     
@@ -152,9 +203,10 @@ class CommandLogger:
             # Copy debug screenshot to command log directory
             import shutil
             dest_path = os.path.join(self.current_log_dir, "debug_annotated.png")
-            shutil.copy(debug_path, dest_path)
+            # Runs after the queued save of debug_path (writes are in order)
+            self.submit(shutil.copy, debug_path, dest_path)
             self.log_data["debug_screenshot_path"] = dest_path
-            log_status(f"💾 Debug screenshot copied to: {dest_path}")
+            log_status(f"💾 Debug screenshot queued: {dest_path}")
     
     def log_execution_result(self, success, action_type, details=None):
         """Log the execution result"""
@@ -172,68 +224,73 @@ class CommandLogger:
         })
     
     def finalize_log(self):
-        """Save the complete log to JSON file"""
+        """Queue saving the complete log to JSON file"""
         if self.current_log_dir:
-            log_file = os.path.join(self.current_log_dir, "command_log.json")
-            with open(log_file, 'w') as f:
-                json.dump(self.log_data, f, indent=2)
-            log_status(f"💾 Command log saved: {log_file}")
+            # start_command_log replaces log_data, so the writer owns this dict from here on
+            self.submit(self._write_log, self.current_log_dir, self.log_data)
+    
+    def _write_log(self, log_dir, log_data):
+        """Write the JSON log and the human-readable summary (writer thread)"""
+        log_file = os.path.join(log_dir, "command_log.json")
+        with open(log_file, 'w') as f:
+            json.dump(log_data, f, indent=2)
+        log_status(f"💾 Command log saved: {log_file}")
+        
+        # Also save a human-readable summary
+        summary_file = os.path.join(log_dir, "summary.txt")
+        with open(summary_file, 'w') as f:
+            f.write(f"Command #{log_data['command_number']}\n")
+            f.write(f"{'='*60}\n\n")
+            f.write(f"Command: {log_data['command_text']}\n")
+            f.write(f"Timestamp: {log_data['timestamp']}\n\n")
             
-            # Also save a human-readable summary
-            summary_file = os.path.join(self.current_log_dir, "summary.txt")
-            with open(summary_file, 'w') as f:
-                f.write(f"Command #{self.log_data['command_number']}\n")
-                f.write(f"{'='*60}\n\n")
-                f.write(f"Command: {self.log_data['command_text']}\n")
-                f.write(f"Timestamp: {self.log_data['timestamp']}\n\n")
-                
-                if self.log_data['parsed_action']:
-                    f.write(f"Parsed Action:\n")
-                    f.write(f"  Type: {self.log_data['parsed_action'].get('type')}\n")
-                    for key, value in self.log_data['parsed_action'].items():
-                        if key != 'type':
-                            f.write(f"  {key}: {value}\n")
-                    f.write("\n")
-                
-                if self.log_data['vlm_request']:
-                    f.write(f"VLM Request:\n")
-                    f.write(f"  Instruction: {self.log_data['vlm_request']['instruction']}\n")
-                    f.write(f"  Screenshot Size: {self.log_data['vlm_request']['screenshot_size']}\n\n")
-                
-                if self.log_data['predicted_points']:
-                    f.write(f"Predicted Points:\n")
-                    for i, point in enumerate(self.log_data['predicted_points']):
-                        f.write(f"  #{i+1}: ({point['x']:.4f}, {point['y']:.4f})\n")
-                    f.write("\n")
-                
-                if self.log_data['selected_point']:
-                    f.write(f"Selected Point:\n")
-                    f.write(f"  Normalized: ({self.log_data['selected_point']['normalized']['x']:.4f}, "
-                           f"{self.log_data['selected_point']['normalized']['y']:.4f})\n")
-                    f.write(f"  Pixel: ({self.log_data['selected_point']['pixel']['x']}, "
-                           f"{self.log_data['selected_point']['pixel']['y']})\n\n")
-                
-                if self.log_data['execution_result']:
-                    f.write(f"Execution Result:\n")
-                    f.write(f"  Success: {self.log_data['execution_result']['success']}\n")
-                    f.write(f"  Action Type: {self.log_data['execution_result']['action_type']}\n")
-                    if self.log_data['execution_result']['details']:
-                        f.write(f"  Details: {self.log_data['execution_result']['details']}\n")
-                    f.write("\n")
-                
-                if self.log_data['errors']:
-                    f.write(f"Errors:\n")
-                    for error in self.log_data['errors']:
-                        f.write(f"  [{error['timestamp']}] {error['message']}\n")
-                    f.write("\n")
-                
-                f.write(f"Files:\n")
-                f.write(f"  - screenshot.png: Original screenshot sent to VLM\n")
-                if self.log_data['debug_screenshot_path']:
-                    f.write(f"  - debug_annotated.png: Screenshot with predicted points marked\n")
-                f.write(f"  - command_log.json: Complete log data in JSON format\n")
+            if log_data['parsed_action']:
+                f.write(f"Parsed Action:\n")
+                f.write(f"  Type: {log_data['parsed_action'].get('type')}\n")
+                for key, value in log_data['parsed_action'].items():
+                    if key != 'type':
+                        f.write(f"  {key}: {value}\n")
+                f.write("\n")
+            
+            if log_data['vlm_request']:
+                f.write(f"VLM Request:\n")
+                f.write(f"  Instruction: {log_data['vlm_request']['instruction']}\n")
+                f.write(f"  Screenshot Size: {log_data['vlm_request']['screenshot_size']}\n\n")
+            
+            if log_data['predicted_points']:
+                f.write(f"Predicted Points:\n")
+                for i, point in enumerate(log_data['predicted_points']):
+                    f.write(f"  #{i+1}: ({point['x']:.4f}, {point['y']:.4f})\n")
+                f.write("\n")
+            
+            if log_data['selected_point']:
+                f.write(f"Selected Point:\n")
+                f.write(f"  Normalized: ({log_data['selected_point']['normalized']['x']:.4f}, "
+                       f"{log_data['selected_point']['normalized']['y']:.4f})\n")
+                f.write(f"  Pixel: ({log_data['selected_point']['pixel']['x']}, "
+                       f"{log_data['selected_point']['pixel']['y']})\n\n")
             
-            log_status(f"💾 Summary saved: {summary_file}")
+            if log_data['execution_result']:
+                f.write(f"Execution Result:\n")
+                f.write(f"  Success: {log_data['execution_result']['success']}\n")
+                f.write(f"  Action Type: {log_data['execution_result']['action_type']}\n")
+                if log_data['execution_result']['details']:
+                    f.write(f"  Details: {log_data['execution_result']['details']}\n")
+                f.write("\n")
+            
+            if log_data['errors']:
+                f.write(f"Errors:\n")
+                for error in log_data['errors']:
+                    f.write(f"  [{error['timestamp']}] {error['message']}\n")
+                f.write("\n")
+            
+            f.write(f"Files:\n")
+            f.write(f"  - screenshot.png: Original screenshot sent to VLM\n")
+            if log_data['debug_screenshot_path']:
+                f.write(f"  - debug_annotated.png: Screenshot with predicted points marked\n")
+            f.write(f"  - command_log.json: Complete log data in JSON format\n")
+        
+        log_status(f"💾 Summary saved: {summary_file}")
 
 
 # Global logger instance
@@ -251,6 +308,7 @@ class VLMModel:
         self.model = None
         self.processor = None
         self.tokenizer = None
+        self.prefix_cache = None
         self.device = "mps" if torch.backends.mps.is_available() else "cpu"
         
     def load(self):
@@ -282,6 +340,11 @@ class VLMModel:
                 except:
                     pass
             
+            # Reuse vision tower outputs when the same screenshot is queried again
+            self.model.enable_image_embed_cache()
+            # The system prompt is the same for every query, prefill it only once
+            self.prefix_cache = PrefixKVCache(self.tokenizer, system_messages=(AGENT_SYSTEM_MESSAGE,))
+            
             # Verify model is on correct device
             log_status(f"   Model device: {next(self.model.parameters()).device}")
             
@@ -294,8 +357,11 @@ class VLMModel:
             log_status(f"   Traceback: {traceback.format_exc()}")
             return False
     
-    def predict_click_location(self, screenshot, instruction):
-        """Predict where to click based on instruction"""
+    def predict_click_location(self, screenshot, instruction, image_inputs=None):
+        """Predict where to click based on instruction
+        
+        image_inputs: optional processed screenshot from capture_screenshot, so it is not processed again
+        """
         try:
             # Ensure screenshot is RGB
             if screenshot.mode != 'RGB':
@@ -307,7 +373,7 @@ class VLMModel:
                     "content": [
                         {
                             "type": "text",
-                            "text": "You are a GUI agent. You are given a task and a screenshot of the screen. You need to perform a series of pyautogui actions to complete the task.",
+                            "text": AGENT_SYSTEM_MESSAGE,
                         }
                     ]
                 },
@@ -333,19 +399,28 @@ class VLMModel:
             if self.device == "mps":
                 torch.mps.empty_cache()
             
-            pred = inference(
+            # Single forward pass (placeholder mode) instead of generate()
+            pred = ground(
                 conversation, 
                 self.model, 
                 self.tokenizer, 
                 self.processor, 
-                use_placeholder=True, 
-                topk=TOPK_PREDICTIONS
+                topk=TOPK_PREDICTIONS,
+                prefix_cache=self.prefix_cache,
+                image_inputs=image_inputs
             )
             
             # Clear cache after inference
             if self.device == "mps":
                 torch.mps.empty_cache()
             
+            cache_stats = self.model.image_embed_cache.stats()
+            log_status(f"   Image embedding cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+            prefix_stats = self.prefix_cache.stats()
+            log_status(f"   System prompt cache: {prefix_stats['hits']} hits, {prefix_stats['misses']} misses")
+            if prefix_stats['misses'] and not prefix_stats['hits']:
+                log_status(f"⚠️  System prompt cache never matched - check AGENT_SYSTEM_MESSAGE")
+            
             return pred
             
         except RuntimeError as e:
@@ -374,32 +449,78 @@ class VLMModel:
 # GUI CONTROL FUNCTIONS
 # ============================================================================
 
-def take_screenshot():
-    """Capture the current screen and resize if needed"""
+def screenshot_target_size(width, height, image_processor=None):
+    """Final (width, height) of a screenshot of the given size as the model sees it
+    
+    The screenshot is first bounded by MAX_SCREENSHOT_SIZE, then sized with
+    smart_resize the way process_vision_info and the image processor would, so
+    resizing once to this size leaves nothing for them to resample.
+    """
+    if width > MAX_SCREENSHOT_SIZE or height > MAX_SCREENSHOT_SIZE:
+        # Calculate new size maintaining aspect ratio
+        if width > height:
+            width, height = MAX_SCREENSHOT_SIZE, int(height * (MAX_SCREENSHOT_SIZE / width))
+        else:
+            width, height = int(width * (MAX_SCREENSHOT_SIZE / height)), MAX_SCREENSHOT_SIZE
+    # process_vision_info
+    height, width = smart_resize(height, width)
+    if image_processor is not None:
+        factor = image_processor.patch_size * image_processor.merge_size
+        height, width = smart_resize(
+            height, width, factor=factor, min_pixels=image_processor.min_pixels, max_pixels=image_processor.max_pixels
+        )
+    return width, height
+
+
+def resize_screenshot(screenshot, size):
+    """Resize in one pass: reduce() for exact integer factors, SCREENSHOT_RESAMPLE otherwise"""
+    width, height = screenshot.size
+    if (width, height) == tuple(size):
+        return screenshot
+    if width % size[0] == 0 and width // size[0] == height / size[1]:
+        return screenshot.reduce(width // size[0])
+    return screenshot.resize(size, SCREENSHOT_RESAMPLE, reducing_gap=SCREENSHOT_REDUCING_GAP)
+
+
+def capture_screenshot(region=None, processor=None):
+    """Capture the screen (or a region of it) at the size the model sees
+    
+    Args:
+        region: Optional (left, top, right, bottom) in screen coordinates to capture only part of the screen
+        processor: Optional model processor; if given, the image is also run through its image processor
+    
+    Returns:
+        (screenshot, image_inputs): the RGB image and its processed `pixel_values` / `image_grid_thw`
+        (None without a processor), or (None, None) on failure
+    """
     try:
-        screenshot = ImageGrab.grab()
+        screenshot = ImageGrab.grab(bbox=region)
+        if screenshot.mode != 'RGB':
+            screenshot = screenshot.convert('RGB')
         
-        # Resize if image is too large (to prevent memory issues)
         width, height = screenshot.size
-        
-        if width > MAX_SCREENSHOT_SIZE or height > MAX_SCREENSHOT_SIZE:
-            # Calculate new size maintaining aspect ratio
-            if width > height:
-                new_width = MAX_SCREENSHOT_SIZE
-                new_height = int(height * (MAX_SCREENSHOT_SIZE / width))
-            else:
-                new_height = MAX_SCREENSHOT_SIZE
-                new_width = int(width * (MAX_SCREENSHOT_SIZE / height))
-            
+        image_processor = processor.image_processor if processor is not None else None
+        new_width, new_height = screenshot_target_size(width, height, image_processor)
+        if (new_width, new_height) != (width, height):
             log_status(f"📐 Resizing screenshot from {width}x{height} to {new_width}x{new_height}")
-            screenshot = screenshot.resize((new_width, new_height), Image.Resampling.LANCZOS)
+            screenshot = resize_screenshot(screenshot, (new_width, new_height))
         else:
             log_status(f"📐 Screenshot size: {width}x{height}")
         
-        return screenshot
+        image_inputs = None
+        if image_processor is not None:
+            image_inputs = image_processor(images=[screenshot], return_tensors="pt")
+        
+        return screenshot, image_inputs
     except Exception as e:
         log_status(f"❌ Screenshot error: {str(e)}")
-        return None
+        return None, None
+
+
+def take_screenshot(region=None):
+    """Capture the current screen (or a region of it) and resize if needed"""
+    screenshot, _ = capture_screenshot(region)
+    return screenshot
 
 
 def show_click_visualization(x, y, duration=2.0):
@@ -451,19 +572,71 @@ def show_click_visualization(x, y, duration=2.0):
         return None
 
 
-def move_and_click(x, y, screenshot_size=None, show_visual=True):
+def screen_signature():
+    """Low-resolution grayscale thumbnail of the screen, for cheap change detection"""
+    frame = ImageGrab.grab().convert('L')
+    frame = frame.resize((SETTLE_HASH_SIZE, SETTLE_HASH_SIZE), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    return np.asarray(frame, dtype=np.int16)
+
+
+def wait_for_screen_settle(stable_time=SETTLE_STABLE_TIME, timeout=SETTLE_TIMEOUT, poll_interval=SETTLE_POLL_INTERVAL,
+                           min_wait=SETTLE_MIN_WAIT):
+    """Wait until the screen has changed and then not changed for `stable_time` seconds, or `timeout` passes
+    
+    Replaces fixed sleeps after actions: returns as soon as the UI has finished
+    reacting instead of always waiting for the worst case. A screen that has not
+    changed at all only counts as settled after `min_wait` seconds, so a slow
+    UI (app launch, page load) gets time to start reacting.
+    
+    Returns:
+        (settled, elapsed): whether the screen settled before the timeout, and the seconds waited
+    """
+    start = time.time()
+    stable_since = start
+    changed = False
+    try:
+        previous = screen_signature()
+        while True:
+            time.sleep(poll_interval)
+            now = time.time()
+            current = screen_signature()
+            if np.abs(current - previous).mean() > SETTLE_DIFF_THRESHOLD:
+                stable_since = now
+                changed = True
+            previous = current
+            if now - stable_since >= stable_time and (changed or now - start >= min_wait):
+                return True, now - start
+            if now - start >= timeout:
+                return False, now - start
+    except Exception as e:
+        # Can't watch the screen (e.g. no capture permission): fall back to a fixed wait
+        log_status(f"⚠️  Screen settle check failed: {str(e)}")
+        remaining = max(stable_time, min_wait) - (time.time() - start)
+        if remaining > 0:
+            time.sleep(remaining)
+        return False, time.time() - start
+
+
+def move_and_click(x, y, screenshot_size=None, show_visual=True, region=None):
     """Move mouse to coordinates and click
     
     Args:
         x, y: Normalized coordinates (0-1) predicted by VLM relative to the screenshot
         screenshot_size: (width, height) of the screenshot the VLM analyzed
         show_visual: Whether to show visual indicator
+        region: (left, top, right, bottom) screen region the screenshot was captured from, if not the full screen
     """
     try:
         # Get logical screen dimensions (what pyautogui uses)
         screen_width, screen_height = pyautogui.size()
         
-        if screenshot_size:
+        if region:
+            # Normalized coords are relative to the captured region
+            left, top, right, bottom = region
+            pixel_x = int(left + x * (right - left))
+            pixel_y = int(top + y * (bottom - top))
+            log_status(f"   Region: ({left}, {top}, {right}, {bottom})")
+        elif screenshot_size:
             screenshot_width, screenshot_height = screenshot_size
             log_status(f"   Screenshot dimensions: {screenshot_width}x{screenshot_height}")
             log_status(f"   Screen dimensions (logical): {screen_width}x{screen_height}")
@@ -501,7 +674,8 @@ def move_and_click(x, y, screenshot_size=None, show_visual=True):
         
         # Move mouse smoothly
         pyautogui.moveTo(pixel_x, pixel_y, duration=0.3)
-        time.sleep(1.0)  # Wait for action to finish
+        # Wait for hover effects to finish (at most the old fixed delay); moving the mouse often changes nothing
+        wait_for_screen_settle(timeout=1.0, min_wait=0)
         
         # VERIFICATION: Check actual mouse position after move
         actual_x, actual_y = pyautogui.position()
@@ -628,8 +802,8 @@ def save_debug_screenshot(screenshot, points, instruction):
         # Save with timestamp
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"debug_click_{timestamp}.png"
-        debug_img.save(filename)
-        log_status(f"💾 Debug screenshot saved: {filename}")
+        command_logger.save_image(debug_img, filename)
+        log_status(f"💾 Debug screenshot queued: {filename}")
         
         return filename
         
@@ -638,13 +812,15 @@ def save_debug_screenshot(screenshot, points, instruction):
         return None
 
 
-def execute_action(action_dict, vlm_model, screenshot=None):
+def execute_action(action_dict, vlm_model, screenshot=None, region=None):
     """Execute a parsed action
     
     Args:
         action_dict: Dictionary with action type and parameters
         vlm_model: The VLM model instance
         screenshot: Optional PIL Image to use (if None, will take a new screenshot)
+        region: Optional (left, top, right, bottom) screen region to capture and click in,
+            when no screenshot is given
     """
     global stop_agent
     
@@ -658,14 +834,16 @@ def execute_action(action_dict, vlm_model, screenshot=None):
     
     if action_type == 'click':
         # Use provided screenshot or take a new one
+        image_inputs = None
         if screenshot is None:
             log_status(f"📸 Taking screenshot...")
-            screenshot = take_screenshot()
+            screenshot, image_inputs = capture_screenshot(region, processor=vlm_model.processor)
             if screenshot is None:
                 command_logger.log_error("Failed to take screenshot")
                 return False
         else:
             log_status(f"📸 Using provided screenshot ({screenshot.width}x{screenshot.height})")
+            region = None
         
         # Log screenshot
         command_logger.log_screenshot(screenshot)
@@ -678,7 +856,7 @@ def execute_action(action_dict, vlm_model, screenshot=None):
         screenshot_info = f"{screenshot.width}x{screenshot.height}"
         command_logger.log_vlm_request(instruction, screenshot_info)
         
-        prediction = vlm_model.predict_click_location(screenshot, instruction)
+        prediction = vlm_model.predict_click_location(screenshot, instruction, image_inputs=image_inputs)
         
         # Log VLM response
         command_logger.log_vlm_response(prediction)
@@ -701,8 +879,7 @@ def execute_action(action_dict, vlm_model, screenshot=None):
                 command_logger.log_selected_point(x, y, pixel_x, pixel_y)
                 
                 # Click - pass screenshot size for proper coordinate conversion
-                time.sleep(ACTION_DELAY)
-                success = move_and_click(x, y, screenshot_size=screenshot_size)
+                success = move_and_click(x, y, screenshot_size=screenshot_size, region=region)
                 command_logger.log_execution_result(success, 'click', 
                     f"Clicked at ({pixel_x}, {pixel_y})")
                 return success
@@ -721,7 +898,6 @@ def execute_action(action_dict, vlm_model, screenshot=None):
     
     elif action_type == 'type':
         text = action_dict.get('text', '')
-        time.sleep(ACTION_DELAY)
         success = type_text(text)
         command_logger.log_execution_result(success, 'type', f"Typed: {text}")
         return success
@@ -1060,6 +1236,9 @@ def main():
         import traceback
         traceback.print_exc()
         stop_agent = True
+    finally:
+        # Finish pending log writes before the daemon writer thread dies with the process
+        command_logger.flush()
 
 
 if __name__ == "__main__":
@@ -10,7 +10,6 @@ import sys
 # CRITICAL: Set this BEFORE any other imports to prevent tokenizer fork issues
 os.environ['TOKENIZERS_PARALLELISM'] = 'false'
 
-import time
 from datetime import datetime
 from PIL import ImageGrab, Image
 import pyautogui
@@ -22,6 +21,7 @@ from gui_agent import (
     take_screenshot, 
     parse_command, 
     execute_action,
+    wait_for_screen_settle,
     CommandLogger,
     log_status as gui_log_status,
     command_counter,
@@ -34,7 +34,7 @@ from gui_agent import (
 
 MAX_ITERATIONS = 20
 SCREENSHOT_DIR = "autonomous_screenshots"
-ACTION_DELAY = 1.0  # Delay between actions to let UI update
+SETTLE_TIMEOUT = 3.0  # Max time to wait for the UI to stop changing after an action
 
 # ============================================================================
 # GLOBAL STATE
@@ -216,8 +216,12 @@ def run_autonomous_agent(goal, max_iterations=MAX_ITERATIONS):
                 command_logger.finalize_log()
             
             # Step 6: Wait for UI to update
-            log(f"⏳ Waiting {ACTION_DELAY}s for UI to update...")
-            time.sleep(ACTION_DELAY)
+            log(f"⏳ Waiting for UI to update...")
+            settled, elapsed = wait_for_screen_settle(timeout=SETTLE_TIMEOUT)
+            if settled:
+                log(f"   Screen settled after {elapsed:.2f}s")
+            else:
+                log(f"   Screen still changing after {elapsed:.2f}s, continuing")
             
             log(f"✓ Iteration {iteration_count} complete\n")
     
@@ -232,6 +236,10 @@ def run_autonomous_agent(goal, max_iterations=MAX_ITERATIONS):
         traceback.print_exc()
         return False
     
+    finally:
+        # The log writer is a daemon thread: finish this run's pending log writes before returning
+        command_logger.flush()
+    
     # If we reach here, we hit max iterations
     log("\n" + "="*70)
     log(f"⚠️  Reached maximum iterations ({max_iterations})")
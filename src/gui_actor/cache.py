@@ -0,0 +1,218 @@
+import copy
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+from gui_actor.constants import chat_template, grounding_system_message
+
+_INT_DTYPES = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+_N_LANES = 64
+
+class ImageEmbedCache:
+    """
+    LRU cache of vision tower outputs (`model.visual(pixel_values, grid_thw)`), one entry per image.
+    Entries are keyed by a hash of the processed (resized + normalized) pixels and the image grid, so asking
+    several questions about an unchanged screenshot only runs the vision tower once.
+    The cache holds at most `max_bytes` of embeddings; the least recently used entries are evicted first.
+    """
+    def __init__(self, max_bytes=1024 ** 3):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def make_key(pixel_values, grid_thw):
+        """
+        pixel_values: (n_patches, patch_dim) patches of a single image
+        grid_thw: (3,) grid of the same image
+
+        The pixels are fingerprinted on their own device: the bit pattern of every value is mixed with its position
+        and summed into a few int64 lanes, so only the lanes (not the whole image) are copied to the host and hashed.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(str((tuple(grid_thw.tolist()), tuple(pixel_values.shape), pixel_values.dtype)).encode())
+        bits = pixel_values.detach().reshape(-1)
+        bits = bits.view(_INT_DTYPES[bits.element_size()]).long()
+        positions = torch.arange(bits.numel(), device=bits.device)
+        # int64 arithmetic wraps around; the odd weights make every single value change the first lane
+        lanes = torch.stack([bits * (2 * positions + 1), (bits ^ (positions * 0x9E3779B1)) * 0x2545F4914F6CDD1D])
+        lanes = torch.nn.functional.pad(lanes, (0, -bits.numel() % _N_LANES)).view(2, -1, _N_LANES).sum(dim=1)
+        digest.update(lanes.cpu().numpy().tobytes())
+        return digest.hexdigest()
+
+    def get(self, key):
+        image_embeds = self._entries.get(key)
+        if image_embeds is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return image_embeds
+
+    def put(self, key, image_embeds):
+        n_bytes = image_embeds.numel() * image_embeds.element_size()
+        if n_bytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.current_bytes -= self._nbytes(self._entries.pop(key))
+        while self._entries and self.current_bytes + n_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= self._nbytes(evicted)
+        self._entries[key] = image_embeds.detach()
+        self.current_bytes += n_bytes
+
+    def clear(self):
+        self._entries.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+        }
+
+    @staticmethod
+    def _nbytes(tensor):
+        return tensor.numel() * tensor.element_size()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def get_image_embeds(model, pixel_values, image_grid_thw):
+    """
+    Run `model.visual` on a batch of images, consulting `model.image_embed_cache` (if enabled) per image.
+    Only the images that miss the cache go through the vision tower, in a single call.
+    """
+    cache = getattr(model, "image_embed_cache", None)
+    if cache is None or model.training:
+        return model.visual(pixel_values, grid_thw=image_grid_thw)
+
+    merge_length = model.visual.spatial_merge_size ** 2
+    patch_counts = image_grid_thw.prod(dim=-1).tolist()
+    image_pixel_values = torch.split(pixel_values, patch_counts, dim=0)
+
+    keys = [cache.make_key(pv, thw) for pv, thw in zip(image_pixel_values, image_grid_thw)]
+    image_embeds = [cache.get(key) for key in keys]
+    missing = [i for i, embeds in enumerate(image_embeds) if embeds is None]
+    if missing:
+        new_embeds = model.visual(
+            torch.cat([image_pixel_values[i] for i in missing], dim=0),
+            grid_thw=image_grid_thw[missing],
+        )
+        new_embeds = torch.split(new_embeds, [patch_counts[i] // merge_length for i in missing], dim=0)
+        for i, embeds in zip(missing, new_embeds):
+            cache.put(keys[i], embeds)
+            image_embeds[i] = embeds
+    return torch.cat(image_embeds, dim=0)
+
+
+class PrefixKVCache:
+    """
+    Precomputed `past_key_values` of fixed prompt prefixes, e.g. the system turn built from `grounding_system_message`.
+    Each prefix is prefilled once per model, dtype and device; a request whose input_ids start with a registered prefix
+    is then prefilled from a copy of that cache and only runs its own suffix (image, instruction, ...) through the model.
+
+    Usage:
+        prefix_cache = PrefixKVCache(tokenizer)
+        prefix_cache.register_system_message(other_system_message)  # grounding_system_message is registered already
+        pred = ground(conversation, model, tokenizer, data_processor, prefix_cache=prefix_cache)
+    """
+    def __init__(self, tokenizer, system_messages=(grounding_system_message,)):
+        self.tokenizer = tokenizer
+        self._prefix_ids = {} # prefix text -> token ids
+        self._entries = {} # (prefix text, dtype, device) -> DynamicCache of the prefix
+        self.hits = 0
+        self.misses = 0
+        for system_message in system_messages:
+            self.register_system_message(system_message)
+
+    def register(self, prefix_text):
+        """Register a fixed prefix given as the exact text that starts the prompt."""
+        if prefix_text not in self._prefix_ids:
+            self._prefix_ids[prefix_text] = self.tokenizer(prefix_text, return_tensors="pt")["input_ids"][0]
+        return prefix_text
+
+    def register_system_message(self, system_message):
+        """Register the system turn (rendered with `chat_template`) of a system message."""
+        conversation = [{"role": "system", "content": [{"type": "text", "text": system_message}]}]
+        prefix_text = self.tokenizer.apply_chat_template(conversation,
+                                                         tokenize=False,
+                                                         add_generation_prompt=False,
+                                                         chat_template=chat_template
+                                                         )
+        return self.register(prefix_text)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "prefixes": len(self._prefix_ids),
+        }
+
+    def match(self, input_ids):
+        """Return the longest registered prefix (text, token ids) that input_ids (seq_len,) starts with, or (None, None)."""
+        best_text, best_ids = None, None
+        for prefix_text, prefix_ids in self._prefix_ids.items():
+            n = len(prefix_ids)
+            if n >= len(input_ids) or (best_ids is not None and n <= len(best_ids)):
+                continue
+            if torch.equal(input_ids[:n].cpu(), prefix_ids):
+                best_text, best_ids = prefix_text, prefix_ids
+        return best_text, best_ids
+
+    @torch.no_grad()
+    def _get_entry(self, model, prefix_text):
+        key = (prefix_text, model.dtype, str(model.device))
+        if key not in self._entries:
+            prefix_ids = self._prefix_ids[prefix_text].unsqueeze(0).to(model.device)
+            # the prefix is text only, so its M-RoPE positions are the same on the 3 axes
+            position_ids, _ = model.get_rope_index(prefix_ids, None, None, attention_mask=torch.ones_like(prefix_ids))
+            outputs = model.model(input_ids=prefix_ids, position_ids=position_ids, use_cache=True, return_dict=True)
+            self._entries[key] = outputs.past_key_values
+        return self._entries[key]
+
+    def prepare_inputs(self, model, inputs):
+        """
+        Turn the processor outputs of a single request into forward kwargs that start from the cached prefix.
+        Returns (prefix_length, forward_kwargs); prefix_length is 0 and the inputs are returned as they are if
+        no registered prefix matches.
+
+        The M-RoPE positions of the suffix are sliced from `get_rope_index` over the full sequence, so they (and
+        `model.rope_deltas` for any following decode steps) are the same as without the prefix cache.
+        """
+        input_ids = inputs["input_ids"]
+        attention_mask = inputs.get("attention_mask")
+        if input_ids.shape[0] != 1 or (attention_mask is not None and not attention_mask.all()):
+            return 0, dict(inputs)
+        prefix_text, prefix_ids = self.match(input_ids[0])
+        if prefix_text is None:
+            self.misses += 1
+            return 0, dict(inputs)
+        self.hits += 1
+
+        prefix_length = len(prefix_ids)
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        position_ids, rope_deltas = model.get_rope_index(
+            input_ids, inputs.get("image_grid_thw"), inputs.get("video_grid_thw"), attention_mask=attention_mask
+        )
+        model.rope_deltas = rope_deltas
+
+        forward_kwargs = dict(inputs)
+        forward_kwargs.update(
+            input_ids=input_ids[:, prefix_length:],
+            attention_mask=attention_mask, # covers the prefix as well
+            position_ids=position_ids[:, :, prefix_length:],
+            past_key_values=copy.deepcopy(self._get_entry(model, prefix_text)),
+            cache_position=torch.arange(prefix_length, input_ids.shape[1], device=input_ids.device),
+        )
+        return prefix_length, forward_kwargs
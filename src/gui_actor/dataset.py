@@ -1,15 +1,20 @@
 import copy
+import hashlib
+import io
 import json
 import math
 import os
 import random
 import re
 import ast
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict
 
+import numpy as np
 import torch
 import transformers
 import yaml
+from PIL import Image
 from qwen_vl_utils import smart_resize, process_vision_info
 from torch.utils.data import Dataset
 
@@ -91,31 +96,54 @@ def get_token_index(image_processor, image, point_x, point_y):
         point_x: the x coordinate of the point, in [0, 1].
         point_y: the y coordinate of the point, in [0, 1].
     """
+    return get_token_indices(image_processor, image, [(point_x, point_y)])[0]
+
+def get_token_indices(image_processor, image, points):
+    """
+    Batched version of `get_token_index`.
+    Args:
+        image_processor: the image processor
+        image: the image in PIL format
+        points: list of (x, y) coordinates, in [0, 1]
+    Returns:
+        list of visual token indices, one per point
+    """
     if len(image) != 1:
         raise ValueError(f"Expected 1 image, got {len(image)}")
     
     # get the original image size and the resized image size
     image = image[0]
     w, h = image.size
-    px, py = w * point_x, h * point_y
-    # rank0_print(f"px: {px}, py: {py}")
-    # get the token index
     merge_patch_size = image_processor.patch_size * image_processor.merge_size
-    x_index = math.floor(px / merge_patch_size)
-    y_index = math.floor(py / merge_patch_size)
-    
-    visual_token_index = y_index * (w // merge_patch_size) + x_index
-
-    # merge all above print into one line
-    return visual_token_index
+    points = torch.tensor(points, dtype=torch.float64).view(-1, 2)
+    x_index = torch.floor(points[:, 0] * w / merge_patch_size).long()
+    y_index = torch.floor(points[:, 1] * h / merge_patch_size).long()
+    return (y_index * (w // merge_patch_size) + x_index).tolist()
 
-def get_multi_patch_labels(image_processor, image, bbox_gt):
+def get_multi_patch_labels(image_processor, image, bbox_gt, return_sparse=False):
     """
     Get the multi-patch labels for the bounding box.
     Args:
         image_processor: the image processor
         image: the image in PIL format
         bbox_gt: the bounding box in the format of (x_min, y_min, x_max, y_max) [0,1]
+        return_sparse: return a sparse COO tensor instead of a dense mask
+    """
+    return get_multi_patch_labels_batch(image_processor, image, [bbox_gt], return_sparse=return_sparse)[0]
+
+def get_multi_patch_labels_batch(image_processor, image, bboxes_gt, return_sparse=False):
+    """
+    Get the multi-patch labels of several bounding boxes at once.
+    A patch is labeled 1 if it overlaps with the bounding box, so the covered patches of each box are a contiguous
+    range of rows times a contiguous range of columns: both ranges are computed on the 1D row / column grids and
+    the mask is their outer product.
+    Args:
+        image_processor: the image processor
+        image: the image in PIL format
+        bboxes_gt: list of bounding boxes in the format of (x_min, y_min, x_max, y_max) [0,1]
+        return_sparse: return a sparse COO tensor (only the covered patches are stored) instead of a dense mask
+    Returns:
+        (n_bbox, grid_h * grid_w) float tensor
     """
     if len(image) != 1:
         raise ValueError(f"Expected 1 image, got {len(image)}")
@@ -124,36 +152,31 @@ def get_multi_patch_labels(image_processor, image, bbox_gt):
     image = image[0]
     w, h = image.size
 
-    bbox_gt = [bbox_gt[0]*w, bbox_gt[1]*h, bbox_gt[2]*w, bbox_gt[3]*h]
-    # Extract bounding box coordinates
-    x_min, y_min, x_max, y_max = bbox_gt
-    x_min = max(0, x_min)
-    y_min = max(0, y_min)
-    x_max = min(w, x_max)
-    y_max = min(h, y_max)
-
     merge_patch_size = image_processor.patch_size * image_processor.merge_size
     assert w % merge_patch_size == 0 and h % merge_patch_size == 0, f"Image size {w}x{h} is not divisible by merge_patch_size {merge_patch_size}"
     grid_h, grid_w = h // merge_patch_size, w // merge_patch_size
 
-    binary_mask = torch.zeros(grid_h * grid_w)
-    # Iterate through all patches, check if they overlap with the bounding box
-    for y_idx in range(grid_h):
-        for x_idx in range(grid_w):
-            # Calculate patch boundaries
-            patch_x_min = x_idx * merge_patch_size
-            patch_y_min = y_idx * merge_patch_size
-            patch_x_max = patch_x_min + merge_patch_size
-            patch_y_max = patch_y_min + merge_patch_size
-            
-            # Check if patch overlaps with the bounding box
-            if not (patch_x_max <= x_min or patch_x_min >= x_max or 
-                    patch_y_max <= y_min or patch_y_min >= y_max):
-                # Calculate patch index in the flattened grid
-                patch_idx = y_idx * grid_w + x_idx
-                binary_mask[patch_idx] = 1
-
-    return binary_mask
+    # Extract bounding box coordinates
+    bboxes_gt = torch.tensor(bboxes_gt, dtype=torch.float64).view(-1, 4) * torch.tensor([w, h, w, h], dtype=torch.float64)
+    x_min = bboxes_gt[:, 0:1].clamp(min=0)
+    y_min = bboxes_gt[:, 1:2].clamp(min=0)
+    x_max = bboxes_gt[:, 2:3].clamp(max=w)
+    y_max = bboxes_gt[:, 3:4].clamp(max=h)
+
+    # Check which patch columns / rows overlap with the bounding box
+    patch_x_min = torch.arange(grid_w, dtype=torch.float64) * merge_patch_size
+    patch_y_min = torch.arange(grid_h, dtype=torch.float64) * merge_patch_size
+    cols = (patch_x_min + merge_patch_size > x_min) & (patch_x_min < x_max) # (n_bbox, grid_w)
+    rows = (patch_y_min + merge_patch_size > y_min) & (patch_y_min < y_max) # (n_bbox, grid_h)
+
+    if return_sparse:
+        # patch index = y_idx * grid_w + x_idx for every (bbox, covered row, covered column)
+        bbox_idx, y_idx, x_idx = torch.nonzero(rows.unsqueeze(2) & cols.unsqueeze(1), as_tuple=True)
+        indices = torch.stack([bbox_idx, y_idx * grid_w + x_idx])
+        return torch.sparse_coo_tensor(indices, torch.ones(indices.shape[1]), (len(bboxes_gt), grid_h * grid_w), check_invariants=False).coalesce()
+
+    binary_mask = rows.unsqueeze(2) & cols.unsqueeze(1) # (n_bbox, grid_h, grid_w)
+    return binary_mask.view(len(bboxes_gt), grid_h * grid_w).float()
 
 def token_index_to_coordinates(image_processor, visual_token_index, image_width, image_height):
     merge_patch_size = image_processor.patch_size * image_processor.merge_size
@@ -163,6 +186,168 @@ def token_index_to_coordinates(image_processor, visual_token_index, image_width,
     py = y_index * merge_patch_size + merge_patch_size / 2
     return px, py
 
+class JsonRecordStore:
+    """
+    Records of one or more .json / .jsonl files, parsed lazily on access.
+    Only the byte offset (int64) and source id (int32) of each selected record are kept in memory, so loading a
+    dataset costs O(n_records) small integers instead of one Python dict per sample, and forked DataLoader workers
+    share the arrays instead of copying millions of dicts.
+
+    A .jsonl file is indexed by scanning it for line starts; the index is saved next to it (`<file>.offsets.npy`) and
+    reused while the file is unchanged. A .json file (one JSON list) is converted once to a `<file>.records.jsonl`
+    sidecar. If the sidecar files cannot be written, the records are kept in memory as before.
+    """
+    SCAN_CHUNK_BYTES = 16 * 1024 * 1024
+
+    def __init__(self):
+        self.sources = [] # (jsonl path or None, images folder, in-memory records or None)
+        self.source_offsets = [] # offsets of all the records of each source, before sampling
+        self._offsets = [] # per added file: selected record offsets (or indices for in-memory records)
+        self._source_ids = []
+        self.offsets = np.zeros(0, dtype=np.int64)
+        self.source_ids = np.zeros(0, dtype=np.int32)
+        self._files = {}
+        self._pid = None
+
+    @staticmethod
+    def _atomic_save(path, write):
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        write(tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def _index_jsonl(cls, path):
+        """Byte offsets of the non-empty lines of a JSONL file."""
+        index_path = f"{path}.offsets.npy"
+        file_size = os.path.getsize(path)
+        if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+            index = np.load(index_path)
+            if len(index) > 0 and index[-1] == file_size: # the last element is the indexed file size
+                return index[:-1]
+
+        starts = [np.zeros(1, dtype=np.int64)]
+        with open(path, "rb") as f:
+            position = 0
+            while True:
+                chunk = f.read(cls.SCAN_CHUNK_BYTES)
+                if not chunk:
+                    break
+                newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+                starts.append(newlines.astype(np.int64) + position + 1)
+                position += len(chunk)
+        starts = np.concatenate(starts)
+        starts = starts[starts < file_size]
+        # drop empty lines
+        ends = np.append(starts[1:], file_size)
+        offsets = starts[ends - starts > 1]
+
+        def write(tmp_path):
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.append(offsets, file_size))
+        try:
+            cls._atomic_save(index_path, write)
+        except OSError:
+            pass
+        return offsets
+
+    @classmethod
+    def _json_to_jsonl(cls, path):
+        """Convert a JSON list file to a JSONL sidecar (once), return the sidecar path or None if it cannot be written."""
+        jsonl_path = f"{path}.records.jsonl"
+        if os.path.exists(jsonl_path) and os.path.getmtime(jsonl_path) >= os.path.getmtime(path):
+            return jsonl_path
+        with open(path) as file:
+            records = json.load(file)
+
+        def write(tmp_path):
+            with open(tmp_path, "w") as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+        try:
+            cls._atomic_save(jsonl_path, write)
+        except OSError:
+            return None
+        return jsonl_path
+
+    def add_file(self, path, images_folder="", sampling_strategy="all"):
+        """
+        Add the records of a .json or .jsonl file, selected with a YAML `sampling_strategy`
+        ("all", "first:N", "end:N", "random:N", N can also be a percentage like "10%"). Returns the number of records added.
+        """
+        records = None
+        if path.endswith(".jsonl"):
+            jsonl_path = path
+        elif path.endswith(".json"):
+            jsonl_path = self._json_to_jsonl(path)
+            if jsonl_path is None:
+                with open(path) as file:
+                    records = json.load(file)
+        else:
+            raise ValueError(f"Unsupported file type: {path}")
+        offsets = np.arange(len(records), dtype=np.int64) if records is not None else self._index_jsonl(jsonl_path)
+        self.source_offsets.append(offsets)
+
+        sampling_number = None
+        if ":" in sampling_strategy:
+            sampling_strategy, sampling_number = sampling_strategy.split(":")
+            if "%" in sampling_number:
+                sampling_number = math.ceil(int(sampling_number.split("%")[0]) * len(offsets) / 100)
+            else:
+                sampling_number = int(sampling_number)
+
+        # Apply the sampling strategy
+        if sampling_strategy == "first" and sampling_number is not None:
+            offsets = offsets[:sampling_number]
+        elif sampling_strategy == "end" and sampling_number is not None:
+            offsets = offsets[-sampling_number:]
+        elif sampling_strategy == "random" and sampling_number is not None:
+            offsets = offsets[np.random.default_rng(random.getrandbits(64)).permutation(len(offsets))[:sampling_number]]
+
+        self.sources.append((None if records is not None else jsonl_path, images_folder, records))
+        self.offsets = np.concatenate([self.offsets, offsets])
+        self.source_ids = np.concatenate([self.source_ids, np.full(len(offsets), len(self.sources) - 1, dtype=np.int32)])
+        return len(offsets)
+
+    def _file(self, path):
+        # file handles are per process, DataLoader workers must not share the file position
+        if self._pid != os.getpid():
+            self._files = {}
+            self._pid = os.getpid()
+        if path not in self._files:
+            self._files[path] = open(path, "rb")
+        return self._files[path]
+
+    def __getitem__(self, i):
+        if i < 0 or i >= len(self.offsets):
+            raise IndexError(f"Record index {i} out of range")
+        jsonl_path, _, records = self.sources[self.source_ids[i]]
+        if records is not None:
+            return records[self.offsets[i]]
+        f = self._file(jsonl_path)
+        f.seek(int(self.offsets[i]))
+        return json.loads(f.readline())
+
+    def images_folder(self, i):
+        return self.sources[self.source_ids[i]][1]
+
+    def source_rows(self, source_id):
+        """Positions in the store and rows in the source file (before sampling) of the records taken from a source."""
+        positions = np.flatnonzero(self.source_ids == source_id)
+        return positions, np.searchsorted(self.source_offsets[source_id], self.offsets[positions])
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_files"], state["_pid"] = {}, None
+        return state
+
+
 class LazySupervisedDataset(Dataset):
     def __init__(
         self,
@@ -174,8 +359,7 @@ class LazySupervisedDataset(Dataset):
         super().__init__()
         self.tokenizer = tokenizer
         self.processor = processor
-        self.list_data_dict = []
-        self.list_image_path = []
+        self.list_data_dict = JsonRecordStore() # records are parsed lazily, see JsonRecordStore
         self.pointer_pad_token_id = tokenizer.encode(DEFAULT_POINTER_PAD_TOKEN)[0]
         self.pointer_start_token_id = tokenizer.encode(DEFAULT_POINTER_START_TOKEN)[0]
         self.pointer_end_token_id = tokenizer.encode(DEFAULT_POINTER_END_TOKEN)[0]
@@ -190,10 +374,8 @@ class LazySupervisedDataset(Dataset):
                 data_args.dataset_paths.append(f"{base_path}{file_name}.json")
                 full_path = f"{base_path}{file_name}.json"
                 rank0_print(f"Loading {full_path}")
-                with open(full_path) as file:
-                    cur_data_dict = json.load(file)
-                    rank0_print(f"Loaded {len(cur_data_dict)} samples from {full_path}")
-                    self.list_data_dict.extend(cur_data_dict)
+                n_loaded = self.list_data_dict.add_file(full_path)
+                rank0_print(f"Loaded {n_loaded} samples from {full_path}")
         elif data_path.endswith(".yaml"):
             with open(data_path) as file:
                 yaml_data = yaml.safe_load(file)
@@ -211,50 +393,15 @@ class LazySupervisedDataset(Dataset):
                     json_path = dataset.get("json_path")
                     sampling_strategy = dataset.get("sampling_strategy", "all")
                     images_folder = dataset.get("images_folder")
-                    sampling_number = None
 
                     rank0_print(f"Loading {json_path} with {sampling_strategy} sampling strategy")
-
-                    if json_path.endswith(".jsonl"):
-                        cur_data_dict = []
-                        with open(json_path) as json_file:
-                            for line in json_file:
-                                cur_data_dict.append(json.loads(line.strip()))
-                    elif json_path.endswith(".json"):
-                        # NOTE: we only use json_path with .json now
-                        # Handle the images_folder in yaml
-                        with open(json_path) as json_file:
-                            cur_data_dict = json.load(json_file)
-                    else:
-                        raise ValueError(f"Unsupported file type: {json_path}")
-
-                    if ":" in sampling_strategy:
-                        sampling_strategy, sampling_number = sampling_strategy.split(":")
-                        if "%" in sampling_number:
-                            sampling_number = math.ceil(int(sampling_number.split("%")[0]) * len(cur_data_dict) / 100)
-                        else:
-                            sampling_number = int(sampling_number)
-
-                    # Apply the sampling strategy
-                    if sampling_strategy == "first" and sampling_number is not None:
-                        cur_data_dict = cur_data_dict[:sampling_number]
-                    elif sampling_strategy == "end" and sampling_number is not None:
-                        cur_data_dict = cur_data_dict[-sampling_number:]
-                    elif sampling_strategy == "random" and sampling_number is not None:
-                        random.shuffle(cur_data_dict)
-                        cur_data_dict = cur_data_dict[:sampling_number]
-
-                    rank0_print(f"Loaded {len(cur_data_dict)} samples from {json_path}")
-                    self.list_data_dict.extend(cur_data_dict)
-                    self.list_image_path.extend([images_folder] * len(cur_data_dict))
+                    n_loaded = self.list_data_dict.add_file(json_path, images_folder, sampling_strategy)
+                    rank0_print(f"Loaded {n_loaded} samples from {json_path}")
         else:
             data_args.dataset_paths = [data_path]
             rank0_print(f"Loading {data_path}")
-            with open(data_path) as file:
-                cur_data_dict = json.load(file)
-                rank0_print(f"Loaded {len(cur_data_dict)} samples from {data_path}")
-                self.list_data_dict.extend(cur_data_dict)
-                self.list_image_path.extend([""] * len(cur_data_dict))  # NOTE: the image subfolder is empty...
+            n_loaded = self.list_data_dict.add_file(data_path)  # NOTE: the image subfolder is empty...
+            rank0_print(f"Loaded {n_loaded} samples from {data_path}")
 
         rank0_print(f"Loaded {len(self.list_data_dict)} samples from {data_path}")
         rank0_print("Formatting inputs...Skip in lazy mode")
@@ -264,32 +411,105 @@ class LazySupervisedDataset(Dataset):
     def __len__(self):
         return len(self.list_data_dict)
 
+    def _count_tokens(self, record, image_path):
+        """
+        (n_text_tokens, n_image_tokens) of a record: the tokenized conversation values and the visual tokens of its
+        images at their smart_resize size (only the image headers are read).
+        """
+        values = [conv["value"] for conv in record["conversations"]]
+        n_text_tokens = sum(len(ids) for ids in self.tokenizer(values, add_special_tokens=False)["input_ids"])
+        if record["conversations"][0]["from"] != "system":
+            # preprocess_qwen2vl adds the default system message
+            if getattr(self, "_n_system_tokens", None) is None:
+                self._n_system_tokens = len(self.tokenizer.apply_chat_template(
+                    conversation=[{"role": "system", "content": [{"type": "text", "text": grounding_system_message}]}],
+                    chat_template=chat_template,
+                ))
+            n_text_tokens += self._n_system_tokens
+
+        image_files = record.get("image", [])
+        image_files = image_files if isinstance(image_files, list) else [image_files]
+        image_processor = self.processor.image_processor
+        factor = image_processor.patch_size * image_processor.merge_size
+        n_image_tokens = 0
+        for image_file in image_files:
+            try:
+                with Image.open(os.path.join(image_path, image_file)) as image:
+                    width, height = image.size
+                resized_height, resized_width = smart_resize(
+                    height, width, factor=factor, min_pixels=image_processor.min_pixels, max_pixels=image_processor.max_pixels
+                )
+                n_image_tokens += (resized_height // factor) * (resized_width // factor)
+            except Exception as e:
+                rank0_print(f"Failed to read the size of {image_file}, assuming 1200 image tokens. Exception:", e)
+                n_image_tokens += 1200
+        return n_text_tokens, n_image_tokens
+
+    def _length_table_path(self, source_id):
+        jsonl_path, images_folder, _ = self.list_data_dict.sources[source_id]
+        if jsonl_path is None:
+            return None
+        image_processor = self.processor.image_processor
+        key = json.dumps([
+            self.tokenizer.name_or_path, len(self.tokenizer),
+            image_processor.patch_size * image_processor.merge_size, image_processor.min_pixels, image_processor.max_pixels,
+            self.data_args.image_folder, images_folder, grounding_system_message,
+        ])
+        return f"{jsonl_path}.lengths-{hashlib.sha1(key.encode()).hexdigest()[:16]}.npy"
+
+    def _get_length_table(self):
+        """
+        (n_samples, 2) array of the text and image token counts of every sample, computed once with a thread pool.
+        Counts are kept per source file next to it (`<file>.lengths-<key>.npy`, -1 for records not counted yet), so
+        later runs, other ranks and other samplings of the same file reuse them.
+        """
+        if getattr(self, "_length_table", None) is not None:
+            return self._length_table
+
+        length_table = np.zeros((len(self.list_data_dict), 2), dtype=np.int64)
+        for source_id in range(len(self.list_data_dict.sources)):
+            positions, rows = self.list_data_dict.source_rows(source_id)
+            table_path = self._length_table_path(source_id)
+            n_records = len(self.list_data_dict.source_offsets[source_id])
+            source_table = np.load(table_path) if table_path is not None and os.path.exists(table_path) else None
+            if source_table is None or source_table.shape != (n_records, 2):
+                source_table = np.full((n_records, 2), -1, dtype=np.int32)
+
+            missing_mask = (source_table[rows] < 0).any(axis=-1)
+            missing = positions[missing_mask]
+            if len(missing) > 0:
+                image_path = os.path.join(self.data_args.image_folder, self.list_data_dict.sources[source_id][1] or "")
+                rank0_print(f"Counting the tokens of {len(missing)} samples")
+
+                def count_chunk(chunk):
+                    return [self._count_tokens(self.list_data_dict[int(i)], image_path) for i in chunk]
+                chunks = np.array_split(missing, max(1, len(missing) // 256))
+                with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) + 4)) as executor:
+                    counts = [count for chunk_counts in executor.map(count_chunk, chunks) for count in chunk_counts]
+                source_table[rows[missing_mask]] = counts
+                if table_path is not None:
+                    def write(tmp_path):
+                        with open(tmp_path, "wb") as f:
+                            np.save(f, source_table)
+                    try:
+                        JsonRecordStore._atomic_save(table_path, write)
+                    except OSError:
+                        pass
+            length_table[positions] = source_table[rows]
+
+        self._length_table = length_table
+        return length_table
+
     @property
     def lengths(self):
-        length_list = []
-        for sample in self.list_data_dict:
-            img_tokens = (
-                1200 * len(sample["image"]) if isinstance(sample["image"], list) else 1200 if "image" in sample else 0
-            )
-            length_list.append(sum(len(conv["value"].split()) for conv in sample["conversations"]) + img_tokens)
-        return length_list
+        length_table = self._get_length_table()
+        return length_table.sum(axis=-1).tolist()
 
     @property
     def modality_lengths(self):
-        length_list = []
-        for sample in self.list_data_dict:
-            cur_len = sum(len(conv["value"].split()) for conv in sample["conversations"])
-            assert cur_len > 0, f"Conversation length is 0 for {sample}"
-
-            img_tokens = (
-                1200 * len(sample["image"]) if isinstance(sample["image"], list) else 1200 if "image" in sample else 0
-            )
-
-            if "image" in sample or "video" in sample or self.data_args.early_mix_text:
-                length_list.append(cur_len + img_tokens)
-            else:
-                length_list.append(-cur_len)
-        return length_list
+        length_table = self._get_length_table()
+        n_text_tokens, n_image_tokens = length_table[:, 0], length_table[:, 1]
+        return np.where((n_image_tokens > 0) | self.data_args.early_mix_text, n_text_tokens + n_image_tokens, -n_text_tokens).tolist()
 
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
         sample = self._get_item(i)
@@ -309,12 +529,13 @@ class LazySupervisedDataset(Dataset):
             return self.__getitem__(new_index)
         return sample
 
-    def _get_item(self, i) -> Dict[str, torch.Tensor]:
-        sources = self.list_data_dict[i]
-        image_path = os.path.join(self.data_args.image_folder, self.list_image_path[i])
+    def _get_item(self, i, return_images=False) -> Dict[str, torch.Tensor]:
+        record = self.list_data_dict[i]
+        sources = record
+        image_path = os.path.join(self.data_args.image_folder, self.list_data_dict.images_folder(i))
 
         if "image" in sources:
-            image_file = self.list_data_dict[i]["image"]
+            image_file = record["image"]
             if type(image_file) is list:
                 image_list = [os.path.join(image_path, image_file) for image_file in image_file]
             else:
@@ -326,7 +547,7 @@ class LazySupervisedDataset(Dataset):
         else:
             sources = copy.deepcopy(sources["conversations"])
 
-        item_id = self.list_data_dict[i].get("id", i)
+        item_id = record.get("id", i)
 
         data_dict = self.preprocess_qwen2vl(sources, self.tokenizer, self.processor, image_list, id=item_id)
         if isinstance(i, int):
@@ -338,6 +559,7 @@ class LazySupervisedDataset(Dataset):
                 "pixel_values": data_dict["pixel_values"],
                 "image_grid_thw": data_dict["image_grid_thw"],
                 "multi_patch_labels": data_dict["multi_patch_labels"][0],   # add multi_patch_labels                
+                **({"images": data_dict["images"]} if return_images else {}), # resized PIL images, for offline preprocessing
             }
 
         data_dict["id"] = item_id
@@ -460,29 +682,21 @@ class LazySupervisedDataset(Dataset):
 
                         # get the visual token indices of the coordinates
                         coordinates.extend(coord)
-                        for (point_x, point_y) in coord:
-                            visual_token_index = get_token_index(
+                        if len(coord) > 0:
+                            visual_token_indices_of_coordinates.extend(get_token_indices(
                                 processor.image_processor,
                                 image_list,
-                                point_x,
-                                point_y
-                            )
-                            # px, py = token_index_to_coordinates(
-                            #     processor.image_processor,
-                            #     visual_token_index,
-                            #     image_list[0].size[0], # make sure the size here is after qwen2vl processing
-                            #     image_list[0].size[1]
-                            # )
-                            # rank0_print(f"estimated px: {px}, py: {py}")
-                            visual_token_indices_of_coordinates.append(visual_token_index)
+                                coord
+                            ))
 
                             if conv["bbox_gt"] is not None:
-                                patch_mask = get_multi_patch_labels(
+                                # every coordinate of the turn refers to the same bounding box
+                                multi_patch_labels.append(get_multi_patch_labels_batch(
                                     processor.image_processor,
                                     image_list,
-                                    conv["bbox_gt"]
-                                )  
-                                multi_patch_labels.append(patch_mask)
+                                    [conv["bbox_gt"]] * len(coord),
+                                    return_sparse=self.data_args.sparse_patch_labels
+                                ))
 
                 templated_conv = tokenizer.apply_chat_template(
                     conversation=[conv],
@@ -511,7 +725,7 @@ class LazySupervisedDataset(Dataset):
 
         # process multi_patch_labels
         if len(multi_patch_labels) > 0:
-            multi_patch_labels = [torch.stack(multi_patch_labels)]
+            multi_patch_labels = [torch.cat(multi_patch_labels)] # (n_target, n_visual), dense or sparse
         else:
             multi_patch_labels = [None]
 
@@ -529,5 +743,151 @@ class LazySupervisedDataset(Dataset):
         data_dict["coordinates"] = coordinates
         data_dict["visual_token_indices_of_coordinates"] = visual_token_indices_of_coordinates
         data_dict["multi_patch_labels"] = multi_patch_labels
+        data_dict["images"] = image_list
         
         return data_dict
+
+
+PREPROCESS_FORMAT_VERSION = 1
+
+
+def preprocess_cache_key(processor, data_path, data_args):
+    """
+    Hash of everything that changes the output of `LazySupervisedDataset._get_item`: the dataset spec, the processor
+    and tokenizer configs, the templates and system message, and `min_pixels`/`max_pixels`.
+    A preprocessed cache (see `gui_actor.preprocess`) is only used if its key matches.
+    """
+    tokenizer = processor.tokenizer
+    image_processor = processor.image_processor
+    config = {
+        "format_version": PREPROCESS_FORMAT_VERSION,
+        "data_path": os.path.abspath(data_path),
+        "image_folder": data_args.image_folder,
+        "max_conv_turns": data_args.max_conv_turns,
+        "min_pixels": image_processor.min_pixels,
+        "max_pixels": image_processor.max_pixels,
+        "image_processor": image_processor.to_json_string(),
+        "tokenizer": [tokenizer.name_or_path, len(tokenizer), tokenizer.model_max_length, tokenizer.additional_special_tokens],
+        "chat_template": chat_template,
+        "assistant_template": assistant_template,
+        "grounding_system_message": grounding_system_message,
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class _PreprocessedShard:
+    """Read side of a shard written by `gui_actor.preprocess`; every field is a memory-mapped ragged array."""
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, "ids.json")) as f:
+            self.ids = json.load(f)
+        self._arrays = {}
+
+    def _array(self, name):
+        if name not in self._arrays:
+            self._arrays[name] = np.load(os.path.join(self.shard_dir, f"{name}.npy"), mmap_mode="r")
+        return self._arrays[name]
+
+    def get(self, name, j):
+        offsets = self._array(f"{name}_offsets")
+        return self._array(name)[offsets[j]:offsets[j + 1]]
+
+    def get_image_bytes(self, j):
+        # images are indexed globally within the shard, the samples' image ranges follow image_grid_thw
+        image_offsets = self._array("image_grid_thw_offsets")
+        byte_offsets = self._array("image_bytes_offsets")
+        data = self._array("image_bytes")
+        return [bytes(data[byte_offsets[k]:byte_offsets[k + 1]]) for k in range(image_offsets[j], image_offsets[j + 1])]
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class CachedSupervisedDataset(Dataset):
+    """
+    Serves the samples written by `python -m gui_actor.preprocess`: token ids, labels, patch labels and the already
+    resized images are read from memory-mapped shards, so there is no chat templating, tokenization or resizing at
+    train time. Only the image normalization/patchification of `processor.image_processor` is left.
+    Returns the same items as `LazySupervisedDataset`.
+    """
+    def __init__(
+        self,
+        processor: transformers.ProcessorMixin,
+        cache_dir: str,
+        data_args,
+    ):
+        super().__init__()
+        self.processor = processor
+        self.data_args = data_args
+        with open(os.path.join(cache_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.shards = [_PreprocessedShard(os.path.join(cache_dir, shard)) for shard in self.meta["shards"]]
+        # (shard, index in shard) of every sample
+        self.index = [(s, j) for s, shard in enumerate(self.shards) for j in range(len(shard))]
+        rank0_print(f"Loaded {len(self.index)} preprocessed samples from {cache_dir}")
+
+    @staticmethod
+    def is_valid(cache_dir, processor, data_path, data_args):
+        meta_path = os.path.join(cache_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return meta.get("cache_key") == preprocess_cache_key(processor, data_path, data_args)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        shard_index, j = self.index[i]
+        shard = self.shards[shard_index]
+
+        data_dict = {
+            "input_ids": torch.from_numpy(shard.get("input_ids", j).astype(np.int64)),
+            "labels": torch.from_numpy(shard.get("labels", j).astype(np.int64)),
+            "coordinates": None,
+            "visual_token_indices_of_coordinates": None,
+            "multi_patch_labels": None,
+        }
+
+        images = [Image.open(io.BytesIO(image_bytes)).convert("RGB") for image_bytes in shard.get_image_bytes(j)]
+        if len(images) > 0:
+            # the images are stored at their smart_resize size already
+            image_inputs = self.processor.image_processor(images=images, do_resize=False, return_tensors="pt")
+            data_dict["pixel_values"] = image_inputs["pixel_values"]
+            data_dict["image_grid_thw"] = torch.from_numpy(shard.get("image_grid_thw", j).astype(np.int64))
+
+        coordinates = shard.get("coordinates", j)
+        if len(coordinates) > 0:
+            data_dict["coordinates"] = [tuple(coord) for coord in coordinates.tolist()]
+            data_dict["visual_token_indices_of_coordinates"] = torch.from_numpy(shard.get("visual_token_indices", j).astype(np.int64))
+
+        n_patch_label_targets = int(shard.get("n_patch_label_targets", j)[0])
+        if n_patch_label_targets > 0:
+            # labels of the first image, see get_multi_patch_labels
+            merge_size = self.processor.image_processor.merge_size
+            n_visual = int(np.prod(data_dict["image_grid_thw"][0].tolist())) // (merge_size * merge_size)
+            indices = torch.from_numpy(shard.get("patch_labels", j).astype(np.int64)).T # (2, n_labeled)
+            multi_patch_labels = torch.sparse_coo_tensor(
+                indices, torch.ones(indices.shape[1]), (n_patch_label_targets, n_visual), check_invariants=False
+            ).coalesce()
+            data_dict["multi_patch_labels"] = multi_patch_labels if self.data_args.sparse_patch_labels else multi_patch_labels.to_dense()
+
+        data_dict["id"] = shard.ids[j]
+        return data_dict
+
+    def _lengths(self):
+        # exact token counts (the <|image_pad|> tokens are already expanded in input_ids) and image counts
+        n_tokens = np.concatenate([np.diff(shard._array("input_ids_offsets")) for shard in self.shards])
+        n_images = np.concatenate([np.diff(shard._array("image_grid_thw_offsets")) for shard in self.shards])
+        return n_tokens, n_images
+
+    @property
+    def lengths(self):
+        n_tokens, _ = self._lengths()
+        return n_tokens.tolist()
+
+    @property
+    def modality_lengths(self):
+        n_tokens, n_images = self._lengths()
+        return np.where((n_images > 0) | self.data_args.early_mix_text, n_tokens, -n_tokens).tolist()
@@ -0,0 +1,462 @@
+"""
+Evaluation engine shared by the ScreenSpot benchmarks (eval/screenSpot.py, eval/screenSpot_v2.py, eval/screenSpot_pro.py).
+
+A benchmark adapter lists the examples and knows how to load the image and the annotation of each one; the engine
+does the rest:
+    - the examples are split into contiguous shards, one per worker process (each worker loads the model on its own
+      device; with a single worker everything runs in the current process),
+    - every worker prefetches and resizes the upcoming images in a thread pool while the model runs,
+    - every prediction is appended to a JSONL checkpoint as soon as it is scored, and a rerun skips the examples that
+      are already in the checkpoint,
+    - the metrics are computed once at the end with `get_metric`.
+"""
+import json
+import multiprocessing as mp
+import os
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+from tqdm import tqdm
+
+from gui_actor.constants import DEFAULT_POINTER_PAD_TOKEN, DEFAULT_POINTER_END_TOKEN
+from gui_actor.metrics import ResultTable
+from gui_actor.utils import do_boxes_overlap
+
+IMAGE_PATCH_SIZE = 14
+
+QWEN2VL_SYSTEM_MESSAGE = "You are a GUI agent. You are given a task and a screenshot of the screen. You need to perform a series of pyautogui actions to complete the task."
+QWEN25VL_SYSTEM_MESSAGE = "You are a GUI agent. Given a screenshot of the current GUI and a human instruction, your task is to locate the screen element that corresponds to the instruction. You should output a PyAutoGUI action that performs a click on the correct position. To indicate the click location, we will use some special tokens, which is used to refer to a visual patch later. For example, you can output: pyautogui.click(<your_special_token_here>)."
+
+
+def normalize_bbox(bbox_x1y1x2y2, img_width, img_height):
+    # if bbox_x1y1x2y2 is not normalized to [0, 1], normalize it
+    x1, y1, x2, y2 = bbox_x1y1x2y2
+    if (0 <= x1 <= 1) and (0 <= y1 <= 1) and (0 <= x2 <= 1) and (0 <= y2 <= 1):
+        return bbox_x1y1x2y2
+    else:
+        x1 = x1 / img_width
+        y1 = y1 / img_height
+        x2 = x2 / img_width
+        y2 = y2 / img_height
+        return x1, y1, x2, y2
+
+
+class ScreenSpotAdapter:
+    """ScreenSpot / ScreenSpot-v2 from the Hugging Face hub; the screenshots are stored in the dataset."""
+    domain_dict = {
+        "windows": "desktop",
+        "macos": "desktop",
+        "ios": "mobile",
+        "android": "mobile",
+        "tool": "web",
+        "shop": "web",
+        "gitlab": "web",
+        "forum": "web"
+    }
+    # get_metric columns
+    group_key, groups = "domain", ["mobile", "desktop", "web"]
+    type_key, types = "data_type", ["text", "icon"]
+
+    def __init__(self, dataset_name, split="test"):
+        from datasets import load_dataset
+        self.dataset = load_dataset(dataset_name)[split]
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def load(self, index):
+        """Return (image, ele) of an example; ele is the prediction record before scoring."""
+        example = self.dataset[index]
+        image = example["image"]
+        ele = {
+            "file_name": example["file_name"],
+            "data_type": example["data_type"],
+            "domain": self.domain_dict[example["data_source"]],
+            "instruction": example["instruction"],
+            "img_size": image.size,
+            "bbox_x1y1x2y2": normalize_bbox(example["bbox"], image.size[0], image.size[1]),
+        }
+        return image, ele
+
+
+class ScreenSpotProAdapter:
+    """ScreenSpot-Pro from a local copy (`annotations/all.json` + `images/`), optionally resized to `resize_to_pixels`."""
+    group_key, groups = "group", ["Dev", "Creative", "CAD", "Scientific", "Office", "OS"]
+    type_key, types = "ui_type", ["text", "icon"]
+
+    def __init__(self, data_path, resize_to_pixels=None):
+        self.image_dir = os.path.join(data_path, "images")
+        data_fn = os.path.join(data_path, "annotations/all.json")
+        with open(data_fn, "r") as f:
+            self.data = json.load(f)
+        print(f"Loaded {len(self.data)} examples from {data_fn}")
+        self.resize_to_pixels = resize_to_pixels
+
+    def __len__(self):
+        return len(self.data)
+
+    def load(self, index):
+        example = self.data[index]
+        ele = {
+            "file_name": example["img_filename"],
+            "ui_type": example["ui_type"],
+            "group": example["group"],
+            "platform": example["platform"],
+            "application": example["application"],
+            "id": example["id"],
+            "instruction": example["instruction"],
+            "img_size": example["img_size"],
+            "bbox_x1y1x2y2": normalize_bbox(example["bbox"], example["img_size"][0], example["img_size"][1]),
+        }
+        image = Image.open(os.path.join(self.image_dir, example["img_filename"]))
+        # resize the image if needed
+        image_width, image_height = example["img_size"]
+        if (self.resize_to_pixels is not None) and ((image_width * image_height) != self.resize_to_pixels):
+            resize_ratio = (self.resize_to_pixels / (image_width * image_height)) ** 0.5
+            image_width_resized, image_height_resized = int(image_width * resize_ratio), int(image_height * resize_ratio)
+            image = image.resize((image_width_resized, image_height_resized))
+            ele["img_size_resized"] = [image_width_resized, image_height_resized]
+        else:
+            image.load() # decode in the prefetch thread, not in the model loop
+            ele["img_size_resized"] = None
+        return image, ele
+
+
+def load_model(model_name_or_path, model_type, device="cuda:0"):
+    """Return (model, data_processor, grounding_system_message) for a GUI-Actor checkpoint."""
+    from transformers import AutoProcessor
+    from gui_actor.modeling import Qwen2VLForConditionalGenerationWithPointer
+    from gui_actor.modeling_qwen25vl import Qwen2_5_VLForConditionalGenerationWithPointer
+
+    data_processor = AutoProcessor.from_pretrained(model_name_or_path)
+    if model_type == "qwen2vl":
+        print(f"Loading model with Qwen2-VL backbone from {model_name_or_path} on {device}")
+        model_cls, grounding_system_message = Qwen2VLForConditionalGenerationWithPointer, QWEN2VL_SYSTEM_MESSAGE
+    elif model_type == "qwen25vl":
+        print(f"Loading model with Qwen2.5-VL backbone from {model_name_or_path} on {device}")
+        model_cls, grounding_system_message = Qwen2_5_VLForConditionalGenerationWithPointer, QWEN25VL_SYSTEM_MESSAGE
+    else:
+        raise ValueError(f"Invalid model type: {model_type}")
+    model = model_cls.from_pretrained(
+        model_name_or_path,
+        torch_dtype=torch.bfloat16,
+        device_map=device,
+        attn_implementation="flash_attention_2"
+    ).eval()
+    # several instructions can refer to the same screenshot
+    model.enable_image_embed_cache()
+    return model, data_processor, grounding_system_message
+
+
+def score_prediction(ele, topk_points):
+    """Fill the hit/overlap metrics of `ele` from the predicted points (normalized, best first)."""
+    ele.update(hit_top1=0, overlap_top1=0, hit_topk=0, overlap_topk=0)
+    x1, y1, x2, y2 = gt_bbox = ele["bbox_x1y1x2y2"]
+    w, h = ele["img_size"]
+    for rank, (px, py) in enumerate(topk_points):
+        hit = (x1 <= px <= x2) and (y1 <= py <= y2)
+        pred_bbox = [px - IMAGE_PATCH_SIZE / w, py - IMAGE_PATCH_SIZE / h, px + IMAGE_PATCH_SIZE / w, py + IMAGE_PATCH_SIZE / h]
+        overlap = do_boxes_overlap(pred_bbox, gt_bbox)
+        if rank == 0:
+            ele["hit_top1"], ele["overlap_top1"] = int(hit), int(overlap)
+        ele["hit_topk"] = max(ele["hit_topk"], int(hit))
+        ele["overlap_topk"] = max(ele["overlap_topk"], int(overlap))
+    return ele
+
+
+def prefetch(fn, items, num_threads=4, lookahead=8):
+    """Yield fn(item) in order, computing up to `lookahead` upcoming items in a thread pool."""
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = deque()
+        for item in items:
+            futures.append(executor.submit(fn, item))
+            if len(futures) > lookahead:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def _evaluate_shard(adapter, indices, model_name_or_path, model_type, device, use_placeholder, topk, emit, num_threads):
+    from gui_actor.inference import inference, ForceFollowTokensLogitsProcessor
+
+    model, data_processor, grounding_system_message = load_model(model_name_or_path, model_type, device)
+    tokenizer = data_processor.tokenizer
+    logits_processor_pointer = ForceFollowTokensLogitsProcessor(
+        token_a_id=tokenizer.encode(DEFAULT_POINTER_PAD_TOKEN)[0],
+        forced_sequence=[
+            tokenizer.encode(DEFAULT_POINTER_END_TOKEN)[0]
+        ]
+    )
+    for index, (image, ele) in zip(indices, prefetch(adapter.load, indices, num_threads=num_threads)):
+        conversation = [
+            {
+                "role": "system",
+                "content": [{"type": "text", "text": grounding_system_message}]
+            },
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image", "image": image},
+                    {"type": "text", "text": ele["instruction"]},
+                ],
+            },
+        ]
+        pred = inference(conversation, model, tokenizer, data_processor, logits_processor=logits_processor_pointer, use_placeholder=use_placeholder, topk=topk)
+        ele["index"] = index
+        emit(score_prediction(ele, pred["topk_points"]))
+
+
+def _worker(rank, adapter, indices, model_name_or_path, model_type, device, use_placeholder, topk, num_threads, result_queue):
+    _evaluate_shard(adapter, indices, model_name_or_path, model_type, device, use_placeholder, topk,
+                    emit=lambda ele: result_queue.put(ele), num_threads=num_threads)
+    result_queue.put(None) # this shard is done
+
+
+def load_checkpoint(checkpoint_path):
+    """Records of a JSONL prediction checkpoint; a torn last line (crash while writing) is ignored."""
+    results = []
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "r") as f:
+            for line in f:
+                try:
+                    results.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break
+    return results
+
+
+def evaluate(adapter, model_name_or_path, model_type, checkpoint_path, use_placeholder=True, topk=3,
+             devices=("cuda:0",), num_workers=None, num_threads=4, max_examples=None):
+    """
+    Run the model over all examples of `adapter` and return the scored records, in dataset order.
+
+    checkpoint_path: JSONL file the records are appended to as they are produced; examples already in it are skipped.
+    devices: the workers are assigned to the devices round-robin.
+    num_workers: number of worker processes (defaults to one per device).
+    max_examples: only evaluate the first `max_examples` examples.
+    """
+    num_workers = num_workers or len(devices)
+    n_examples = len(adapter) if max_examples is None else min(max_examples, len(adapter))
+    results = [ele for ele in load_checkpoint(checkpoint_path) if ele["index"] < n_examples]
+    done = {ele["index"] for ele in results}
+    pending = [i for i in range(n_examples) if i not in done]
+    if results:
+        print(f"Resuming from {checkpoint_path}: {len(done)} done, {len(pending)} to go")
+
+    # rewrite the checkpoint without a torn last line before appending to it
+    with open(checkpoint_path, "w") as f:
+        f.writelines(json.dumps(ele) + "\n" for ele in results)
+
+    if pending:
+        # contiguous shards keep the instructions about one screenshot on one worker (image embedding cache hits)
+        shards = [shard.tolist() for shard in np.array_split(pending, min(num_workers, len(pending)))]
+        with open(checkpoint_path, "a") as f, tqdm(total=len(pending)) as progress:
+            def emit(ele):
+                f.write(json.dumps(ele) + "\n")
+                f.flush()
+                results.append(ele)
+                progress.update(1)
+
+            if len(shards) == 1:
+                _evaluate_shard(adapter, shards[0], model_name_or_path, model_type, devices[0], use_placeholder, topk, emit, num_threads)
+            else:
+                _run_workers(adapter, shards, model_name_or_path, model_type, devices, use_placeholder, topk, num_threads, emit)
+
+    results.sort(key=lambda ele: ele["index"])
+    return results
+
+
+def _run_workers(adapter, shards, model_name_or_path, model_type, devices, use_placeholder, topk, num_threads, emit):
+    # the parent is the only writer of the checkpoint, the workers send their records through a queue
+    ctx = mp.get_context("spawn")
+    result_queue = ctx.Queue()
+    workers = [
+        ctx.Process(
+            target=_worker,
+            args=(rank, adapter, shard, model_name_or_path, model_type, devices[rank % len(devices)], use_placeholder, topk, num_threads, result_queue),
+        )
+        for rank, shard in enumerate(shards)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        n_running = len(workers)
+        while n_running > 0:
+            try:
+                ele = result_queue.get(timeout=30)
+            except queue.Empty:
+                failed = [rank for rank, worker in enumerate(workers) if worker.exitcode not in (None, 0)]
+                if failed:
+                    raise RuntimeError(f"Evaluation workers {failed} failed, rerun to resume from the checkpoint")
+                continue
+            if ele is None:
+                n_running -= 1
+            else:
+                emit(ele)
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+
+def get_metric(list_of_examples, group_key, groups, type_key, types):
+    """
+    Computes metrics over a list of examples and prints/plots a table.
+
+    Each element in list_of_examples is a dict containing:
+        - group_key: Group name (e.g., "web", "mobile", "desktop" for ScreenSpot, "Dev", "Creative", ... for ScreenSpot-Pro)
+        - type_key: UI type (e.g., "text", "icon")
+        - "hit_top1", "overlap_top1", "hit_topk", "overlap_topk": binary (0 or 1)
+
+    The final table has columns for each group broken down by UI type (plus a group-average)
+    and overall columns ("All-text", "All-icon", "All-avg").
+
+    The rows of the table are:
+        - hit_top1
+        - overlap_top1
+        - hit_topk
+        - overlap_topk
+    """
+
+    # List of metric keys to compute.
+    metrics = ["hit_top1", "overlap_top1", "hit_topk", "overlap_topk"]
+
+    # One pass over the examples: the count and the metric sums of every (group, UI type) cell.
+    table = ResultTable(list_of_examples, categorical=(group_key, type_key), values=metrics)
+    cubes = table.sums((group_key, type_key), metrics)
+
+    # Helper function to compute the mean of every metric over the cells of a group / UI type (None selects all).
+    def compute_mean(group=None, ui=None):
+        select = []
+        for column, category in ((group_key, group), (type_key, ui)):
+            if category is None:
+                select.append(slice(None))
+                continue
+            index = table.index(column, category)
+            if index is None:
+                return {metric: None for metric in metrics}
+            select.append(index)
+        count = cubes["count"][tuple(select)].sum()
+        if count == 0:
+            return {metric: None for metric in metrics}
+        return {metric: float(cubes[metric][tuple(select)].sum() / count) for metric in metrics}
+
+    # Prepare results dictionary: structure {metric: {column_name: value}}.
+    results = {metric: {} for metric in metrics}
+
+    def add_column(col_name, means):
+        for metric in metrics:
+            results[metric][col_name] = means[metric]
+
+    # Compute metrics for each group broken down by UI type, and the group-average (all UI types for this group).
+    for group in groups:
+        for ui in types:
+            add_column(f"{group}-{ui}", compute_mean(group=group, ui=ui))
+        add_column(f"{group}-avg", compute_mean(group=group))
+
+    # Compute overall metrics for each UI type across all groups.
+    for ui in types:
+        add_column(f"All-{ui}", compute_mean(ui=ui))
+
+    # Compute overall average across all examples.
+    add_column("All-avg", compute_mean())
+
+    # Define the order of columns.
+    columns_order = []
+    for group in groups:
+        for ui in types:
+            columns_order.append(f"{group}-{ui}")
+        columns_order.append(f"{group}-avg")
+    for ui in types:
+        columns_order.append(f"All-{ui}")
+    columns_order.append("All-avg")
+
+    # ------------- Print Table to Console -------------
+    # Prepare header row.
+    header = [""] + columns_order
+    # Calculate column widths for console printing.
+    col_widths = [max(len(col), 12) for col in header]
+
+    def format_cell(cell):
+        if isinstance(cell, float):
+            return f"{cell*100:.2f}"
+        elif cell is None:
+            return "N/A"
+        return str(cell)
+
+    # Print header.
+    header_line = " | ".join(word.ljust(width) for word, width in zip(header, col_widths))
+    separator_line = "-+-".join("-" * width for width in col_widths)
+    print(header_line)
+    print(separator_line)
+
+    for metric in metrics:
+        row = [metric]
+        for col in columns_order:
+            val = results[metric].get(col)
+            row.append(format_cell(val))
+        row_line = " | ".join(word.ljust(width) for word, width in zip(row, col_widths))
+        print(row_line)
+
+    # ------------- Print Tab-delimited Version (for Excel Copy-Paste) -------------
+    metric_info = "Tab-delimited Table for Excel:\n"
+    # Header row.
+    header_tab = "\t".join([""] + columns_order)
+    metric_info += (header_tab + "\n")
+    # Each row.
+    for metric in metrics:
+        row = [metric] + [format_cell(results[metric].get(col)) for col in columns_order]
+        metric_info += ("\t".join(row) + "\n")
+    print(metric_info)
+    return metric_info
+
+
+def run_benchmark(adapter, args, pred_path, metric_path):
+    """Shared `__main__` of the eval scripts: evaluate (resuming from the .jsonl checkpoint next to `pred_path`), save predictions and metrics."""
+    if os.path.exists(metric_path):
+        return
+
+    if os.path.exists(pred_path):
+        print(f"Loading predictions from {pred_path}")
+        with open(pred_path, "r") as f:
+            results = json.load(f)
+    else:
+        print(f"Evaluating {args.model_name_or_path}...")
+        results = evaluate(
+            adapter,
+            args.model_name_or_path,
+            args.model_type,
+            checkpoint_path=os.path.splitext(pred_path)[0] + ".jsonl",
+            use_placeholder=args.use_placeholder,
+            topk=args.topk,
+            devices=args.devices.split(","),
+            num_workers=args.num_workers,
+            num_threads=args.num_prefetch_threads,
+            max_examples=args.max_examples,
+        )
+        with open(pred_path, "w") as f:
+            json.dump(results, f)
+        print(f"Saved {len(results)} predictions to {pred_path}")
+
+    metric_info = get_metric(results, adapter.group_key, adapter.groups, adapter.type_key, adapter.types)
+    with open(metric_path, "w") as f:
+        f.write(metric_info)
+    print(f"Saved metric to {metric_path}")
+
+
+def add_eval_arguments(parser):
+    """Arguments shared by the eval scripts."""
+    parser.add_argument("--save_path", type=str, default="./")
+    parser.add_argument('--topk', type=int, default=3, help='Topk')
+    parser.add_argument('--no-placeholder', dest='use_placeholder', action='store_false', help='Disable the placeholder')
+    parser.add_argument("--devices", type=str, default="cuda:0", help="Comma-separated devices, the workers are assigned to them round-robin.")
+    parser.add_argument("--num_workers", type=int, default=None, help="Number of worker processes (default: one per device).")
+    parser.add_argument("--num_prefetch_threads", type=int, default=4, help="Threads per worker that load the upcoming images.")
+    parser.add_argument("--max_examples", type=int, default=None, help="Only evaluate the first N examples.")
+    parser.set_defaults(use_placeholder=True)
+    return parser
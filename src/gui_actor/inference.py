@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 import json
 import re
 import os
@@ -8,7 +9,8 @@ from transformers import (
     LogitsProcessor,
     LogitsProcessorList,
     AutoModelForCausalLM,
-    AutoTokenizer
+    AutoTokenizer,
+    BatchFeature
 )
 from gui_actor.constants import (
     DEFAULT_POINTER_END_TOKEN,
@@ -21,12 +23,13 @@ class ForceFollowTokensLogitsProcessor(LogitsProcessor):
     Forces tokens B (pointer_pad_token) and C (pointer_end_token) to follow token A (pointer_start_token).
     Whenever token_a_id is generated, enqueue the forced_sequence (e.g. [B, C]).
     As long as forced tokens remain in the queue, force them in the output.
+    Each row of the batch has its own queue, so rows are forced independently.
     """
     def __init__(self, token_a_id, forced_sequence=[DEFAULT_POINTER_PAD_TOKEN, DEFAULT_POINTER_END_TOKEN]):
         super().__init__()
         self.token_a_id = token_a_id
         self.forced_sequence = forced_sequence  # list of token IDs, e.g. [B_id, C_id]
-        self.force_queue = []  # holds the tokens we still need to force
+        self.force_queues = []  # per row, holds the tokens we still need to force
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
         """
@@ -37,27 +40,63 @@ class ForceFollowTokensLogitsProcessor(LogitsProcessor):
             scores:    shape (batch_size, vocab_size). Model logits for the next token.
         """
         batch_size = input_ids.shape[0]
-        if batch_size > 1:
-            raise NotImplementedError("Batch size must be 1 for this logits processor.")
-        
-        # We assume batch_size=1 for simplicity; if you have multiple sequences,
-        # you'll need to adapt the logic to handle each item in the batch.
-        last_token_id = input_ids[0, -1].item()
+        if len(self.force_queues) != batch_size:
+            self.force_queues = [[] for _ in range(batch_size)]
+
+        forced_rows, forced_tokens = [], []
+        for row, last_token_id in enumerate(input_ids[:, -1].tolist()):
+            force_queue = self.force_queues[row]
+            # If the last token was A, enqueue B and C
+            if last_token_id == self.token_a_id:
+                force_queue.extend(self.forced_sequence)
+            # If we have forced tokens waiting in the queue, override the distribution of this row
+            if len(force_queue) > 0:
+                forced_rows.append(row)
+                forced_tokens.append(force_queue.pop(0))  # next token to force
 
-        # If the last token was A, enqueue B and C
-        if last_token_id == self.token_a_id:
-            self.force_queue.extend(self.forced_sequence)
-        
-        # If we have forced tokens waiting in the queue, override the distribution
-        if len(self.force_queue) > 0:
-            forced_token = self.force_queue.pop(0)  # next token to force
-            # Create a mask of -inf for all tokens except the forced one
-            new_scores = torch.full_like(scores, float('-inf'))
-            new_scores[0, forced_token] = 0.0  # log prob = 0 => prob = 1
-            return new_scores
-        
         # Otherwise, return scores unmodified
-        return scores
+        if len(forced_rows) == 0:
+            return scores
+
+        # Create a mask of -inf for all tokens except the forced one
+        new_scores = scores.clone()
+        forced_rows = torch.tensor(forced_rows, device=scores.device)
+        new_scores[forced_rows] = float('-inf')
+        new_scores[forced_rows, torch.tensor(forced_tokens, device=scores.device)] = 0.0  # log prob = 0 => prob = 1
+        return new_scores
+
+
+def label_connected_regions(mask):
+    """
+    Label the 4-connected components of a 2D boolean mask.
+
+    Args:
+        mask: bool tensor of shape (n_height, n_width).
+
+    Returns:
+        labels: long tensor of shape (n_height, n_width). Every activated patch holds the flat index of the
+        first (row-major) patch of its region, every other patch holds n_height * n_width.
+    """
+    n_height, n_width = mask.shape
+    n_patches = n_height * n_width
+    background = torch.full(mask.shape, n_patches, dtype=torch.long, device=mask.device)
+    labels = torch.where(mask, torch.arange(n_patches, device=mask.device).view(n_height, n_width), background)
+    # the extra slot keeps background patches pointing at the background during pointer jumping
+    lookup = torch.full((n_patches + 1,), n_patches, dtype=torch.long, device=mask.device)
+
+    while True:
+        # Propagate the smallest label among the 4 adjacent patches
+        padded = F.pad(labels, (1, 1, 1, 1), value=n_patches)
+        new_labels = torch.stack([
+            labels, padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]
+        ]).amin(dim=0)
+        new_labels = torch.where(mask, new_labels, background)
+        # Pointer jumping: take over the label of the patch we point to, so long regions converge quickly
+        lookup[:n_patches] = new_labels.view(-1)
+        new_labels = lookup[new_labels]
+        if torch.equal(new_labels, labels):
+            return labels
+        labels = new_labels
 
 
 def get_prediction_region_point(attn_scores, n_width, n_height, top_n=30, activation_threshold=0.3, return_all_regions=True, rect_center=False):
@@ -67,103 +106,75 @@ def get_prediction_region_point(attn_scores, n_width, n_height, top_n=30, activa
     3. Calculate the average activation value for each region
     4. Select the region with the highest average activation value
     5. Return the center point of that region as the final prediction point
+
+    attn_scores is a tensor or ndarray of shape (n_dec, n_height * n_width), only the first row is used.
+    All the work happens on the device of attn_scores; the results are copied to the host once at the end.
     """
+    attn_scores = torch.as_tensor(attn_scores)
+    device = attn_scores.device
+    dtype = torch.float32 if device.type == "mps" else torch.float64  # mps has no float64
+    scores = attn_scores[0].view(n_height, n_width)
 
     # Get patches with activation values greater than a certain proportion of the maximum activation value as activated patches
-    # Get the highest activation value and threshold
-    max_score = attn_scores[0].max().item()
-    threshold = max_score * activation_threshold
-    # Select all patches above the threshold
-    mask = attn_scores[0] > threshold
-    valid_indices = torch.nonzero(mask).squeeze(-1)
-    topk_values = attn_scores[0][valid_indices]
-    topk_indices = valid_indices
-    
-    # Convert indices to 2D coordinates
-    topk_coords = []
-    for idx in topk_indices.tolist():
-        y = idx // n_width
-        x = idx % n_width
-        topk_coords.append((y, x, idx))
-    
-    # Divide into connected regions
-    regions = []
-    visited = set()
-    for i, (y, x, idx) in enumerate(topk_coords):
-        if idx in visited:
-            continue
-            
-        # Start a new region
-        region = [(y, x, idx, topk_values[i].item())]
-        visited.add(idx)
-        queue = [(y, x, idx, topk_values[i].item())]
-        
-        # BFS to find connected points
-        while queue:
-            cy, cx, c_idx, c_val = queue.pop(0)
-            
-            # Check 4 adjacent directions
-            for dy, dx in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                ny, nx = cy + dy, cx + dx
-                n_idx = ny * n_width + nx
-                
-                # Check if this adjacent point is in the topk list
-                for j, (ty, tx, t_idx) in enumerate(topk_coords):
-                    if ty == ny and tx == nx and t_idx not in visited:
-                        visited.add(t_idx)
-                        region.append((ny, nx, t_idx, topk_values[j].item()))
-                        queue.append((ny, nx, t_idx, topk_values[j].item()))
-        
-        regions.append(region)
-    
+    mask = scores > scores.max() * activation_threshold
+    scores = scores.to(dtype)
+
+    # Divide into connected regions, numbered in the order of their first patch
+    labels = label_connected_regions(mask)
+    patch_indices = torch.nonzero(mask.view(-1)).squeeze(-1)
+    region_ids, patch_region = torch.unique(labels.view(-1)[patch_indices], return_inverse=True)
+    n_regions = region_ids.shape[0]
+
+    patch_scores = scores.view(-1)[patch_indices]
+    ys = torch.div(patch_indices, n_width, rounding_mode="floor")
+    xs = patch_indices % n_width
+    # Normalized coordinates of the center point for each patch
+    center_x = (xs.to(dtype) + 0.5) / n_width
+    center_y = (ys.to(dtype) + 0.5) / n_height
+
     # Calculate the average activation value for each region
-    region_scores = []
-    region_centers = []
-    region_points = []
-    
-    for region in regions:
-        # Calculate average score for the region
-        avg_score = sum(item[3] for item in region) / len(region)
-        region_scores.append(avg_score)
-
-        # Calculate normalized center coordinates for each patch, then take the average
-        normalized_centers = []
-        weights = []
-        y_coords = set()
-        x_coords = set()
-
-        for y, x, _, score in region:
-            # Normalized coordinates of the center point for each patch
-            center_y = (y + 0.5) / n_height
-            center_x = (x + 0.5) / n_width
-            normalized_centers.append((center_x, center_y))
-            weights.append(score)
-
-            y_coords.add(center_y)
-            x_coords.add(center_x)
-
-        region_points.append(normalized_centers)
-
-        # Calculate the average of normalized coordinates as the region center
-        if not rect_center:
-            # Weighted average
-            total_weight = sum(weights)
-            weighted_x = sum(nc[0] * w for nc, w in zip(normalized_centers, weights)) / total_weight
-            weighted_y = sum(nc[1] * w for nc, w in zip(normalized_centers, weights)) / total_weight
-            avg_center_x, avg_center_y = weighted_x, weighted_y
-            # # Simple average
-            # avg_center_x = sum(nc[0] for nc in normalized_centers) / len(normalized_centers)
-            # avg_center_y = sum(nc[1] for nc in normalized_centers) / len(normalized_centers)
-        else:
-            avg_center_x = sum(x_coords) / len(x_coords)
-            avg_center_y = sum(y_coords) / len(y_coords)
-        region_centers.append((avg_center_x, avg_center_y))
-        
-    # Select the region with the highest average activation value
-    sorted_indices = sorted(range(len(region_scores)), key=lambda i: region_scores[i], reverse=True)
-    sorted_scores = [region_scores[i] for i in sorted_indices]
-    sorted_centers = [region_centers[i] for i in sorted_indices]
-    sorted_points = [region_points[i] for i in sorted_indices]
+    zeros = torch.zeros(n_regions, dtype=dtype, device=device)
+    region_sums = zeros.index_add(0, patch_region, patch_scores)
+    region_sizes = torch.bincount(patch_region, minlength=n_regions)
+    region_scores = region_sums / region_sizes
+
+    # Calculate the region centers
+    if not rect_center:
+        # Weighted average
+        region_x = zeros.index_add(0, patch_region, center_x * patch_scores) / region_sums
+        region_y = zeros.index_add(0, patch_region, center_y * patch_scores) / region_sums
+    else:
+        # Average of the distinct column / row centers covered by the region
+        covered_x = torch.zeros(n_regions, n_width, dtype=dtype, device=device)
+        covered_x[patch_region, xs] = 1
+        covered_y = torch.zeros(n_regions, n_height, dtype=dtype, device=device)
+        covered_y[patch_region, ys] = 1
+        grid_x = (torch.arange(n_width, dtype=dtype, device=device) + 0.5) / n_width
+        grid_y = (torch.arange(n_height, dtype=dtype, device=device) + 0.5) / n_height
+        region_x = (covered_x @ grid_x) / covered_x.sum(dim=-1)
+        region_y = (covered_y @ grid_y) / covered_y.sum(dim=-1)
+
+    # Sort the regions by average activation value (stable, like sorted()), and the patches by region
+    order = torch.sort(region_scores, descending=True, stable=True).indices
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(n_regions, device=device)
+    patch_order = torch.sort(rank[patch_region], stable=True).indices
+
+    # Copy everything to the host in one go
+    host = torch.cat([
+        region_scores[order], region_x[order], region_y[order], region_sizes[order].to(dtype),
+        center_x[patch_order], center_y[patch_order],
+    ]).cpu().tolist()
+    n_points = patch_indices.shape[0]
+    sorted_scores = host[:n_regions]
+    sorted_centers = list(zip(host[n_regions:2 * n_regions], host[2 * n_regions:3 * n_regions]))
+    sizes = [int(size) for size in host[3 * n_regions:4 * n_regions]]
+    points = list(zip(host[4 * n_regions:4 * n_regions + n_points], host[4 * n_regions + n_points:]))
+    sorted_points = []
+    offset = 0
+    for size in sizes:
+        sorted_points.append(points[offset:offset + size])
+        offset += size
     best_point = sorted_centers[0]
 
     if return_all_regions:
@@ -177,45 +188,20 @@ def get_prediction_region_point(attn_scores, n_width, n_height, top_n=30, activa
         return best_point
 
 
-def inference(conversation, model, tokenizer, data_processor, logits_processor=None, use_placeholder=False, topk=5):
-    """
-    conversation = [
-        {
-            "role": "system",
-            "content": [
-                {
-                    "type": "text",
-                    "text": grounding_system_message,
-                }
-            ]
-        },
-        {
-            "role": "user",
-            "content": [
-                {
-                    "type": "image",
-                    "image": example["image"], # PIL.Image.Image or str to path
-                    # "image_url": "https://xxxxx.png" or "https://xxxxx.jpg" or "file://xxxxx.png" or "data:image/png;base64,xxxxxxxx", will be split by "base64,"
-                },
-                {
-                    "type": "text",
-                    "text": example["instruction"]
-                },
-            ],
-        },
-    ]
-    """
-    if logits_processor is None:
-        logits_processor = ForceFollowTokensLogitsProcessor(
-            token_a_id=tokenizer.encode(DEFAULT_POINTER_PAD_TOKEN)[0],
-            forced_sequence=[
-                tokenizer.encode(DEFAULT_POINTER_END_TOKEN)[0]
-            ]
-        )
-    
-    assiatant_starter = "" if not use_placeholder else "<|im_start|>assistant<|recipient|>os\npyautogui.click(<|pointer_start|><|pointer_pad|><|pointer_end|>)"
+POINTER_ASSISTANT_STARTER = "<|im_start|>assistant<|recipient|>os\npyautogui.click(<|pointer_start|><|pointer_pad|><|pointer_end|>)"
+
+
+def _default_logits_processor(tokenizer):
+    return ForceFollowTokensLogitsProcessor(
+        token_a_id=tokenizer.encode(DEFAULT_POINTER_PAD_TOKEN)[0],
+        forced_sequence=[
+            tokenizer.encode(DEFAULT_POINTER_END_TOKEN)[0]
+        ]
+    )
 
-    pred = {
+
+def _empty_pred():
+    return {
         "output_text": None, # generated text
         "n_width": None, # number of patch_tokens in width dimension
         "n_height": None, # number of patch_tokens in height dimension
@@ -225,25 +211,19 @@ def inference(conversation, model, tokenizer, data_processor, logits_processor=N
         "topk_points_all": None, # all points
     }
 
-    # prepare text
+
+def _prepare_text(conversation, data_processor, use_placeholder):
     text = data_processor.apply_chat_template(conversation,
                                             tokenize=False,
                                             add_generation_prompt=False,
                                             chat_template=chat_template
                                             )
-    text += assiatant_starter
+    if use_placeholder:
+        text += POINTER_ASSISTANT_STARTER
+    return text
 
-    # prepare inputs
-    image_inputs, video_inputs = process_vision_info(conversation)
-    inputs = data_processor(text=[text],
-                            images=image_inputs,
-                            videos=video_inputs,
-                            padding=True,
-                            return_tensors="pt"
-                            )
-    inputs = inputs.to(model.device)
 
-    # generate
+def _generate(model, inputs, logits_processor, use_placeholder):
     try:
         # Clear MPS cache before generation if using MPS
         if str(model.device).startswith('mps'):
@@ -274,6 +254,82 @@ def inference(conversation, model, tokenizer, data_processor, logits_processor=N
         raise RuntimeError("Model generation failed - no sequences returned")
     if not hasattr(results, 'hidden_states') or results.hidden_states is None or len(results.hidden_states) == 0:
         raise RuntimeError("Model generation failed - no hidden states returned")
+    return results
+
+
+def _predict_points(pred, model, image_embeds, decoder_hidden_states, image_grid_thw, topk):
+    """
+    Run the pointer head for one sample and fill the attention scores and topk points into pred.
+    image_embeds: n_image_tokens, hidden_size
+    decoder_hidden_states: n_pointer_pad_tokens, hidden_size
+    image_grid_thw: (3,), grid of the image
+    """
+    attn_scores, _ = model.multi_patch_pointer_head(image_embeds, decoder_hidden_states)
+    pred["attn_scores"] = attn_scores.tolist()
+
+    _, n_height, n_width = (image_grid_thw // model.visual.spatial_merge_size).tolist()
+    pred["n_width"] = n_width
+    pred["n_height"] = n_height
+
+    # get the topk points according to the attention scores
+    best_point, region_points, region_scores, region_points_all = get_prediction_region_point(attn_scores, n_width, n_height, return_all_regions=True, rect_center=False)
+    topk_points = region_points[:topk] if len(region_points) > topk else region_points
+    topk_values = region_scores[:topk] if len(region_scores) > topk else region_scores
+    topk_points_all = region_points_all[:topk] if len(region_points_all) > topk else region_points_all
+    pred["topk_points"] = topk_points
+    pred["topk_values"] = topk_values
+    pred["topk_points_all"] = topk_points_all
+    return pred
+
+
+def inference(conversation, model, tokenizer, data_processor, logits_processor=None, use_placeholder=False, topk=5):
+    """
+    conversation = [
+        {
+            "role": "system",
+            "content": [
+                {
+                    "type": "text",
+                    "text": grounding_system_message,
+                }
+            ]
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image",
+                    "image": example["image"], # PIL.Image.Image or str to path
+                    # "image_url": "https://xxxxx.png" or "https://xxxxx.jpg" or "file://xxxxx.png" or "data:image/png;base64,xxxxxxxx", will be split by "base64,"
+                },
+                {
+                    "type": "text",
+                    "text": example["instruction"]
+                },
+            ],
+        },
+    ]
+    """
+    if logits_processor is None:
+        logits_processor = _default_logits_processor(tokenizer)
+
+    pred = _empty_pred()
+
+    # prepare text
+    text = _prepare_text(conversation, data_processor, use_placeholder)
+
+    # prepare inputs
+    image_inputs, video_inputs = process_vision_info(conversation)
+    inputs = data_processor(text=[text],
+                            images=image_inputs,
+                            videos=video_inputs,
+                            padding=True,
+                            return_tensors="pt"
+                            )
+    inputs = inputs.to(model.device)
+
+    # generate
+    results = _generate(model, inputs, logits_processor, use_placeholder)
 
     # decode the generated ids
     input_ids = inputs["input_ids"][0]
@@ -312,20 +368,138 @@ def inference(conversation, model, tokenizer, data_processor, logits_processor=N
     image_mask = (inputs["input_ids"][0] == tokenizer.encode("<|image_pad|>")[0])
     image_embeds = results.hidden_states[0][0][0][image_mask] # n_image_tokens, hidden_size
 
-    attn_scores, _ = model.multi_patch_pointer_head(image_embeds, decoder_hidden_states)
-    pred["attn_scores"] = attn_scores.tolist()
+    return _predict_points(pred, model, image_embeds, decoder_hidden_states, inputs["image_grid_thw"][0], topk)
 
-    _, n_height, n_width = (inputs["image_grid_thw"][0] // model.visual.spatial_merge_size).tolist()
-    pred["n_width"] = n_width
-    pred["n_height"] = n_height
 
-    # get the topk points according to the attention scores
-    best_point, region_points, region_scores, region_points_all = get_prediction_region_point(attn_scores, n_width, n_height, return_all_regions=True, rect_center=False)
-    topk_points = region_points[:topk] if len(region_points) > topk else region_points
-    topk_values = region_scores[:topk] if len(region_scores) > topk else region_scores
-    topk_points_all = region_points_all[:topk] if len(region_points_all) > topk else region_points_all
-    pred["topk_points"] = topk_points
-    pred["topk_values"] = topk_values
-    pred["topk_points_all"] = topk_points_all
+def _processor_inputs(text, conversation, data_processor, image_inputs=None):
+    """
+    data_processor inputs of one prompt. `image_inputs` are the already processed images of the conversation
+    (the output of `data_processor.image_processor`); if given, the images are not fetched and processed again
+    and only the <|image_pad|> tokens are expanded the way the processor does it.
+    """
+    if image_inputs is None:
+        images, videos = process_vision_info(conversation)
+        return data_processor(text=[text], images=images, videos=videos, padding=True, return_tensors="pt")
+
+    merge_length = data_processor.image_processor.merge_size ** 2
+    for grid_thw in image_inputs["image_grid_thw"]:
+        text = text.replace("<|image_pad|>", "<|placeholder|>" * int(grid_thw.prod() // merge_length), 1)
+    text = text.replace("<|placeholder|>", "<|image_pad|>")
+    text_inputs = data_processor.tokenizer([text], padding=True, return_tensors="pt")
+    return BatchFeature(data={**text_inputs, **image_inputs})
+
+
+def ground(conversation, model, tokenizer, data_processor, topk=5, prefix_cache=None, image_inputs=None):
+    """
+    Placeholder grounding (same result as `inference(..., use_placeholder=True)`) with a single forward pass.
+    Instead of `generate` with `output_hidden_states=True`, which keeps the hidden states of every layer for the
+    whole prompt, forward hooks on the decoder capture only the input embeddings at the <|image_pad|> positions
+    and the last-layer states at the <|pointer_pad|> positions. The LM head only runs on the last position,
+    which gives the (greedy) `output_text`.
+    If a `PrefixKVCache` is given and the prompt starts with one of its prefixes (e.g. the system turn), the
+    forward starts from the cached keys/values and only runs the rest of the prompt.
+    The conversation has the same format as in `inference`. `image_inputs` can hold its already processed image
+    (`pixel_values` and `image_grid_thw` from `data_processor.image_processor`), which is then used as is.
+    """
+    pred = _empty_pred()
+
+    # prepare text and inputs
+    text = _prepare_text(conversation, data_processor, use_placeholder=True)
+    inputs = _processor_inputs(text, conversation, data_processor, image_inputs)
+    inputs = inputs.to(model.device)
+
+    prefix_length, forward_inputs = (0, dict(inputs)) if prefix_cache is None else prefix_cache.prepare_inputs(model, inputs)
+    image_mask = (inputs["input_ids"][0, prefix_length:] == tokenizer.encode("<|image_pad|>")[0])
+    pointer_pad_mask = (inputs["input_ids"][0, prefix_length:] == model.config.pointer_pad_token_id)
+
+    captured = {}
+    def capture_image_embeds(module, args, kwargs):
+        captured["image_embeds"] = kwargs["inputs_embeds"][0][image_mask] # n_image_tokens, hidden_size
+    def capture_pointer_hidden_states(module, args, output):
+        captured["decoder_hidden_states"] = output[0][0][pointer_pad_mask] # n_pointer_pad_tokens, hidden_size
+
+    hooks = [
+        model.model.register_forward_pre_hook(capture_image_embeds, with_kwargs=True),
+        model.model.register_forward_hook(capture_pointer_hidden_states),
+    ]
+    try:
+        with torch.no_grad():
+            outputs = model(**forward_inputs, use_cache=False, logits_to_keep=1, return_dict=True)
+    finally:
+        for hook in hooks:
+            hook.remove()
+
+    pred["output_text"] = tokenizer.decode(outputs.logits[0, -1].argmax(dim=-1), skip_special_tokens=False, clean_up_tokenization_spaces=False)
+
+    return _predict_points(pred, model, captured["image_embeds"], captured["decoder_hidden_states"], inputs["image_grid_thw"][0], topk)
+
+
+def inference_batch(conversations, model, tokenizer, data_processor, logits_processor=None, use_placeholder=False, topk=5):
+    """
+    Batched version of `inference`: run several conversations (one image each) through a single `generate` call.
+    The conversations are left-padded together, every row keeps its own forced-token state in the logits processor,
+    and the pointer head runs on the hidden states and image embeddings sliced out for each row.
+
+    Returns a list with one `pred` dict (same format as `inference`) per conversation.
+    """
+    if logits_processor is None:
+        logits_processor = _default_logits_processor(tokenizer)
+
+    # prepare text
+    texts = [_prepare_text(conversation, data_processor, use_placeholder) for conversation in conversations]
+
+    # prepare inputs, left padded so that all rows continue generating from the same position
+    image_inputs, video_inputs = process_vision_info(conversations)
+    padding_side = data_processor.tokenizer.padding_side
+    data_processor.tokenizer.padding_side = "left"
+    try:
+        inputs = data_processor(text=texts,
+                                images=image_inputs,
+                                videos=video_inputs,
+                                padding=True,
+                                return_tensors="pt"
+                                )
+    finally:
+        data_processor.tokenizer.padding_side = padding_side
+    inputs = inputs.to(model.device)
+
+    # generate
+    results = _generate(model, inputs, logits_processor, use_placeholder)
+    if not use_placeholder and len(results.hidden_states) <= 1:
+        raise RuntimeError(f"Hidden states has insufficient length: {len(results.hidden_states)}")
+
+    input_length = inputs["input_ids"].shape[1]
+    pad_token_id = model.generation_config.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.pad_token_id
+    image_pad_token_id = tokenizer.encode("<|image_pad|>")[0]
+
+    preds = []
+    for i in range(len(conversations)):
+        pred = _empty_pred()
+
+        # decode the generated ids, dropping the padding of rows that finished early
+        generated_ids = results.sequences[i][input_length:]
+        pred["output_text"] = tokenizer.decode(generated_ids[generated_ids != pad_token_id], skip_special_tokens=False, clean_up_tokenization_spaces=False)
+
+        if use_placeholder:
+            pointer_pad_mask = (inputs["input_ids"][i] == model.config.pointer_pad_token_id) # n_all_input_tokens
+            decoder_hidden_states = results.hidden_states[0][-1][i] # n_all_input_tokens, hidden_size
+        else:
+            pointer_pad_mask = (generated_ids[:-1] == model.config.pointer_pad_token_id) # seq_len_generated_ids-1
+            decoder_hidden_states = [step_hidden_states[-1][i] for step_hidden_states in results.hidden_states[1:]]
+            decoder_hidden_states = torch.cat(decoder_hidden_states, dim=0) # seq_len_generated_ids-1, hidden_size
+
+        # rows that produced no <POINTER_TOKEN> only get the generated text
+        if not pointer_pad_mask.any():
+            preds.append(pred)
+            continue
+        decoder_hidden_states = decoder_hidden_states[pointer_pad_mask] # n_pointer_pad_tokens, hidden_size
+
+        # get the image embeddings of this row as encoder vectors
+        image_mask = (inputs["input_ids"][i] == image_pad_token_id)
+        image_embeds = results.hidden_states[0][0][i][image_mask] # n_image_tokens, hidden_size
+
+        preds.append(_predict_points(pred, model, image_embeds, decoder_hidden_states, inputs["image_grid_thw"][i], topk))
 
-    return pred
\ No newline at end of file
+    return preds
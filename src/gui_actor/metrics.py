@@ -0,0 +1,60 @@
+"""
+Columnar aggregation of per-sample evaluation results.
+
+`ResultTable` turns a list of result dicts into integer-coded categorical columns and float value columns once; any
+breakdown (by group, by group x UI type, ...) is then a single `np.bincount` into a dense cube over the selected
+columns, instead of re-filtering the result list for every combination of attribute values.
+"""
+import numpy as np
+
+
+class ResultTable:
+    """
+    Struct-of-arrays view of a list of result dicts.
+
+    categorical: keys whose values are categories (missing keys count as the category None); every column is stored
+        as int codes into `categories[key]`, in order of first appearance.
+    values: keys whose values are numbers (missing keys count as 0), summed by `sums`.
+    """
+    def __init__(self, results, categorical=(), values=()):
+        self.n = len(results)
+        self.categories = {}
+        self.codes = {}
+        for key in categorical:
+            lookup = {}
+            codes = np.fromiter(
+                (lookup.setdefault(result.get(key), len(lookup)) for result in results), dtype=np.int64, count=self.n
+            )
+            self.categories[key] = list(lookup)
+            self.codes[key] = codes
+        self.values = {
+            key: np.fromiter((result.get(key, 0) for result in results), dtype=np.float64, count=self.n)
+            for key in values
+        }
+
+    def add_indicator(self, key, column, category):
+        """Add a value column `key` that is 1 where categorical `column` equals `category`."""
+        categories = self.categories[column]
+        code = categories.index(category) if category in categories else -1
+        self.values[key] = (self.codes[column] == code).astype(np.float64)
+
+    def index(self, column, category):
+        """Position of `category` along the axis of `column` in a cube, or None if it never occurs."""
+        categories = self.categories[column]
+        return categories.index(category) if category in categories else None
+
+    def sums(self, by, values=()):
+        """
+        Dense cubes of shape (len(categories[by[0]]), len(categories[by[1]]), ...): the number of samples ("count")
+        and the sum of every value column in `values` for each combination of categories.
+        """
+        shape = tuple(len(self.categories[key]) for key in by)
+        if by:
+            flat = np.ravel_multi_index(tuple(self.codes[key] for key in by), shape)
+        else:
+            flat = np.zeros(self.n, dtype=np.int64)
+        size = int(np.prod(shape))
+        cubes = {"count": np.bincount(flat, minlength=size).reshape(shape)}
+        for key in values:
+            cubes[key] = np.bincount(flat, weights=self.values[key], minlength=size).reshape(shape)
+        return cubes
@@ -1,11 +1,14 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 from transformers.models.qwen2_vl.modeling_qwen2_vl import Qwen2VLCausalLMOutputWithPast, Qwen2VLForConditionalGeneration
 from gui_actor.constants import IGNORE_INDEX
 from typing import List, Tuple, Union, Optional
 from gui_actor.trainer import rank0_print
+from gui_actor.cache import ImageEmbedCache, get_image_embeds
+from gui_actor.packing import packed_causal_mask, packed_position_ids, set_packed_sequences
 
 class QwenVLwithVisionHeadOutputWithPast(Qwen2VLCausalLMOutputWithPast):
     """
@@ -17,11 +20,13 @@ class QwenVLwithVisionHeadOutputWithPast(Qwen2VLCausalLMOutputWithPast):
         pointer_loss (`torch.FloatTensor` of shape `(1,)`, *optional*):
             Vision pointer network loss.
         pointer_scores (`List[torch.FloatTensor]`, *optional*):
-            Attention scores from the pointer network, one tensor per batch item.
+            Attention scores from the pointer network, one (CPU) tensor per batch item. Only returned with
+            `return_pointer_scores=True`.
         loss (`torch.FloatTensor` of shape `(1,)`, *optional*):
             Combined loss (weighted sum of lm_loss and pointer_loss).
-        logits (`torch.FloatTensor` of shape `(batch_size, sequence_length, config.vocab_size)`):
-            Prediction scores from the language modeling head.
+        logits (`torch.FloatTensor` of shape `(batch_size, sequence_length, config.vocab_size)`, *optional*):
+            Prediction scores from the language modeling head. Not computed (`None`) when `labels` are passed in
+            training mode.
         past_key_values, hidden_states, attentions, rope_deltas:
             Same as parent class.
     """
@@ -62,34 +67,62 @@ class VisionHead_MultiPatch(nn.Module):
         self.layer_norm = nn.LayerNorm(d_model)
         self.dropout = nn.Dropout(dropout_rate)
 
+    def _self_attention(self, enc_input, enc_mask=None):
+        """
+        Same computation as `self.self_attention(enc_input, enc_input, enc_input, need_weights=False)`, with its
+        weights, but through `F.scaled_dot_product_attention` so that the (n_enc x n_enc) attention matrix is never
+        materialized when a memory-efficient or flash kernel is available.
+        enc_input: (B, n_enc, d_model); enc_mask: (B, n_enc) bool, False at padded visual tokens
+        """
+        mha = self.self_attention
+        batch_size, n_enc, _ = enc_input.shape
+        head_dim = self.d_model // mha.num_heads
+        q, k, v = F.linear(enc_input, mha.in_proj_weight, mha.in_proj_bias).chunk(3, dim=-1)
+        q, k, v = (x.view(batch_size, n_enc, mha.num_heads, head_dim).transpose(1, 2) for x in (q, k, v))
+        attn_mask = None if enc_mask is None else enc_mask[:, None, None, :] # (B, 1, 1, n_enc)
+        attn_output = F.scaled_dot_product_attention(
+            q, k, v,
+            attn_mask=attn_mask,
+            dropout_p=mha.dropout if self.training else 0.0,
+        )
+        attn_output = attn_output.transpose(1, 2).reshape(batch_size, n_enc, self.d_model)
+        return mha.out_proj(attn_output)
+
     def forward(self,
-                hidden_state_enc,  # shape: [n_enc, d_model] where n_enc can vary with image size
-                hidden_state_dec,  # shape: [n_dec, d_model] there can be multiple query in one sample
-                labels: Optional[torch.Tensor] = None,  # shape: [n_dec, n_enc], binary mask of patches in bbox
+                hidden_state_enc,  # shape: [n_enc, d_model] or padded [B, n_enc, d_model], n_enc can vary with image size
+                hidden_state_dec,  # shape: [n_dec, d_model] or padded [B, n_dec, d_model], there can be multiple query in one sample
+                labels: Optional[torch.Tensor] = None,  # shape: [n_dec, n_enc] or [B, n_dec, n_enc], binary mask of patches in bbox, dense or sparse COO
                 do_single_patch: bool = False,
+                enc_mask: Optional[torch.Tensor] = None,  # shape: [B, n_enc], True at real (non-padded) visual tokens
+                dec_mask: Optional[torch.Tensor] = None,  # shape: [B, n_dec], True at real (non-padded) queries
                ):
-        
-        enc_input = hidden_state_enc.unsqueeze(0)
-        attn_output, _ = self.self_attention(
-            query=enc_input,
-            key=enc_input,
-            value=enc_input,
-            # attn_mask=attention_mask,
-            need_weights=False
-        )
+        """
+        For a single sample (2D inputs) returns attn_weights [n_dec, n_enc] and the KL loss (a scalar).
+        For a padded batch (3D inputs) returns attn_weights [B, n_dec, n_enc], which are 0 at padded patches,
+        and the KL loss of each sample [B] (0 for samples without any real query).
+        """
+        unbatched = hidden_state_enc.dim() == 2
+        if unbatched:
+            hidden_state_enc = hidden_state_enc.unsqueeze(0)
+            hidden_state_dec = hidden_state_dec.unsqueeze(0)
+            if labels is not None and not do_single_patch:
+                labels = labels.unsqueeze(0)
+
+        attn_output = self._self_attention(hidden_state_enc, enc_mask)
         # Residual connection and layer normalization
-        hidden_state_enc_ctx = self.layer_norm(enc_input + self.dropout(attn_output))
-        # Remove batch dimension
-        hidden_state_enc_ctx = hidden_state_enc_ctx.squeeze(0)  # [n_enc, d_model]
+        hidden_state_enc_ctx = self.layer_norm(hidden_state_enc + self.dropout(attn_output))  # [B, n_enc, d_model]
 
         # Apply the projection networks.
-        proj_enc = self.projection_enc(hidden_state_enc_ctx)  # [n_enc, d_model]
-        proj_dec = self.projection_dec(hidden_state_dec)  # [n_dec, d_model]
+        proj_enc = self.projection_enc(hidden_state_enc_ctx)  # [B, n_enc, d_model]
+        proj_dec = self.projection_dec(hidden_state_dec)  # [B, n_dec, d_model]
         
         # Compute scaled dot-product attention scores.
         # Scaling by sqrt(d_model) is critical regardless of variable n_enc.
         scaling = self.d_model ** 0.5
-        patch_logits = torch.matmul(proj_dec, proj_enc.transpose(0, 1)) / scaling  # [n_dec, n_enc]
+        patch_logits = torch.matmul(proj_dec, proj_enc.transpose(-1, -2)) / scaling  # [B, n_dec, n_enc]
+        if enc_mask is not None:
+            # a finite fill value keeps the KL terms of padded patches at 0 instead of 0 * -inf
+            patch_logits = patch_logits.masked_fill(~enc_mask[:, None, :], torch.finfo(patch_logits.dtype).min)
         
         # Softmax normalization is applied along the encoder dimension.
         attn_weights = F.softmax(patch_logits, dim=-1)
@@ -97,20 +130,73 @@ class VisionHead_MultiPatch(nn.Module):
         loss = None
         if (labels is not None) and (not do_single_patch):
             epsilon = 1e-8
-            labels_float = labels.float()
-            # Normalize each row to get target probability distribution
-            target_dist = labels_float / (labels_float.sum(dim=-1, keepdim=True) + epsilon)
-
             # Apply log_softmax to logits
-            pred_log_probs = F.log_softmax(patch_logits, dim=-1)
-            # Use KL divergence as loss
-            loss = F.kl_div(pred_log_probs, target_dist, reduction='batchmean')
+            pred_log_probs = F.log_softmax(patch_logits.float(), dim=-1)
+            # Use KL divergence as loss, averaged over the queries of each sample ('batchmean' per sample)
+            if labels.is_sparse:
+                # Same KL, from the labeled patches only: the dense [B, n_dec, n_enc] target is never built
+                labels = labels.coalesce()
+                (batch_index, dec_index, enc_index), label_values = labels.indices(), labels.values().float()
+                n_rows = pred_log_probs.shape[0] * pred_log_probs.shape[1]
+                row = batch_index * pred_log_probs.shape[1] + dec_index
+                row_sums = label_values.new_zeros(n_rows).index_add_(0, row, label_values)
+                target_values = label_values / (row_sums[row] + epsilon)
+                kl_terms = torch.xlogy(target_values, target_values) - target_values * pred_log_probs[batch_index, dec_index, enc_index]
+                kl = kl_terms.new_zeros(n_rows).index_add_(0, row, kl_terms).view(pred_log_probs.shape[:2])  # [B, n_dec]
+            else:
+                labels_float = labels.float()
+                # Normalize each row to get target probability distribution
+                target_dist = labels_float / (labels_float.sum(dim=-1, keepdim=True) + epsilon)
+                kl = F.kl_div(pred_log_probs, target_dist, reduction='none').sum(dim=-1)  # [B, n_dec]
+            if dec_mask is None:
+                loss = kl.mean(dim=-1)
+            else:
+                kl = kl * dec_mask
+                loss = kl.sum(dim=-1) / dec_mask.sum(dim=-1).clamp(min=1)
+
+        if unbatched:
+            attn_weights = attn_weights.squeeze(0)
+            patch_logits = patch_logits.squeeze(0)
+            if loss is not None:
+                loss = loss.squeeze(0)
 
         if do_single_patch and (labels is not None):
-            loss = F.cross_entropy(attn_scores, labels)
+            loss = F.cross_entropy(patch_logits, labels)
 
         return attn_weights, loss
 
+def _lm_head_cross_entropy_sum(lm_head, hidden_states, labels):
+    # float32 logits of one chunk only; summed so that chunks can be added up
+    return F.cross_entropy(lm_head(hidden_states).float(), labels, reduction='sum')
+
+
+def chunked_lm_loss(lm_head, hidden_states, labels, chunk_size=1024):
+    """
+    Next-token cross-entropy (mean over the supervised tokens) without the (batch_size, seq_len, vocab_size) logits.
+    Only the positions whose shifted label is not IGNORE_INDEX go through `lm_head`, `chunk_size` tokens at a time.
+    With autograd enabled every chunk is checkpointed and its logits are recomputed in the backward pass, so at most
+    one chunk of float32 logits is alive at any time.
+    hidden_states: (batch_size, seq_len, d_model); labels: (batch_size, seq_len)
+    """
+    # Shift so that tokens < n predict n
+    shift_labels = labels[..., 1:].to(hidden_states.device)
+    supervised_mask = shift_labels != IGNORE_INDEX
+    supervised_hidden = hidden_states[..., :-1, :][supervised_mask] # (n_supervised, d_model)
+    supervised_labels = shift_labels[supervised_mask] # (n_supervised,)
+    n_supervised = supervised_labels.shape[0]
+    if n_supervised == 0:
+        return hidden_states.sum() * 0.0
+
+    loss = 0.0
+    for start in range(0, n_supervised, chunk_size):
+        chunk_hidden = supervised_hidden[start:start + chunk_size]
+        chunk_labels = supervised_labels[start:start + chunk_size]
+        if torch.is_grad_enabled() and chunk_hidden.requires_grad:
+            loss = loss + checkpoint(_lm_head_cross_entropy_sum, lm_head, chunk_hidden, chunk_labels, use_reentrant=False)
+        else:
+            loss = loss + _lm_head_cross_entropy_sum(lm_head, chunk_hidden, chunk_labels)
+    return loss / n_supervised
+
 
 class Qwen2VLForConditionalGenerationWithPointer(Qwen2VLForConditionalGeneration):
     def __init__(self, *args, **kwargs):
@@ -118,11 +204,17 @@ class Qwen2VLForConditionalGenerationWithPointer(Qwen2VLForConditionalGeneration
         self.multi_patch_pointer_head = VisionHead_MultiPatch(self.config.hidden_size, self.config.hidden_size)
         self.pointer_loss_weight = kwargs.get("pointer_loss_weight", 1.0)
         self.lm_loss_weight = kwargs.get("lm_loss_weight", 1.0)
+        self.image_embed_cache = None
         self.post_init()
     
     def reset_loss_weights(self, pointer_loss_weight, lm_loss_weight):
         self.pointer_loss_weight = pointer_loss_weight
         self.lm_loss_weight = lm_loss_weight
+
+    def enable_image_embed_cache(self, max_bytes=1024 ** 3):
+        """Cache the vision tower outputs of repeated images (eval mode only), see `ImageEmbedCache`."""
+        self.image_embed_cache = ImageEmbedCache(max_bytes=max_bytes)
+        return self.image_embed_cache
    
     def forward(self,
                 input_ids: torch.LongTensor = None, # (batch_size, seq_len)
@@ -143,10 +235,14 @@ class Qwen2VLForConditionalGenerationWithPointer(Qwen2VLForConditionalGeneration
                 cache_position: Optional[torch.LongTensor] = None,
                 # Grounding
                 visual_token_indices_of_coordinates: Optional[torch.Tensor] = None, # shape: (batch_size, n_target); each element is the ground-truth index of the visual token that should be attended to for the corresponding target token
-                multi_patch_labels: Optional[torch.Tensor] = None, # shape: list [(n_target, n_visual), ...]; binary mask of patches in bbox
+                multi_patch_labels: Optional[torch.Tensor] = None, # shape: list [(n_target, n_visual), ...]; binary mask of patches in bbox, dense or sparse COO
                 if_multi_patch: bool = True,
                 coordinates: Optional[List[Tuple[float, float]]] = None,
-                verbose: bool = False) -> Union[Tuple, QwenVLwithVisionHeadOutputWithPast]:
+                verbose: bool = False,
+                logits_to_keep: Union[int, torch.Tensor] = 0, # if int, only the logits of the last `logits_to_keep` positions are computed (0 keeps all); if a tensor, the sequence indices to keep
+                return_pointer_scores: bool = False, # copy the per-sample pointer scores to the host and return them
+                cu_seqlens: Optional[torch.LongTensor] = None, # (n_samples + 1,) boundaries of the samples packed into a single row, see gui_actor.packing
+               ) -> Union[Tuple, QwenVLwithVisionHeadOutputWithPast]:
 
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -167,7 +263,7 @@ class Qwen2VLForConditionalGenerationWithPointer(Qwen2VLForConditionalGeneration
             inputs_embeds = self.model.embed_tokens(input_ids) # shape: (batch_size, seq_len, d_model)
             if pixel_values is not None:
                 pixel_values = pixel_values.type(self.visual.dtype)
-                image_embeds = self.visual(pixel_values, grid_thw=image_grid_thw)
+                image_embeds = get_image_embeds(self, pixel_values, image_grid_thw)
                 n_image_tokens = (input_ids == self.config.image_token_id).sum().item()
                 n_image_features = image_embeds.shape[0]
                 if n_image_tokens != n_image_features:
@@ -204,6 +300,17 @@ class Qwen2VLForConditionalGenerationWithPointer(Qwen2VLForConditionalGeneration
             if attention_mask is not None:
                 attention_mask = attention_mask.to(inputs_embeds.device)
 
+        # Packed samples: positions restart at every sample and attention never crosses a sample boundary
+        # (varlen flash attention, or a block-diagonal mask for the other attention implementations)
+        set_packed_sequences(cu_seqlens if self.config._attn_implementation == "flash_attention_2" else None)
+        if cu_seqlens is not None:
+            if position_ids is None:
+                position_ids = packed_position_ids(self, input_ids, image_grid_thw, cu_seqlens)
+            if self.config._attn_implementation == "flash_attention_2":
+                attention_mask = None
+            else:
+                attention_mask = packed_causal_mask(cu_seqlens, inputs_embeds.dtype, inputs_embeds.device)
+
         # if we get 4D attention mask we cannot calculate rope deltas anymore. TODO @raushan fixme
         if position_ids is None and (attention_mask is None or attention_mask.ndim == 2):
             # calculate RoPE index once per generation in the pre-fill stage only
@@ -242,92 +349,103 @@ class Qwen2VLForConditionalGenerationWithPointer(Qwen2VLForConditionalGeneration
         )
 
         hidden_states = outputs[0] # shape: (batch_size, seq_len, d_model)
-        logits = self.lm_head(hidden_states)
 
         lm_loss = None
+        logits = None
         if labels is not None and self.lm_loss_weight > 0:
-            # Upcast to float if we need to compute the loss to avoid potential precision issues
-            logits = logits.float()
-            # Shift so that tokens < n predict n
-            shift_logits = logits[..., :-1, :].contiguous()
-            shift_labels = labels[..., 1:].contiguous()
-            # Flatten the tokens
-            loss_fct = nn.CrossEntropyLoss()
-            shift_logits = shift_logits.view(-1, self.config.vocab_size)
-            shift_labels = shift_labels.view(-1)
-            # Enable model parallelism
-            shift_labels = shift_labels.to(shift_logits.device)
-            lm_loss = loss_fct(shift_logits, shift_labels)
+            # the LM loss only projects the supervised positions, chunk by chunk
+            lm_loss = chunked_lm_loss(self.lm_head, hidden_states, labels)
+        if labels is None or not self.training:
+            # training never needs the full-sequence logits, so they are only computed in eval mode
+            slice_indices = slice(-logits_to_keep, None) if isinstance(logits_to_keep, int) else logits_to_keep
+            logits = self.lm_head(hidden_states[:, slice_indices, :])
 
 
         # If vision supervision is requested, process the action head.
         pointer_loss = None
-        pointer_scores = []
+        pointer_scores = None
         if visual_token_indices_of_coordinates is not None:
-            batch_size = input_ids.shape[0]
-            pointer_losses = []
-            
-            # Process each sample individually because the number of visual and target tokens may vary.
-            for i in range(batch_size):
-                dummy_target = False
-
-                # Get the token ids and corresponding hidden states for sample i.
-                token_ids = input_ids[i]          # shape: (seq_length,)
-                hs = hidden_states[i]             # shape: (seq_length, d_model)
-
-                # Identify visual tokens indices.
-                visual_mask = (token_ids == self.config.image_token_id)
-                visual_indices = torch.nonzero(visual_mask, as_tuple=False).squeeze(-1) # shape: (n_visual,)
-
-                # Identify target tokens (the ones that should attend to visual features).
-                target_mask = (token_ids == self.config.pointer_pad_token_id)
-                target_indices = torch.nonzero(target_mask, as_tuple=False).squeeze(-1)
-                
-                # If either visual or target tokens are missing, skip this sample.
-                if visual_indices.numel() == 0:
-                    raise ValueError(f"No visual or target tokens found for sample {i}.")
-                if target_indices.numel() == 0:
-                    target_indices = torch.tensor([hs.shape[0] - 1]) # take the last token as the dummy target token
-                    gt = torch.tensor([0]).to(hs.device) # take the first visual token as the dummy ground truth
-                    if if_multi_patch:  # task the first 4 visual tokens as the ground truth
-                        sample_labels = torch.zeros_like(visual_indices).unsqueeze(0)
-                        sample_labels[0][:4] = 1
-                    dummy_target = True
-                else:
-                    # For supervision, we assume that visual_token_indices_of_coordinates[i] is a tensor of shape (n_target,)
-                    # where each element is an integer in the range [0, n_visual-1] indicating the ground-truth visual token.
-                    gt = visual_token_indices_of_coordinates[i].to(hs.device) # shape: (n_target,)
-                    if if_multi_patch:
-                        sample_labels = multi_patch_labels[i]
-                
-                # Gather the corresponding hidden state representations.
-                # visual_hidden = hs[visual_indices]  # shape: (n_visual, d_model)
-                visual_embeds = inputs_embeds[i][visual_indices]
-                target_hidden = hs[target_indices]  # shape: (n_target, d_model)
-
-                # Calculate loss for multi-patch mode
-                if if_multi_patch:
-                    # Ensure the number of targets matches between sample and labels
-                    if sample_labels.shape[0] != target_indices.shape[0]:
-                        raise ValueError(f"Sample {i} has mismatched target counts: {sample_labels.shape[0]} labels but found {target_indices.shape[0]} target tokens")
-
-                    # Process using VisionHead_MultiPatch
-                    attn_scores, loss_v = self.multi_patch_pointer_head(
-                        visual_embeds,
-                        target_hidden,
-                        labels=sample_labels
-                    )
-                    
-                else:
-                    # Deprecated branch - single patch mode is no longer used
-                    # Run the action head to compute the attention (from target tokens to visual tokens) and its loss.
-                    attn_scores, loss_v = self.pointer_head(visual_embeds, target_hidden, labels=gt)
-                
-                pointer_scores.append(attn_scores.detach().cpu())
-
-                pointer_losses.append(loss_v * 0.0 if dummy_target else loss_v)
-            
-            pointer_loss = torch.stack(pointer_losses).mean()
+            if not if_multi_patch:
+                # Deprecated branch - single patch mode is no longer used
+                raise ValueError("Single-patch pointer supervision is deprecated, use if_multi_patch=True.")
+
+            # A sample is a row of the batch, or a packed segment of the single row when cu_seqlens is given.
+            # All samples are handled at once: the visual tokens and target tokens of every sample are gathered
+            # into padded (n_samples, max_n, d_model) tensors and the pointer head runs a single time.
+            batch_size, seq_length = input_ids.shape
+            flat_input_ids = input_ids.reshape(-1)
+            if cu_seqlens is None:
+                sample_starts = torch.arange(batch_size, device=input_ids.device) * seq_length
+            else:
+                sample_starts = cu_seqlens[:-1].to(input_ids.device)
+            n_samples = len(sample_starts)
+            token_positions = torch.arange(flat_input_ids.shape[0], device=input_ids.device)
+            sample_ids = torch.searchsorted(sample_starts, token_positions, right=True) - 1 # shape: (batch_size * seq_length,)
+            sample_last = torch.cat([sample_starts[1:], sample_starts.new_tensor([flat_input_ids.shape[0]])]) - 1
+            visual_mask = (flat_input_ids == self.config.image_token_id)
+            target_mask = (flat_input_ids == self.config.pointer_pad_token_id)
+            counts = torch.zeros(2, n_samples, dtype=torch.long, device=input_ids.device)
+            counts[0].index_add_(0, sample_ids, visual_mask.long())
+            counts[1].index_add_(0, sample_ids, target_mask.long())
+            n_visual, n_target = counts.tolist() # the only host sync
+
+            if 0 in n_visual:
+                raise ValueError(f"No visual or target tokens found for sample {n_visual.index(0)}.")
+            # Samples without target tokens take the last token as the dummy target token and the first
+            # 4 visual tokens as the dummy ground truth; their loss is multiplied by 0.
+            dummy_target = [n == 0 for n in n_target]
+            if any(dummy_target):
+                target_mask = target_mask.clone()
+                target_mask[sample_last[torch.tensor(dummy_target, device=target_mask.device)]] = True
+            n_target = [max(n, 1) for n in n_target]
+
+            max_visual, max_target = max(n_visual), max(n_target)
+            enc_mask = torch.arange(max_visual, device=input_ids.device) < torch.tensor(n_visual, device=input_ids.device).unsqueeze(-1) # (n_samples, max_visual)
+            dec_mask = torch.arange(max_target, device=input_ids.device) < torch.tensor(n_target, device=input_ids.device).unsqueeze(-1) # (n_samples, max_target)
+
+            # Gather the corresponding hidden state representations.
+            visual_embeds = inputs_embeds.new_zeros(n_samples, max_visual, inputs_embeds.shape[-1])
+            visual_embeds[enc_mask] = inputs_embeds.reshape(-1, inputs_embeds.shape[-1])[visual_mask]
+            target_hidden = hidden_states.new_zeros(n_samples, max_target, hidden_states.shape[-1])
+            target_hidden[dec_mask] = hidden_states.reshape(-1, hidden_states.shape[-1])[target_mask]
+
+            # Collect the labeled patches of every sample as (sample, target, patch) indices, dense (n_target, n_visual)
+            # masks and sparse COO labels alike, into sparse (n_samples, max_target, max_visual) labels on the device.
+            # The labels may or may not be on the device already (the Trainer moves them), so every piece is moved there.
+            device = hidden_states.device
+            label_indices, label_values = [], []
+            for i in range(n_samples):
+                if dummy_target[i]:
+                    n_dummy = min(4, n_visual[i])
+                    label_indices.append(torch.tensor([[i] * n_dummy, [0] * n_dummy, list(range(n_dummy))], device=device))
+                    label_values.append(torch.ones(n_dummy, device=device))
+                    continue
+                # Ensure the number of targets matches between sample and labels
+                if multi_patch_labels[i].shape[0] != n_target[i]:
+                    raise ValueError(f"Sample {i} has mismatched target counts: {multi_patch_labels[i].shape[0]} labels but found {n_target[i]} target tokens")
+                sample_labels = multi_patch_labels[i] if multi_patch_labels[i].is_sparse else multi_patch_labels[i].to_sparse()
+                sample_labels = sample_labels.coalesce()
+                indices = sample_labels.indices()
+                label_indices.append(torch.cat([torch.full_like(indices[:1], i), indices]).to(device, non_blocking=True))
+                label_values.append(sample_labels.values().float().to(device, non_blocking=True))
+            label_indices = torch.cat(label_indices, dim=1)
+            label_values = torch.cat(label_values)
+            sample_labels = torch.sparse_coo_tensor(label_indices, label_values, (n_samples, max_target, max_visual))
+
+            # Process using VisionHead_MultiPatch
+            attn_scores, pointer_losses = self.multi_patch_pointer_head(
+                visual_embeds,
+                target_hidden,
+                labels=sample_labels,
+                enc_mask=enc_mask,
+                dec_mask=dec_mask,
+            ) # (n_samples, max_target, max_visual), (n_samples,)
+            keep = torch.tensor([not dummy for dummy in dummy_target], device=pointer_losses.device, dtype=pointer_losses.dtype)
+            pointer_loss = (pointer_losses * keep).mean()
+
+            if return_pointer_scores:
+                attn_scores = attn_scores.detach().cpu()
+                pointer_scores = [attn_scores[i, :n_target[i], :n_visual[i]] for i in range(n_samples)]
 
         # Combine the LM loss and vision loss using the provided loss weights.
         
@@ -0,0 +1,75 @@
+"""
+Sequence packing for training: several samples are concatenated into one row (batch size 1) and described by
+`cu_seqlens`, the cumulative sample lengths `[0, len_0, len_0 + len_1, ...]`.
+
+With flash_attention_2 the decoder attention runs `flash_attn_varlen_func` over the packed samples, so no sample
+attends to another and no padding is computed. Other attention implementations get an equivalent block-diagonal
+causal mask. M-RoPE positions restart at every sample.
+"""
+import torch
+from transformers.models.qwen2_vl import modeling_qwen2_vl
+from transformers.models.qwen2_5_vl import modeling_qwen2_5_vl
+
+# (cu_seqlens, max_seqlen) of the current packed forward, or None. It stays set until the next forward of a pointer
+# model, so that the attention recomputed by gradient checkpointing in the backward pass sees it as well.
+_packed_sequences = None
+
+
+def set_packed_sequences(cu_seqlens):
+    global _packed_sequences
+    if cu_seqlens is None:
+        _packed_sequences = None
+    else:
+        cu_seqlens = cu_seqlens.to(torch.int32)
+        _packed_sequences = (cu_seqlens, int(cu_seqlens.diff().max()))
+
+
+def _make_varlen_flash_attention_forward(flash_attention_forward):
+    def varlen_flash_attention_forward(query_states, key_states, value_states, attention_mask, query_length, *args, **kwargs):
+        if _packed_sequences is not None and attention_mask is None:
+            cu_seqlens, max_seqlen = _packed_sequences
+            if query_states.shape[0] == 1 and query_states.shape[1] == cu_seqlens[-1]:
+                cu_seqlens = cu_seqlens.to(query_states.device)
+                kwargs.update(
+                    cu_seq_lens_q=cu_seqlens,
+                    cu_seq_lens_k=cu_seqlens,
+                    max_length_q=max_seqlen,
+                    max_length_k=max_seqlen,
+                    position_ids=cu_seqlens, # only checked for None to select the varlen path
+                )
+        return flash_attention_forward(query_states, key_states, value_states, attention_mask, query_length, *args, **kwargs)
+    return varlen_flash_attention_forward
+
+
+# the decoder attention of both backbones calls the module-level `_flash_attention_forward`
+for _module in (modeling_qwen2_vl, modeling_qwen2_5_vl):
+    if hasattr(_module, "_flash_attention_forward"):
+        _module._flash_attention_forward = _make_varlen_flash_attention_forward(_module._flash_attention_forward)
+
+
+def packed_causal_mask(cu_seqlens, dtype, device):
+    """(1, 1, L, L) additive mask: causal within every packed sample, nothing across samples."""
+    cu_seqlens = cu_seqlens.to(device)
+    seq_length = int(cu_seqlens[-1])
+    positions = torch.arange(seq_length, device=device)
+    sample_ids = torch.searchsorted(cu_seqlens[1:], positions, right=True)
+    allowed = (sample_ids[:, None] == sample_ids[None, :]) & (positions[:, None] >= positions[None, :])
+    mask = torch.zeros(seq_length, seq_length, dtype=dtype, device=device)
+    return mask.masked_fill(~allowed, torch.finfo(dtype).min)[None, None]
+
+
+def packed_position_ids(model, input_ids, image_grid_thw, cu_seqlens):
+    """
+    (3, 1, L) M-RoPE positions of a packed row: `get_rope_index` of every sample on its own, concatenated.
+    The samples are right padded into a (n_samples, max_len) batch so that `get_rope_index` runs once and consumes
+    image_grid_thw in order.
+    """
+    sample_lengths = cu_seqlens.diff().tolist()
+    samples = torch.split(input_ids[0], sample_lengths)
+    padded_input_ids = torch.nn.utils.rnn.pad_sequence(samples, batch_first=True, padding_value=0)
+    attention_mask = (
+        torch.arange(padded_input_ids.shape[1], device=input_ids.device)
+        < torch.tensor(sample_lengths, device=input_ids.device).unsqueeze(-1)
+    )
+    position_ids, _ = model.get_rope_index(padded_input_ids, image_grid_thw, None, attention_mask=attention_mask.long())
+    return position_ids[:, attention_mask].unsqueeze(1)
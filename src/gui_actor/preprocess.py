@@ -0,0 +1,177 @@
+"""
+Offline preprocessing for `CachedSupervisedDataset`.
+
+Runs `LazySupervisedDataset` once over a dataset spec (a .json/.jsonl file, a {a,b}.json pattern or a .yaml config)
+with a process pool and writes sharded, memory-mappable numpy files with the token ids, labels, image grids,
+coordinates, patch-label indices and the resized (smart_resize) images as PNG bytes:
+
+    python -m gui_actor.preprocess \
+        --model_name_or_path ./checkpoints/qwen2vl_warmup \
+        --data_path data/data_config.yaml \
+        --output_dir data/preprocessed \
+        --max_pixels 5720064 --model_max_length 24576 --num_workers 32
+
+Then train with `--preprocessed_data_dir data/preprocessed` and the same data/processor arguments; the cache is only
+used if its key (see `preprocess_cache_key`) still matches.
+"""
+import argparse
+import io
+import json
+import os
+from multiprocessing import Pool
+from types import SimpleNamespace
+
+import numpy as np
+import transformers
+from PIL import ImageFile
+from tqdm import tqdm
+from transformers import AutoProcessor
+
+from gui_actor.constants import ADDITIONAL_SPECIAL_TOKENS
+from gui_actor.dataset import LazySupervisedDataset, preprocess_cache_key
+
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+# set in the parent before the pool forks, shared by the workers
+_dataset = None
+
+
+# name -> (dtype, shape of one row); every field is a ragged array of rows, one range of rows per sample
+# (image_bytes: one range of bytes per image, the images of a sample follow its image_grid_thw rows)
+SHARD_FIELDS = {
+    "input_ids": (np.int32, ()),
+    "labels": (np.int32, ()),
+    "image_grid_thw": (np.int32, (3,)),
+    "image_bytes": (np.uint8, ()),
+    "coordinates": (np.float64, (2,)),
+    "visual_token_indices": (np.int64, ()),
+    "n_patch_label_targets": (np.int32, ()),
+    "patch_labels": (np.int32, (2,)), # (target, patch) pairs
+}
+
+
+class _ShardWriter:
+    """Accumulates samples as ragged arrays: `<name>.npy` holds the concatenated rows, `<name>_offsets.npy` the bounds."""
+    def __init__(self):
+        self.values = {name: [] for name in SHARD_FIELDS}
+        self.ids = []
+
+    def add(self, name, values):
+        dtype, row_shape = SHARD_FIELDS[name]
+        self.values[name].append(np.asarray(values, dtype=dtype).reshape((-1,) + row_shape))
+
+    def add_sample(self, data_dict, images):
+        self.ids.append(data_dict["id"])
+        self.add("input_ids", data_dict["input_ids"].numpy())
+        self.add("labels", data_dict["labels"].numpy())
+
+        self.add("image_grid_thw", data_dict["image_grid_thw"].numpy() if "image_grid_thw" in data_dict else [])
+        for image in images:
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+            self.add("image_bytes", np.frombuffer(buffer.getvalue(), dtype=np.uint8))
+
+        self.add("coordinates", data_dict["coordinates"] or [])
+        visual_token_indices = data_dict["visual_token_indices_of_coordinates"]
+        self.add("visual_token_indices", [] if visual_token_indices is None else visual_token_indices.numpy())
+
+        multi_patch_labels = data_dict["multi_patch_labels"]
+        if multi_patch_labels is None:
+            self.add("n_patch_label_targets", [0])
+            self.add("patch_labels", [])
+        else:
+            multi_patch_labels = multi_patch_labels if multi_patch_labels.is_sparse else multi_patch_labels.to_sparse()
+            self.add("n_patch_label_targets", [multi_patch_labels.shape[0]])
+            self.add("patch_labels", multi_patch_labels.coalesce().indices().T.numpy())
+
+    def save(self, shard_dir):
+        os.makedirs(shard_dir, exist_ok=True)
+        for name, (dtype, row_shape) in SHARD_FIELDS.items():
+            values = self.values[name]
+            offsets = np.cumsum([0] + [len(v) for v in values], dtype=np.int64)
+            values = np.concatenate(values) if values else np.zeros((0,) + row_shape, dtype=dtype)
+            np.save(os.path.join(shard_dir, f"{name}.npy"), values)
+            np.save(os.path.join(shard_dir, f"{name}_offsets.npy"), offsets)
+        with open(os.path.join(shard_dir, "ids.json"), "w") as f:
+            json.dump(self.ids, f)
+
+
+def _write_shard(task):
+    shard_dir, indices = task
+    writer = _ShardWriter()
+    n_skipped = 0
+    for i in indices:
+        try:
+            data_dict = _dataset._get_item(i, return_images=True)
+        except Exception as e:
+            print(f"Failed to preprocess sample {i}. Exception:", e)
+            data_dict = None
+        if data_dict is None:
+            n_skipped += 1
+            continue
+        writer.add_sample(data_dict, data_dict["images"])
+    writer.save(shard_dir)
+    return len(writer.ids), n_skipped
+
+
+def preprocess(args):
+    global _dataset
+
+    tokenizer = transformers.AutoTokenizer.from_pretrained(
+        args.model_name_or_path,
+        model_max_length=args.model_max_length,
+        padding_side="right",
+    )
+    tokenizer.add_special_tokens({"additional_special_tokens": ADDITIONAL_SPECIAL_TOKENS})
+    processor = AutoProcessor.from_pretrained(
+        args.model_name_or_path, min_pixels=args.min_pixels, max_pixels=args.max_pixels
+    )
+    processor.tokenizer = tokenizer
+
+    data_args = SimpleNamespace(
+        image_folder=args.image_folder,
+        max_conv_turns=args.max_conv_turns,
+        early_mix_text=False,
+        sparse_patch_labels=True,
+    )
+    _dataset = LazySupervisedDataset(tokenizer=tokenizer, processor=processor, data_path=args.data_path, data_args=data_args)
+    # the tokenizer has been used before the pool forks
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    shards = [f"shard_{k:05d}" for k in range(0, (len(_dataset) + args.samples_per_shard - 1) // args.samples_per_shard)]
+    tasks = [
+        (os.path.join(args.output_dir, shard), range(k * args.samples_per_shard, min((k + 1) * args.samples_per_shard, len(_dataset))))
+        for k, shard in enumerate(shards)
+    ]
+    n_samples, n_skipped = 0, 0
+    with Pool(args.num_workers) as pool:
+        for n_written, n_shard_skipped in tqdm(pool.imap(_write_shard, tasks), total=len(tasks), desc="Preprocessing shards"):
+            n_samples += n_written
+            n_skipped += n_shard_skipped
+
+    # meta.json is written last: a cache without it is incomplete
+    with open(os.path.join(args.output_dir, "meta.json"), "w") as f:
+        json.dump({
+            "cache_key": preprocess_cache_key(processor, args.data_path, data_args),
+            "data_path": args.data_path,
+            "shards": shards,
+            "n_samples": n_samples,
+            "n_skipped": n_skipped,
+        }, f, indent=4)
+    print(f"Wrote {n_samples} samples ({n_skipped} skipped) in {len(shards)} shards to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name_or_path", type=str, required=True)
+    parser.add_argument("--data_path", type=str, required=True)
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--image_folder", type=str, default="")
+    parser.add_argument("--min_pixels", type=int, default=3136)
+    parser.add_argument("--max_pixels", type=int, default=5720064)
+    parser.add_argument("--max_conv_turns", type=int, default=10)
+    parser.add_argument("--model_max_length", type=int, default=8192)
+    parser.add_argument("--samples_per_shard", type=int, default=2048)
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
+    preprocess(parser.parse_args())
@@ -2,12 +2,14 @@ from datetime import timedelta
 from functools import wraps
 from typing import Optional
 
+import numpy as np
 import torch
 import torch.distributed as dist
 import transformers
 from accelerate import Accelerator, DataLoaderConfiguration
+from accelerate.data_loader import prepare_data_loader
 from accelerate.utils import GradientAccumulationPlugin, InitProcessGroupKwargs
-from torch.utils.data import DataLoader, RandomSampler
+from torch.utils.data import DataLoader, RandomSampler, Sampler
 from transformers import Trainer
 from transformers.trainer import (
     ALL_LAYERNORM_LAYERS,
@@ -69,6 +71,95 @@ def safe_save_model_for_hf_trainer(trainer: transformers.Trainer, output_dir: st
         trainer._save(output_dir, state_dict=cpu_state_dict)
 
 
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batch sampler that fills every batch up to `max_tokens` instead of using a fixed batch size.
+    Since the collator pads to the longest sample, a batch costs `len(batch) * max(lengths in batch)` tokens (text
+    and image tokens); samples longer than `max_tokens` get a batch of their own. With `packed=True` (the collator
+    concatenates the samples into one row, no padding) a batch costs the sum of its lengths instead.
+
+    Every epoch (with `seed + epoch`, the same order on all ranks) the samples are permuted and cut into megabatches
+    of `bucket_size` samples, each megabatch is sorted by length and packed greedily, so that batches hold similar
+    lengths. The batches are shuffled and dealt out round-robin to the `num_replicas` ranks. The Trainer relies on a
+    fixed number of batches per epoch for `max_steps` and the learning rate schedule, so every epoch is truncated to
+    (or padded with repeated batches up to) the number of batches of epoch 0. The sampler does the sharding itself,
+    so its DataLoader must not be sharded again by accelerate.
+    """
+    def __init__(self, lengths, max_tokens, num_replicas=1, rank=0, seed=0, bucket_size=1000, shuffle=True, drop_last=True, packed=False):
+        self.lengths = np.abs(np.asarray(lengths, dtype=np.int64))
+        self.max_tokens = max_tokens
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.packed = packed
+        self.epoch = 0
+        self._num_batches = None
+        self._cached_epoch, self._cached_batches = None, None
+
+    @property
+    def sampler(self):
+        # accelerate's DataLoaderShard forwards set_epoch to `batch_sampler.sampler`
+        return self
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _pack(self, epoch):
+        """All batches of `epoch`, before they are dealt out to the ranks."""
+        rng = np.random.default_rng(self.seed + epoch)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            megabatch = indices[start:start + self.bucket_size]
+            megabatch = megabatch[np.argsort(-self.lengths[megabatch], kind="stable")]
+            batch, batch_max_length, batch_total_length = [], 0, 0
+            for index in megabatch.tolist():
+                length = self.lengths[index]
+                max_length = max(batch_max_length, length)
+                cost = batch_total_length + length if self.packed else (len(batch) + 1) * max_length
+                if batch and cost > self.max_tokens:
+                    batches.append(batch)
+                    batch, max_length, batch_total_length = [], length, 0
+                batch.append(index)
+                batch_max_length = max_length
+                batch_total_length += length
+            if batch:
+                batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def _batches(self):
+        """The batches of this rank for the current epoch, computed once per epoch."""
+        if self._cached_epoch == self.epoch:
+            return self._cached_batches
+        batches = self._pack(self.epoch)
+        if self._num_batches is None:
+            num_batches = len(batches) if self.epoch == 0 else len(self._pack(0))
+            # every rank must run the same number of steps
+            if self.drop_last:
+                num_batches -= num_batches % self.num_replicas
+            else:
+                num_batches += -num_batches % self.num_replicas
+            self._num_batches = num_batches
+
+        while len(batches) < self._num_batches:
+            batches += batches[:self._num_batches - len(batches)]
+        batches = batches[:self._num_batches]
+        self._cached_epoch, self._cached_batches = self.epoch, batches[self.rank::self.num_replicas]
+        return self._cached_batches
+
+    def __iter__(self):
+        return iter(self._batches())
+
+    def __len__(self):
+        return len(self._batches())
+
+
 class AGUVISTrainer(Trainer):
 
     def __init__(self, *args, **kwargs):
@@ -211,6 +302,40 @@ class AGUVISTrainer(Trainer):
             "persistent_workers": self.args.dataloader_persistent_workers,
         }
 
+        if self.args.max_tokens_per_batch > 0 and not isinstance(train_dataset, torch.utils.data.IterableDataset):
+            # dynamic batch size: the batch sampler shards the batches over the ranks itself
+            batch_sampler = TokenBudgetBatchSampler(
+                self.train_dataset.lengths,
+                max_tokens=self.args.max_tokens_per_batch,
+                num_replicas=self.args.world_size,
+                rank=self.args.process_index,
+                seed=self.args.seed,
+                drop_last=self.args.dataloader_drop_last,
+                packed=self.args.packing,
+            )
+            dataloader_params.pop("batch_size")
+            dataloader = DataLoader(
+                train_dataset,
+                batch_sampler=batch_sampler,
+                worker_init_fn=seed_worker,
+                prefetch_factor=self.args.dataloader_num_workers * 2 if self.args.dataloader_num_workers != 0 else None,
+                **dataloader_params,
+            )
+            # prepared like `accelerator.prepare` does (device placement, rng sync, end-of-dataloader tracking for
+            # gradient accumulation, checkpointing), but with a single process so that accelerate does not shard the
+            # batches a second time
+            dataloader = prepare_data_loader(
+                dataloader,
+                self.accelerator.device,
+                num_processes=1,
+                process_index=0,
+                put_on_device=self.accelerator.device_placement,
+                rng_types=self.accelerator.rng_types.copy(),
+                non_blocking=self.accelerator.non_blocking,
+            )
+            self.accelerator._dataloaders.append(dataloader)
+            return dataloader
+
         if not isinstance(train_dataset, torch.utils.data.IterableDataset):
             dataloader_params["sampler"] = self._get_train_sampler()
             dataloader_params["drop_last"] = self.args.dataloader_drop_last
@@ -13,7 +13,7 @@ from transformers import (
     AutoProcessor,
 )
 
-from gui_actor.dataset import LazySupervisedDataset
+from gui_actor.dataset import LazySupervisedDataset, CachedSupervisedDataset
 from gui_actor.trainer import AGUVISTrainer, rank0_print, safe_save_model_for_hf_trainer
 from gui_actor.utils import dump_args_to_json
 
@@ -50,6 +50,8 @@ class DataArguments:
     min_pixels: Optional[int] = field(default=3136) # 2 * 2 * 28 * 28 = 56 * 56
     max_pixels: Optional[int] = field(default=5720064) # 5720064 = 114 * 64 * 28 * 28 = 3192 * 1792, 12845056 = 128 * 128 * 28 * 28
     max_conv_turns: Optional[int] = field(default=10) # 30 => 20 => 10
+    sparse_patch_labels: bool = field(default=False) # keep the multi-patch labels as sparse COO tensors (only the covered patches)
+    preprocessed_data_dir: Optional[str] = field(default=None) # output_dir of `python -m gui_actor.preprocess` for data_path
 
 
 @dataclass
@@ -61,6 +63,14 @@ class TrainingArguments(transformers.TrainingArguments):
         metadata={"help": "Maximum sequence length. Sequences will be right padded (and possibly truncated)."},
     )
     group_by_modality_length: bool = field(default=False)
+    max_tokens_per_batch: int = field(
+        default=0,
+        metadata={"help": "If > 0, batches are filled up to this many (padded) text + image tokens instead of using a fixed per-device batch size."},
+    )
+    packing: bool = field(
+        default=False,
+        metadata={"help": "Concatenate the samples of a batch into a single row without padding; attention stays within every sample (varlen flash attention with flash_attention_2)."},
+    )
     gradient_checkpointing: bool = field(default=True)
     verbose_logging: bool = field(default=False)
     
@@ -165,6 +175,7 @@ class DataCollatorForSupervisedDataset:
     """Collate examples for supervised fine-tuning."""
 
     tokenizer: transformers.PreTrainedTokenizer
+    packing: bool = False
 
     def pad_sequence(self, input_ids, batch_first, padding_value):
         if self.tokenizer.padding_side == "left":
@@ -178,6 +189,8 @@ class DataCollatorForSupervisedDataset:
         input_ids, labels = tuple([instance[key] for instance in instances] for key in ("input_ids", "labels"))
         input_ids = [_input_ids[: self.tokenizer.model_max_length] for _input_ids in input_ids]
         labels = [_labels[: self.tokenizer.model_max_length] for _labels in labels]
+        if self.packing:
+            return self.pack(instances, input_ids, labels)
         if self.tokenizer.pad_token_id is None:
             self.tokenizer.pad_token_id = 0  # This gets the best result. Don't know why.
         input_ids = self.pad_sequence(input_ids, batch_first=True, padding_value=self.tokenizer.pad_token_id)
@@ -188,6 +201,28 @@ class DataCollatorForSupervisedDataset:
             "attention_mask": input_ids.ne(self.tokenizer.pad_token_id),
         }
 
+        return self.add_grounding_inputs(batch, instances)
+
+    def pack(self, instances, input_ids, labels):
+        """
+        Concatenate the samples into a single row of shape (1, total_len) without padding. `cu_seqlens` marks the
+        sample boundaries; the model restarts the positions and restricts attention to each sample.
+        """
+        labels = [_labels.clone() for _labels in labels]
+        for _labels in labels:
+            _labels[0] = IGNORE_INDEX # the first token of a sample must not be predicted from the previous sample
+        sample_lengths = torch.tensor([len(_input_ids) for _input_ids in input_ids])
+        input_ids = torch.cat(input_ids).unsqueeze(0)
+        labels = torch.cat(labels).unsqueeze(0)
+        batch = {
+            "input_ids": input_ids,
+            "labels": labels.long() if labels.dtype == torch.int32 else labels,
+            "attention_mask": torch.ones_like(input_ids, dtype=torch.bool),
+            "cu_seqlens": torch.nn.functional.pad(sample_lengths.cumsum(0), (1, 0)),
+        }
+        return self.add_grounding_inputs(batch, instances)
+
+    def add_grounding_inputs(self, batch, instances):
         if "pixel_values" in instances[0]:
             batch["pixel_values"] = torch.concat([instance["pixel_values"] for instance in instances], dim=0)
             batch["image_grid_thw"] = torch.concat([instance["image_grid_thw"] for instance in instances], dim=0)
@@ -207,10 +242,19 @@ def make_supervised_data_module(tokenizer: transformers.PreTrainedTokenizer,
                                 data_args: DataArguments,
                                 training_args: TrainingArguments) -> Dict:
     """Make dataset and collator for supervised fine-tuning."""
-    train_dataset = LazySupervisedDataset(
-        tokenizer=tokenizer, processor=processor, data_path=data_args.data_path, data_args=data_args
-    )
-    data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
+    if data_args.preprocessed_data_dir is not None and CachedSupervisedDataset.is_valid(
+        data_args.preprocessed_data_dir, processor, data_args.data_path, data_args
+    ):
+        train_dataset = CachedSupervisedDataset(
+            processor=processor, cache_dir=data_args.preprocessed_data_dir, data_args=data_args
+        )
+    else:
+        if data_args.preprocessed_data_dir is not None:
+            rank0_print(f"Preprocessed data in {data_args.preprocessed_data_dir} is missing or stale (dataset, processor or template changed), preprocessing on the fly")
+        train_dataset = LazySupervisedDataset(
+            tokenizer=tokenizer, processor=processor, data_path=data_args.data_path, data_args=data_args
+        )
+    data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer, packing=training_args.packing)
     return {"train_dataset": train_dataset, "eval_dataset": None, "data_collator": data_collator}
 
 
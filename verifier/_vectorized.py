@@ -0,0 +1,91 @@
+"""
+Vectorized helpers shared by the verifier scripts. They mirror gui_actor.metrics.ResultTable and
+gui_actor.inference.label_connected_regions, so that the verifier scripts run without the gui_actor package.
+"""
+import numpy as np
+import torch
+
+
+def label_connected_regions(mask):
+    """
+    Label the 4-connected components of a 2D boolean mask.
+
+    Args:
+        mask: bool tensor of shape (n_height, n_width).
+
+    Returns:
+        labels: long tensor of shape (n_height, n_width). Every activated patch holds the flat index of the
+        first (row-major) patch of its region, every other patch holds n_height * n_width.
+    """
+    n_height, n_width = mask.shape
+    n_patches = n_height * n_width
+    background = torch.full(mask.shape, n_patches, dtype=torch.long, device=mask.device)
+    labels = torch.where(mask, torch.arange(n_patches, device=mask.device).view(n_height, n_width), background)
+    # the extra slot keeps background patches pointing at the background during pointer jumping
+    lookup = torch.full((n_patches + 1,), n_patches, dtype=torch.long, device=mask.device)
+
+    while True:
+        # Propagate the smallest label among the 4 adjacent patches
+        padded = torch.nn.functional.pad(labels, (1, 1, 1, 1), value=n_patches)
+        new_labels = torch.stack([
+            labels, padded[:-2, 1:-1], padded[2:, 1:-1], padded[1:-1, :-2], padded[1:-1, 2:]
+        ]).amin(dim=0)
+        new_labels = torch.where(mask, new_labels, background)
+        # Pointer jumping: take over the label of the patch we point to, so long regions converge quickly
+        lookup[:n_patches] = new_labels.view(-1)
+        new_labels = lookup[new_labels]
+        if torch.equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+class ResultTable:
+    """
+    Struct-of-arrays view of a list of result dicts.
+
+    categorical: keys whose values are categories (missing keys count as the category None); every column is stored
+        as int codes into `categories[key]`, in order of first appearance.
+    values: keys whose values are numbers (missing keys count as 0), summed by `sums`.
+    """
+    def __init__(self, results, categorical=(), values=()):
+        self.n = len(results)
+        self.categories = {}
+        self.codes = {}
+        for key in categorical:
+            lookup = {}
+            codes = np.fromiter(
+                (lookup.setdefault(result.get(key), len(lookup)) for result in results), dtype=np.int64, count=self.n
+            )
+            self.categories[key] = list(lookup)
+            self.codes[key] = codes
+        self.values = {
+            key: np.fromiter((result.get(key, 0) for result in results), dtype=np.float64, count=self.n)
+            for key in values
+        }
+
+    def add_indicator(self, key, column, category):
+        """Add a value column `key` that is 1 where categorical `column` equals `category`."""
+        categories = self.categories[column]
+        code = categories.index(category) if category in categories else -1
+        self.values[key] = (self.codes[column] == code).astype(np.float64)
+
+    def index(self, column, category):
+        """Position of `category` along the axis of `column` in a cube, or None if it never occurs."""
+        categories = self.categories[column]
+        return categories.index(category) if category in categories else None
+
+    def sums(self, by, values=()):
+        """
+        Dense cubes of shape (len(categories[by[0]]), len(categories[by[1]]), ...): the number of samples ("count")
+        and the sum of every value column in `values` for each combination of categories.
+        """
+        shape = tuple(len(self.categories[key]) for key in by)
+        if by:
+            flat = np.ravel_multi_index(tuple(self.codes[key] for key in by), shape)
+        else:
+            flat = np.zeros(self.n, dtype=np.int64)
+        size = int(np.prod(shape))
+        cubes = {"count": np.bincount(flat, minlength=size).reshape(shape)}
+        for key in values:
+            cubes[key] = np.bincount(flat, weights=self.values[key], minlength=size).reshape(shape)
+        return cubes
@@ -8,7 +8,7 @@ import os
 from PIL import Image, ImageDraw
 import logging
 from tqdm import tqdm
-
+from _vectorized import ResultTable
 
 
 def draw_annotations(img, point_in_pixel, bbox, output_path='test.png'): 
@@ -72,108 +72,35 @@ def build_model(args):
     return model
 
 
-def collect_results_to_eval(results, platform=None, group=None, application=None, language=None, gt_type=None, instruction_style=None, ui_type=None):
-    """
-    Filters the results based on provided values. None means include all (ignore filtering this attribute).
-
-
-    Parameters:
-        results (list): A list of dictionaries containing sample results.
-
-    Returns:
-        list: A filtered list of dictionaries based on the given criteria.
-    """
-    filtered_results = []
-
-
-    for sample in results:
-        # Check each filter condition; if None, consider it as passed
-        if (platform is None or sample.get("platform") == platform) and \
-            (group is None or sample.get("group") == group) and \
-            (application is None or sample.get("application") == application) and \
-            (language is None or sample.get("language") == language) and \
-            (gt_type is None or sample.get("gt_type") == gt_type) and \
-            (instruction_style is None or sample.get("instruction_style") == instruction_style) and \
-            (ui_type is None or sample.get("ui_type") == ui_type):
-            filtered_results.append(sample)
-
+RESULT_ATTRIBUTES = ["platform", "group", "application", "language", "gt_type", "instruction_style", "ui_type"]
 
-    return filtered_results
 
+def build_result_table(results):
+    """Columnar view of the results that all metric tables below are aggregated from."""
+    if isinstance(results, ResultTable):
+        return results
+    table = ResultTable(results, categorical=RESULT_ATTRIBUTES + ["correctness"])
+    table.add_indicator("correct", "correctness", "correct")
+    table.add_indicator("wrong_format", "correctness", "wrong_format")
+    return table
 
 
+def _metrics_from_cubes(table, cubes, select):
+    """calc_metric_for_result_list of the samples in `select` (indices into the cubes, the last axis is ui_type)."""
+    def total(key, ui_type=None):
+        cube = cubes[key][select]
+        if ui_type is not None:
+            index = table.index("ui_type", ui_type)
+            if index is None:
+                return 0
+            cube = cube[..., index]
+        return int(cube.sum())
 
-def make_combinations(results, platform=False, group=None, application=False, language=False, gt_type=False, instruction_style=False, ui_type=False):
-    """
-    Returns a list of combinations of values for attributes where the corresponding parameter is set to True.
-    """
-    # Initialize a dictionary to store unique values for each attribute
-    unique_values = {
-        "platform": set(),
-        "group": set(),
-        "application": set(),
-        "language": set(),
-        "gt_type": set(),
-        "instruction_style": set(),
-        "ui_type": set(),
-    }
-
-
-    # Collect unique values from the results
-    for sample in results:
-        if platform:
-            unique_values["platform"].add(sample.get("platform"))
-        if group:
-            unique_values["group"].add(sample.get("group"))
-        if application:
-            unique_values["application"].add(sample.get("application"))
-        if language:
-            unique_values["language"].add(sample.get("language"))
-        if gt_type:
-            unique_values["gt_type"].add(sample.get("gt_type"))
-        if instruction_style:
-            unique_values["instruction_style"].add(sample.get("instruction_style"))
-        if ui_type:
-            unique_values["ui_type"].add(sample.get("ui_type"))
-
-
-    # Filter out the attributes that are set to False (no need for combinations)
-    filtered_values = {key: list(value) for key, value in unique_values.items() if value}
-    if not filtered_values:
-        return []
-
-
-    # Generate all combinations of the selected attributes using itertools.product
-    attribute_combinations = list(itertools.product(*filtered_values.values()))
-
-
-    # Convert combinations into dictionaries with corresponding attribute names
-    combinations = []
-    for combination in attribute_combinations:
-        combinations.append(dict(zip(filtered_values.keys(), combination)))
-
-
-    return combinations
-
-
-
-
-def calc_metric_for_result_list(results):
-    """Calculates the metrics for a simple result list."""
-    num_total = len(results)
-    correct_num = sum(1 for res in results if res["correctness"] == "correct")
-    wrong_format_num = sum(1 for res in results if res["correctness"] == "wrong_format")
-
-
-    # Calculate text and icon specific metrics using collect_results_to_eval
-    text_results = collect_results_to_eval(results, ui_type="text")
-    icon_results = collect_results_to_eval(results, ui_type="icon")
-
-
-    text_correct = sum(1 for res in text_results if res["correctness"] == "correct")
-    text_total = len(text_results)
-    icon_correct = sum(1 for res in icon_results if res["correctness"] == "correct")
-    icon_total = len(icon_results)
+    num_total = total("count")
+    correct_num = total("correct")
+    wrong_format_num = total("wrong_format")
+    text_correct, text_total = total("correct", "text"), total("count", "text")
+    icon_correct, icon_total = total("correct", "icon"), total("count", "icon")
     metrics = {
         "num_correct_action": correct_num,
         "num_total": num_total,
@@ -185,6 +112,30 @@ def calc_metric_for_result_list(results):
     return metrics
 
 
+def calc_metric_for_result_list(results):
+    """Calculates the metrics for a simple result list."""
+    table = build_result_table(results)
+    return _metrics_from_cubes(table, table.sums(["ui_type"], ["correct", "wrong_format"]), ())
+
+
+def evaluate_combinations(results, attributes, key_format):
+    """
+    Metrics for every combination of the values of `attributes`, keyed by `key_format.format(*values)`.
+    A None value matches all samples. All combinations are computed from a single bincount over the results.
+    """
+    table = build_result_table(results)
+    cubes = table.sums(list(attributes) + ["ui_type"], ["correct", "wrong_format"])
+
+    evaluation_result = {}
+    for combination in itertools.product(*(list(enumerate(table.categories[key])) for key in attributes)):
+        select = tuple(slice(None) if value is None else index for index, value in combination)
+        metrics = _metrics_from_cubes(table, cubes, select)
+        if metrics['num_total'] == 0:
+            continue
+        evaluation_result[key_format.format(*(value for _, value in combination))] = metrics
+    return evaluation_result
+
+
 
 
 def eval_sample_positive_gt(sample, response):
@@ -215,189 +166,31 @@ def eval_sample_negative_gt(sample, response):
 
 
 def evaluate_fine_grained(results):
-    # Generate all combinations of platform, instruction_style, and gt_type
-    combinations = make_combinations(
+    return evaluate_combinations(
         results,
-        platform=True,
-        application=True,
-        instruction_style=True,
-        gt_type=True
+        ["platform", "application", "instruction_style", "gt_type"],
+        "plat:{} app:{} inst_style:{} gt_type:{}",
     )
 
 
-    evaluation_result = {}
-
-
-    # Iterate through each combination
-    for combo in combinations:
-        platform = combo.get("platform")
-        application = combo.get("application")
-        inst_style = combo.get("instruction_style")
-        gt_type = combo.get("gt_type")
-        
-        # Filter results for the current combination
-        filtered_results = collect_results_to_eval(
-            results=results,
-            platform=platform,
-            application=application,
-            instruction_style=inst_style,
-            gt_type=gt_type
-        )
-        
-        # Calculate metrics using the calc_metric_for_result_list function
-        metrics = calc_metric_for_result_list(filtered_results)
-        if metrics['num_total'] == 0:
-            continue
-        
-        # Construct a unique key based on the combination
-        key = f"plat:{platform} app:{application} inst_style:{inst_style} gt_type:{gt_type}"
-        evaluation_result[key] = metrics
-
-
-    return evaluation_result
-
-
 def evaluate_fine_grained_v2(results):
-    # Generate all combinations of platform, instruction_style, and gt_type
-    combinations = make_combinations(
-        results,
-        group=True,
-    )
-
-
-    evaluation_result = {}
-
-
-    # Iterate through each combination
-    for combo in combinations:
-        group = combo.get("group")
-
-
-        # Filter results for the current combination
-        filtered_results = collect_results_to_eval(
-            results=results,
-            group=group,
-        )
-        
-        # Calculate metrics using the calc_metric_for_result_list function
-        metrics = calc_metric_for_result_list(filtered_results)
-        if metrics['num_total'] == 0:
-            continue
-        
-        # Construct a unique key based on the combination
-        key = f"group:{group}"
-        evaluation_result[key] = metrics
-
-
-    return evaluation_result
+    return evaluate_combinations(results, ["group"], "group:{}")
 
 
 def evaluate_seeclick_paper_style(results):
-    # Generate all combinations of platform, instruction_style, and gt_type
-    combinations = make_combinations(
+    return evaluate_combinations(
         results,
-        platform=True,
-        instruction_style=True,
-        gt_type=True
+        ["platform", "instruction_style", "gt_type"],
+        "plat:{} inst_style:{} gt_type:{}",
     )
 
 
-    evaluation_result = {}
-
-
-    # Iterate through each combination
-    for combo in combinations:
-        platform = combo.get("platform")
-        inst_style = combo.get("instruction_style")
-        gt_type = combo.get("gt_type")
-        
-        # Filter results for the current combination
-        filtered_results = collect_results_to_eval(
-            results=results,
-            platform=platform,
-            instruction_style=inst_style,
-            gt_type=gt_type
-        )
-        
-        # Calculate metrics using the calc_metric_for_result_list function
-        metrics = calc_metric_for_result_list(filtered_results)
-        if metrics['num_total'] == 0:
-            continue
-        
-        # Construct a unique key based on the combination
-        key = f"plat:{platform} inst_style:{inst_style} gt_type:{gt_type}"
-        evaluation_result[key] = metrics
-
-
-    return evaluation_result
-
-
 def evaluate_leaderboard_detailed_style(results):
-    # Generate all combinations of platform, instruction_style, and gt_type
-    combinations = make_combinations(
-        results,
-        application=True,
-    )
-
-
-    evaluation_result = {}
-
-
-    # Iterate through each combination
-    for combo in combinations:
-        application = combo.get("application")
-        
-        # Filter results for the current combination
-        filtered_results = collect_results_to_eval(
-            results=results,
-            application=application,
-        )
-        
-        # Calculate metrics using the calc_metric_for_result_list function
-        metrics = calc_metric_for_result_list(filtered_results)
-        if metrics['num_total'] == 0:
-            continue
-        
-        # Construct a unique key based on the combination
-        key = f"app:{application}"
-        evaluation_result[key] = metrics
-
-
-    return evaluation_result
+    return evaluate_combinations(results, ["application"], "app:{}")
 
 
 def evaluate_leaderboard_simple_style(results):
-    # Generate all combinations of platform, instruction_style, and gt_type
-    combinations = make_combinations(
-        results,
-        group=True,
-    )
-
-
-    evaluation_result = {}
-
-
-    # Iterate through each combination
-    for combo in combinations:
-        group = combo.get("group")
-        
-        # Filter results for the current combination
-        filtered_results = collect_results_to_eval(
-            results=results,
-            group=group,
-        )
-        
-        # Calculate metrics using the calc_metric_for_result_list function
-        metrics = calc_metric_for_result_list(filtered_results)
-        if metrics['num_total'] == 0:
-            continue
-        
-        # Construct a unique key based on the combination
-        key = f"group:{group}"
-        evaluation_result[key] = metrics
-
-
-    return evaluation_result
+    return evaluate_combinations(results, ["group"], "group:{}")
 
 
 def evaluate_overall(results):
@@ -427,12 +220,15 @@ def evaluate(results):
     }
 
 
+    # all tables are aggregated from the same columnar view of the results
+    table = build_result_table(results)
+
     # # TODO: comment out function calls based on your need
-    result_report["metrics"]["fine_grained"] = evaluate_fine_grained_v2(results)
-    # result_report["metrics"]["seeclick_style"] = evaluate_seeclick_paper_style(results)
-    # result_report["metrics"]["leaderboard_simple_style"] = evaluate_leaderboard_simple_style(results)
-    # result_report["metrics"]["leaderboard_detailed_style"] = evaluate_leaderboard_detailed_style(results)
-    result_report["metrics"]["overall"] = evaluate_overall(results)
+    result_report["metrics"]["fine_grained"] = evaluate_fine_grained_v2(table)
+    # result_report["metrics"]["seeclick_style"] = evaluate_seeclick_paper_style(table)
+    # result_report["metrics"]["leaderboard_simple_style"] = evaluate_leaderboard_simple_style(table)
+    # result_report["metrics"]["leaderboard_detailed_style"] = evaluate_leaderboard_detailed_style(table)
+    result_report["metrics"]["overall"] = evaluate_overall(table)
 
 
     # Save detailed results
@@ -1,9 +1,13 @@
 import json
 import os
 import re
+import hashlib
 import numpy as np
 import random
+from functools import partial
+from multiprocessing import Pool
 from PIL import Image, ImageDraw
+from tqdm import tqdm
 import argparse
 
 
@@ -22,11 +26,11 @@ neg_dic = {
 
 
 
-def sample_point(bbox):
+def sample_point(bbox, rng=np.random):
     x0, y0, x1, y1 = bbox
     t = 0
     while t <= 50:
-        xx, yy = np.random.random(2)
+        xx, yy = rng.random(2)
         t += 1
         if not ((x0 < xx < x1) and (y0 < yy < y1)):
             break
@@ -69,143 +73,204 @@ def draw_annotations(img, point_in_pixel, bbox, output_path='test.png', color='r
         draw.ellipse(circle_bbox, outline=color, width=np.ceil(4 * size).astype(int))
 
     img.save(output_path)
-    print(f"Annotated image saved to {output_path}")
     return img
 
 
-def transform_to_conversation_format(data, file, image_folder_dict, new_directory):
+IMAGE_FORMAT_SUFFIXES = {'png': '.png', 'webp': '.webp', 'jpeg': '.jpg'}
+
+
+def annotated_image_path(new_directory, file, img_filename, tag, instruction, point, crop_size=0, image_format='source'):
+    """Deterministic file name of an annotated variant: source name, tag and a hash of what is drawn."""
+    prefix, suffix = os.path.splitext(img_filename)
+    digest = hashlib.blake2b(json.dumps([file, img_filename, tag, instruction, point, crop_size]).encode(), digest_size=4).hexdigest()
+    suffix = IMAGE_FORMAT_SUFFIXES.get(image_format, suffix)
+    return os.path.join(new_directory, file + '_' + prefix.replace('/', '') + f'_{tag}_{digest}' + suffix)
+
+
+def inference_crop_box(point_in_pixel, img_size, crop_size):
+    """The window GroundingVerifier.verifier_score shows the verifier (see draw_point_list in verifier_model.py)."""
+    x, y = point_in_pixel
+    width, height = img_size
+    left = max(0, x - crop_size)
+    right = min(width-1, x + crop_size)
+    top = max(0, y - crop_size)
+    bottom = min(height-1, y + crop_size)
+    return [left, top, right, bottom]
+
+
+def draw_annotated_crop(img, point_in_pixel, output_path, crop_size=500, image_format='webp', quality=90, color='red', size=1):
     """
-    Transform the input data to the specified conversation format.
-    Args:
-        data: List of dictionaries containing webpage elements data
-    
-    Returns:
-        List of dictionaries in the conversation format
+    Save the annotated window around `point_in_pixel` that the verifier sees at inference (the full image if
+    crop_size is 0). Only the window is copied and drawn on. Returns the crop box in source pixels.
     """
-    image_folder = image_folder_dict[file]
-    result = []
-    for i, item in enumerate(data):
-        print(i / len(data))
-        img_filename = item['img_filename']
+    if crop_size > 0:
+        crop_box = inference_crop_box(point_in_pixel, img.size, crop_size)
+        img = img.crop(crop_box)
+        # crop rounds the box to whole pixels
+        crop_box = [round(v) for v in crop_box]
+        point_in_pixel = [point_in_pixel[0] - crop_box[0], point_in_pixel[1] - crop_box[1]]
+    else:
+        crop_box = [0, 0, img.size[0], img.size[1]]
+        img = img.copy()
+    if image_format in ('jpeg', 'webp'):
+        img = img.convert('RGB')
 
-        prompt = 'Please observe the screenshot and exame whether the hollow red circle accurately placed on the intended position in the image:'
-    
-        if 'elements' in item:
-            # sample n//2 element
-            n = len(item['elements'])
-            ind_list = []
-            if n <= 1:
-                ind_list = [0]
-            else:
-                ind_list = random.sample(range(n), min(n//2, 3))
-
-            for ind in ind_list:
-                conversations = []
-                instruction = item['elements'][ind]['instruction']
-                bbox = item['elements'][ind]['bbox']
-                if (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) >= 0.8:
-                    continue
-
-                conversations.append({
-                    "from": "human",
-                    "value": f"<image>\n{prompt} " + f"'{instruction}'. Answer True or False."
-                })
-                
-                # Calculate the center point of the bounding box
-                x_center = (bbox[0] + bbox[2]) / 2
-                y_center = (bbox[1] + bbox[3]) / 2
-
-                if n >= 2:
-                    neg_ind = random.choice([k for k in range(n) if k != ind])
-                    neg_bbox = item['elements'][neg_ind]['bbox']
-                    x_neg, y_neg =  (neg_bbox[0] + neg_bbox[2]) / 2, (neg_bbox[1] + neg_bbox[3]) / 2
-                    if (x_center - x_neg) ** 2 + (y_center - y_neg) ** 2 < 0.05:
-                        x_neg, y_neg = sample_point(bbox)
-                else:
-                    x_neg, y_neg = sample_point(bbox)
-            
-                # draw image
-                try:
-                    img = Image.open(os.path.join(image_folder, img_filename))
-                except:
-                    continue
-
-                
-                prefix, suffix = img_filename.split('.')
-                width, height = img.size
-                save_path = os.path.join(new_directory, file+'_'+ prefix.replace('/', '') + f'_pos{ind}.' + suffix)
-                while os.path.exists(save_path):
-                    save_path = os.path.join(new_directory, file+'_'+ prefix.replace('/', '') + f'_pos{ind}_{random.randint(0, 1000)}.' + suffix)
-            
-                try:
-                    draw_annotations(img, [x_center * width, y_center* height], None, output_path=save_path, size=height/1000 * 1.2)
-                except:
-                    continue
-                img = Image.open(os.path.join(image_folder, img_filename))
-                neg_save_path = os.path.join(new_directory, file+'_'+ prefix.replace('/', '') + f'_neg{ind}.' + suffix)
-                while os.path.exists(neg_save_path):
-                    neg_save_path = os.path.join(new_directory, file+'_'+ prefix.replace('/', '') + f'_neg{ind}_{random.randint(0, 1000)}.' + suffix)
-            
-                draw_annotations(img, [x_neg * width, y_neg* height], None, output_path=neg_save_path, size=height/1000 * 1.2)
-
-
-                # Create the conversation item
-                result.append({
-                    "image":save_path.replace(new_directory, ''),
-                    "conversations": conversations + [dic]
-                })
-                result.append({
-                    "image":neg_save_path.replace(new_directory, ''),
-                    "conversations": conversations + [neg_dic]
-                })
-        else:
-            conversations = []
-            instruction = item['instruction']
-            bbox = item['bbox']
-            conversations.append({
-                "from": "human",
-                "value": f"<image>\n{prompt} " + f"'{instruction}'. Answer True or False."
-            })
+    draw = ImageDraw.Draw(img)
+    radius = np.ceil(8 * size).astype(int)
+    circle_bbox = [
+        point_in_pixel[0] - radius,  # x1
+        point_in_pixel[1] - radius,  # y1
+        point_in_pixel[0] + radius,  # x2
+        point_in_pixel[1] + radius   # y2
+    ]
+    draw.ellipse(circle_bbox, outline=color, width=np.ceil(4 * size).astype(int))
+
+    if image_format == 'source':
+        img.save(output_path)
+    else:
+        img.save(output_path, format=image_format.upper(), quality=quality)
+    return crop_box
 
 
+def transform_item(task, file, image_folder, new_directory, seed=0, crop_size=500, image_format='webp', quality=90):
+    """
+    Conversation samples (a positive and a negative annotated screenshot per instruction) of one source item.
+    The source image is decoded once and every variant is drawn on a crop of it (see draw_annotated_crop). The random
+    choices only depend on `seed`, `file` and the item index, so every run (and every resumed run) produces the same
+    samples. Every sample records its source image and crop box.
+    """
+    index, item = task
+    rng = np.random.default_rng([seed, index, int(hashlib.md5(file.encode()).hexdigest()[:8], 16)])
+    py_rng = random.Random(int(rng.integers(2 ** 32)))
+    img_filename = item['img_filename']
+    prompt = 'Please observe the screenshot and exame whether the hollow red circle accurately placed on the intended position in the image:'
+
+    # (tag, instruction, bbox, negative point)
+    samples = []
+    if 'elements' in item:
+        # sample n//2 element
+        n = len(item['elements'])
+        if n <= 1:
+            ind_list = [0]
+        else:
+            ind_list = py_rng.sample(range(n), min(n//2, 3))
+
+        for ind in ind_list:
+            instruction = item['elements'][ind]['instruction']
+            bbox = item['elements'][ind]['bbox']
             if (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) >= 0.8:
                 continue
 
+            # Calculate the center point of the bounding box
             x_center = (bbox[0] + bbox[2]) / 2
             y_center = (bbox[1] + bbox[3]) / 2
-            x_neg, y_neg = sample_point(bbox)
 
-            # draw image
-            try:
-                img = Image.open(os.path.join(image_folder, img_filename))
-            except:
-                continue
-            prefix, suffix = img_filename.split('.')
-            width, height = img.size
-            save_path = os.path.join(new_directory, file+'_'+ prefix.replace('/', '') + '_pos.' + suffix)
-            while os.path.exists(save_path):
-                save_path = os.path.join(new_directory, file+'_'+ prefix.replace('/', '') + f'_pos_{random.randint(0, 1000)}.' + suffix)
-            
-            draw_annotations(img, [x_center * width, y_center* height], None, output_path=save_path, size=height/1000 * 1.2)
-
-            img = Image.open(os.path.join(image_folder, img_filename))
-            neg_save_path = os.path.join(new_directory, file+'_'+ prefix.replace('/', '') + '_neg.' + suffix)
-            while os.path.exists(neg_save_path):
-                neg_save_path = os.path.join(new_directory, file+'_'+ prefix.replace('/', '') + f'_neg_{random.randint(0, 1000)}.' + suffix)
-            
-            draw_annotations(img, [x_neg * width, y_neg* height], None, output_path=neg_save_path, size=height/1000 * 1.2)
-
-            # Create the conversation item
-            result.append({
-                "image":save_path.replace(new_directory, ''),
-                "conversations": conversations + [dic]
-            })
-            result.append({
-                "image":neg_save_path.replace(new_directory, ''),
-                "conversations": conversations + [neg_dic]
-            })
-    
-    return result
+            if n >= 2:
+                neg_ind = py_rng.choice([k for k in range(n) if k != ind])
+                neg_bbox = item['elements'][neg_ind]['bbox']
+                x_neg, y_neg =  (neg_bbox[0] + neg_bbox[2]) / 2, (neg_bbox[1] + neg_bbox[3]) / 2
+                neg_point = (x_neg, y_neg)
+                if (x_center - x_neg) ** 2 + (y_center - y_neg) ** 2 < 0.05:
+                    neg_point = sample_point(bbox, rng)
+            else:
+                neg_point = sample_point(bbox, rng)
+            if neg_point is not None: # no point outside the box was found
+                samples.append((str(ind), instruction, bbox, neg_point))
+    else:
+        instruction = item['instruction']
+        bbox = item['bbox']
+        neg_point = sample_point(bbox, rng)
+        if (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) < 0.8 and neg_point is not None:
+            samples.append(('', instruction, bbox, neg_point))
+    if not samples:
+        return index, []
+
+    # decode the source image once
+    try:
+        source_img = Image.open(os.path.join(image_folder, img_filename))
+        source_img.load()
+    except Exception:
+        return index, []
+    width, height = source_img.size
+
+    result = []
+    for tag, instruction, bbox, (x_neg, y_neg) in samples:
+        conversations = [{
+            "from": "human",
+            "value": f"<image>\n{prompt} " + f"'{instruction}'. Answer True or False."
+        }]
+        x_center = (bbox[0] + bbox[2]) / 2
+        y_center = (bbox[1] + bbox[3]) / 2
+        pos_point = [x_center * width, y_center * height]
+        neg_point = [x_neg * width, y_neg * height]
+        save_path = annotated_image_path(new_directory, file, img_filename, 'pos' + tag, instruction, pos_point, crop_size, image_format)
+        neg_save_path = annotated_image_path(new_directory, file, img_filename, 'neg' + tag, instruction, neg_point, crop_size, image_format)
+        try:
+            crop_box = draw_annotated_crop(source_img, pos_point, save_path, crop_size, image_format, quality, size=height/1000 * 1.2)
+            neg_crop_box = draw_annotated_crop(source_img, neg_point, neg_save_path, crop_size, image_format, quality, size=height/1000 * 1.2)
+        except Exception:
+            continue
+
+        # Create the conversation item
+        result.append({
+            "image":save_path.replace(new_directory, ''),
+            "conversations": conversations + [dic],
+            "source_image": os.path.join(image_folder, img_filename),
+            "crop_box": crop_box,
+        })
+        result.append({
+            "image":neg_save_path.replace(new_directory, ''),
+            "conversations": conversations + [neg_dic],
+            "source_image": os.path.join(image_folder, img_filename),
+            "crop_box": neg_crop_box,
+        })
+    return index, result
+
+
+def transform_to_conversation_format(data, file, image_folder_dict, new_directory, progress_path=None, num_workers=None, seed=0,
+                                     crop_size=500, image_format='webp', quality=90):
+    """
+    Transform the input data to the specified conversation format.
+    Args:
+        data: List of dictionaries containing webpage elements data
+        progress_path: JSONL file every finished item is appended to as it completes; items already in it are
+            not processed again, so an interrupted run can be resumed
+        num_workers: size of the process pool (default: number of CPUs)
+        crop_size, image_format, quality: see draw_annotated_crop
+
+    Returns:
+        List of dictionaries in the conversation format, with the "source_image" and "crop_box" of every image
+    """
+    image_folder = image_folder_dict[file]
+    done = {}
+    if progress_path is not None and os.path.exists(progress_path):
+        with open(progress_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError: # torn last line of an interrupted run
+                    break
+                done[entry["index"]] = entry["records"]
+        # drop a torn last line before appending to the file
+        with open(progress_path, 'w') as f:
+            f.writelines(json.dumps({"index": index, "records": records}) + "\n" for index, records in done.items())
+    tasks = [(index, item) for index, item in enumerate(data) if index not in done]
+
+    worker = partial(transform_item, file=file, image_folder=image_folder, new_directory=new_directory, seed=seed,
+                     crop_size=crop_size, image_format=image_format, quality=quality)
+    progress_file = open(progress_path, 'a') if progress_path is not None else None
+    try:
+        with Pool(num_workers) as pool:
+            for index, records in tqdm(pool.imap_unordered(worker, tasks, chunksize=8), total=len(tasks), desc=file):
+                done[index] = records
+                if progress_file is not None:
+                    progress_file.write(json.dumps({"index": index, "records": records}) + "\n")
+                    progress_file.flush()
+    finally:
+        if progress_file is not None:
+            progress_file.close()
+
+    return [record for index in sorted(done) for record in done[index]]
 
 
 
@@ -217,6 +282,11 @@ if __name__ == "__main__":
     parser.add_argument('--file_dict_key', type=str, default='', help='Key for the file dictionary to process')
     parser.add_argument('--save_suffix', type=str, default='verifier', help='Suffix for the saved files')
     parser.add_argument('--selected_size', type=int, default=10000, help='Number of samples to select from each file')
+    parser.add_argument('--num_workers', type=int, default=None, help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the sample selection and the negative points')
+    parser.add_argument('--crop_size', type=int, default=500, help='Save the window of +-crop_size pixels around the point that the verifier sees at inference (verifier_crop_size); 0 saves the full screenshot')
+    parser.add_argument('--image_format', type=str, default='webp', choices=['source', 'png', 'webp', 'jpeg'], help="Format of the saved images ('source' keeps the format of the screenshot)")
+    parser.add_argument('--quality', type=int, default=90, help='WebP / JPEG quality')
     args = parser.parse_args()
 
 
@@ -255,16 +325,25 @@ if __name__ == "__main__":
             file_path = os.path.join(root_path, directory, file + '.json')
             # Load the JSON data
             data = load_json_file(file_path)
-            data = random.sample(data, selected_size) if len(data) >= selected_size else data
+            # seeded, so that a resumed run selects the same samples
+            data = random.Random(f"{args.seed}-{file}").sample(data, selected_size) if len(data) >= selected_size else data
             print(directory, file, len(data))
 
             # Extract coordinates
-            new_data = transform_to_conversation_format(data, file, image_folder_dict, new_directory)
-
-
-            print(directory, file, len(data))
-            with open(file_path.replace('.json', f'_{save_suffix}.json'), "w", encoding="utf-8") as f:
-                json.dump(new_data, f)
+            save_path = file_path.replace('.json', f'_{save_suffix}.json')
+            new_data = transform_to_conversation_format(
+                data, file, image_folder_dict, new_directory,
+                progress_path=save_path.replace('.json', '.progress.jsonl'), num_workers=args.num_workers, seed=args.seed,
+                crop_size=args.crop_size, image_format=args.image_format, quality=args.quality,
+            )
+
+
+            print(directory, file, len(data), len(new_data))
+            # the training data, and a manifest of where every image was cropped from
+            with open(save_path, "w", encoding="utf-8") as f:
+                json.dump([{"image": item["image"], "conversations": item["conversations"]} for item in new_data], f)
+            with open(save_path.replace('.json', '_crops.json'), "w", encoding="utf-8") as f:
+                json.dump({item["image"]: {"source_image": item["source_image"], "crop_box": item["crop_box"]} for item in new_data}, f)
 
 
     if len(args.file_dict_key) == 0:
@@ -4,36 +4,43 @@ from transformers.generation import GenerationConfig
 import json
 import re
 import os
-import tempfile
+import hashlib
+from functools import lru_cache
 from PIL import Image, ImageDraw
 from qwen_vl_utils import process_vision_info
 from typing import List, Literal, Optional
 import numpy as np
 import random
+from _vectorized import label_connected_regions
 
 grounding_system_message = "You are a GUI agent. You are given a task and a screenshot of the screen. You need to perform a series of pyautogui actions to complete the task."
 
 
-def image_to_temp_filename(image):
-    temp_file = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
-    image.save(temp_file.name)
-    print(f"Image saved to temporary file: {temp_file.name}")
-    return temp_file.name
+def image_to_key_filename(image):
+    """
+    Name used to look up the predictions of an in-memory image, without writing it to disk: the file it was opened
+    from if there is one, otherwise a hash of its pixels.
+    """
+    filename = getattr(image, "filename", "")
+    if filename:
+        return filename
+    digest = hashlib.blake2b(image.tobytes(), digest_size=16)
+    digest.update(str((image.mode, image.size)).encode())
+    return f"memory-{digest.hexdigest()}.png"
 
 
-def draw_point_list(img, points, color='red', size=1, crop=True, sample_crop=False, crop_size=500):
-    draw = ImageDraw.Draw(img)
-    radius = np.ceil(7 * size).astype(int)
-    for point in points:
-        circle_bbox = [
-            point[0] - radius,  # x1
-            point[1] - radius,  # y1
-            point[0] + radius,  # x2
-            point[1] + radius   # y2
-        ]
-        draw.ellipse(circle_bbox, outline=color, width=np.ceil(3 * size).astype(int))
+@lru_cache(maxsize=16)
+def load_image(image_path):
+    """Decoded RGB screenshot, cached since several instructions refer to the same screenshot. Do not modify it."""
+    return Image.open(image_path).convert('RGB')
 
 
+def draw_point_list(img, points, color='red', size=1, crop=True, sample_crop=False, crop_size=500):
+    """
+    Draw hollow circles at `points`. With crop=True only the window of `crop_size` around the first point is copied
+    and drawn on (img is left untouched); otherwise the circles are drawn on img itself.
+    """
+    offset_x, offset_y = 0, 0
     if crop:
         x, y = points[0]
         width, height = img.size 
@@ -44,14 +51,92 @@ def draw_point_list(img, points, color='red', size=1, crop=True, sample_crop=Fal
         bottom = min(height-1, y + crop_half_size)
         try:
             img = img.crop((left, top, right, bottom))
+            # crop rounds the box to whole pixels
+            offset_x, offset_y = round(left), round(top)
         except Exception as e:
             print(f"Error cropping image: {e}")
-            # If cropping fails, return the original image
-            return img
+            # If cropping fails, draw on a copy of the original image
+            img = img.copy()
+
+    draw = ImageDraw.Draw(img)
+    radius = np.ceil(7 * size).astype(int)
+    for point in points:
+        circle_bbox = [
+            point[0] - offset_x - radius,  # x1
+            point[1] - offset_y - radius,  # y1
+            point[0] - offset_x + radius,  # x2
+            point[1] - offset_y + radius   # y2
+        ]
+        draw.ellipse(circle_bbox, outline=color, width=np.ceil(3 * size).astype(int))
     return img
 
 
 
+class AttentionScoreStore:
+    """
+    The predictions of a JSON prediction file with their `attn_scores` moved out of the Python objects: all maps are
+    stored as one flat float16 array, memory-mapped from the sidecar `<json>.attn_scores.npy`, with the start of
+    every prediction's map in `<json>.attn_offsets.npy` and its row length in `<json>.attn_n_cols.npy`. The other
+    fields are kept in `<json>.predictions.json`. The sidecars are built on first use and rebuilt when the JSON changes;
+    if they cannot be written (e.g. read-only directory), the arrays are kept in memory instead.
+    """
+    def __init__(self, json_path):
+        self.json_path = json_path
+        paths = self._sidecar_paths(json_path)
+        if not all(os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(json_path) for path in paths):
+            self.predictions, self.scores, self.offsets, self.n_cols = self._build(json_path)
+            try:
+                self._save(paths, self.predictions, [self.scores, self.offsets, self.n_cols])
+            except OSError:
+                pass
+            return
+        predictions_path, scores_path, offsets_path, n_cols_path = paths
+        with open(predictions_path, 'r') as f:
+            self.predictions = json.load(f)
+        self.scores = np.load(scores_path, mmap_mode='r')
+        self.offsets = np.load(offsets_path)
+        self.n_cols = np.load(n_cols_path)
+
+    @staticmethod
+    def _sidecar_paths(json_path):
+        return [f"{json_path}.predictions.json", f"{json_path}.attn_scores.npy", f"{json_path}.attn_offsets.npy", f"{json_path}.attn_n_cols.npy"]
+
+    @staticmethod
+    def _build(json_path):
+        with open(json_path, 'r') as f:
+            predictions = json.load(f)
+        scores, n_cols = [], []
+        for item in predictions:
+            attn_scores = np.asarray(item.pop('attn_scores', []), dtype=np.float16)
+            attn_scores = attn_scores.reshape(-1, attn_scores.shape[-1]) if attn_scores.size else attn_scores.reshape(0, 0)
+            scores.append(attn_scores.reshape(-1))
+            n_cols.append(attn_scores.shape[1])
+        offsets = np.zeros(len(scores) + 1, dtype=np.int64)
+        np.cumsum([len(item_scores) for item_scores in scores], out=offsets[1:])
+        scores = np.concatenate(scores) if scores else np.zeros(0, dtype=np.float16)
+        return predictions, scores, offsets, np.asarray(n_cols, dtype=np.int64)
+
+    @staticmethod
+    def _save(paths, predictions, arrays):
+        predictions_path = paths[0]
+        for path, array in zip(paths[1:], arrays):
+            with open(f"{path}.tmp{os.getpid()}", 'wb') as f:
+                np.save(f, array)
+            os.replace(f"{path}.tmp{os.getpid()}", path)
+        # written last: its presence marks a complete set of sidecars
+        with open(f"{predictions_path}.tmp{os.getpid()}", 'w') as f:
+            json.dump(predictions, f)
+        os.replace(f"{predictions_path}.tmp{os.getpid()}", predictions_path)
+
+    def __len__(self):
+        return len(self.predictions)
+
+    def attn_scores(self, index):
+        """(n_rows, n_cols) float16 view of the attention map of a prediction."""
+        item_scores = self.scores[self.offsets[index]:self.offsets[index + 1]]
+        return item_scores.reshape(-1, self.n_cols[index]) if len(item_scores) else item_scores.reshape(0, 0)
+
+
 class GroundingVerifier():
     def __init__(self,
         model_name_or_path="microsoft/GUI-Actor-Verifier-2B",
@@ -67,10 +152,12 @@ class GroundingVerifier():
         self.json_prediction_path = json_prediction
         # load json prediction
         assert os.path.exists(json_prediction) and os.path.isfile(json_prediction), "Invalid json prediction path."
-        with open(json_prediction, 'r') as f:
-            self.json_prediction = json.load(f)
+        # the attention maps live in a memory-mapped float16 store, not as nested lists of Python floats
+        self.attention_store = AttentionScoreStore(json_prediction)
+        self.json_prediction = self.attention_store.predictions
         
         self.verifier_crop_size = 500 # half of the true crop size
+        self.verifier_batch_size = 8 # candidate crops scored per forward pass
         # use 0.95 for ss-pro 
         if '-pro' in self.json_prediction_path.lower(): 
             self.threshold = 0.95
@@ -102,6 +189,10 @@ class GroundingVerifier():
         self.verifier_processor = AutoProcessor.from_pretrained(verifier_model_name_or_path)
         self.verifier_processor.tokenizer.pad_token = self.verifier_processor.tokenizer.eos_token   
 
+        # Only the "True" and "False" logits of the last token are ever used (see verify_batch)
+        self.true_id = self.verifier_processor.tokenizer.encode("True", add_special_tokens=False)[0]
+        self.false_id = self.verifier_processor.tokenizer.encode("False", add_special_tokens=False)[0]
+
 
 
     def set_generation_config(self, **kwargs):
@@ -109,65 +200,90 @@ class GroundingVerifier():
 
 
     def verify(self, instruction, image):
+        return self.verify_batch(instruction, [image])[0]
+
+
+    def verify_batch(self, instruction, images):
+        """Verifier scores P(True) / (P(True) + P(False)) of several annotated crops for one instruction, in one forward pass."""
         verifier_prompt = "Please observe the screenshot and exame whether the hollow red circle accurately placed on the intended position in the image: '{}'. Answer True or False."
         full_prompt = verifier_prompt.format(instruction)
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image",
-                        "image": image,
-                    },
-                    {"type": "text", "text": full_prompt},
-                ],
-            }
+        batch_messages = [
+            [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "image",
+                            "image": image,
+                        },
+                        {"type": "text", "text": full_prompt},
+                    ],
+                }
+            ]
+            for image in images
+        ]
+        text_inputs = [
+            self.verifier_processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+            for messages in batch_messages
         ]
-        text_input = self.verifier_processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
-        image_inputs, video_inputs = process_vision_info(messages)
-        inputs = self.verifier_processor(
-            text=[text_input],
-            images=image_inputs,
-            videos=video_inputs,
-            padding=True,
-            return_tensors="pt",
-        )
+        image_inputs, video_inputs = process_vision_info(batch_messages)
+        # left padding, so that the last position of every row is its own last token
+        tokenizer = self.verifier_processor.tokenizer
+        padding_side = tokenizer.padding_side
+        tokenizer.padding_side = "left"
+        try:
+            inputs = self.verifier_processor(
+                text=text_inputs,
+                images=image_inputs,
+                videos=video_inputs,
+                padding=True,
+                return_tensors="pt",
+            )
+        finally:
+            tokenizer.padding_side = padding_side
         inputs = inputs.to("cuda:0")
 
 
         # get the token probability of True and False using the verifier
-        # Forward pass to get logits
-        with torch.no_grad():
-            outputs = self.verifier(**inputs)
-            logits = outputs.logits  # shape: (batch_size, seq_len, vocab_size)
-
-        # Get the last token's logits
-        last_token_logits = logits[:, -1, :]  # (batch_size, vocab_size)
+        # Only the last position reaches lm_head: a forward hook on the decoder drops the other positions, so the
+        # logits are (batch_size, 1, vocab_size) instead of (batch_size, seq_len, vocab_size)
+        def keep_last_position(module, args, output):
+            if isinstance(output, tuple):
+                return (output[0][:, -1:],) + output[1:]
+            output.last_hidden_state = output.last_hidden_state[:, -1:]
+            return output
+
+        hook = self.verifier.model.register_forward_hook(keep_last_position)
+        try:
+            with torch.no_grad():
+                outputs = self.verifier(**inputs)
+        finally:
+            hook.remove()
+        true_false_logits = outputs.logits[:, -1, [self.true_id, self.false_id]].float()  # (batch_size, 2)
 
+        # P(True) / (P(True) + P(False)): the softmax normalizer over the vocabulary cancels out
+        return torch.softmax(true_false_logits, dim=-1)[:, 0].tolist()
 
-        # Get vocab IDs for "True" and "False"
-        true_id = self.verifier_processor.tokenizer.encode("True", add_special_tokens=False)[0]
-        false_id = self.verifier_processor.tokenizer.encode("False", add_special_tokens=False)[0]
 
-        # Get probabilities using softmax
-        probs = torch.softmax(last_token_logits, dim=-1)
-        true_prob = probs[0, true_id].item()
-        false_prob = probs[0, false_id].item()
-        score = true_prob / (true_prob + false_prob)
-        return score
 
+    def verifier_score(self, instruction, image, box):
+        return self.verifier_score_batch(instruction, image, [box])[0]
 
 
-    def verifier_score(self, instruction, image, box):
-        box = [box]
-        img_copy = image.copy()
-        img_new = draw_point_list(img_copy, box, crop_size=self.verifier_crop_size) 
-        score = self.verify(instruction, img_new)
-        return score
+    def verifier_score_batch(self, instruction, image, boxes):
+        """Score candidate points: one annotated crop per point, verified in micro-batches of `verifier_batch_size`."""
+        crops = [
+            draw_point_list(image, [box], crop_size=self.verifier_crop_size)
+            for box in boxes
+        ]
+        scores = []
+        for start in range(0, len(crops), self.verifier_batch_size):
+            scores.extend(self.verify_batch(instruction, crops[start:start + self.verifier_batch_size]))
+        return scores
 
 
     def get_prediction_region_point(self, attn_scores, n_width, n_height, top_n=20, return_all_regions=True, rect_center=False, no_groups=False):
-        attn_scores = np.array(attn_scores)
+        attn_scores = np.asarray(attn_scores, dtype=np.float64)
         max_score = attn_scores.max()
         threshold = max_score * 0.2 
         # select patches with activation scores above the threshold
@@ -177,111 +293,71 @@ class GroundingVerifier():
         if len(valid_indices[1]) > top_n:
             valid_scores = attn_scores[valid_indices]
             sorted_idx = np.argsort(valid_scores)[::-1][:top_n]
-            valid_indices = valid_indices[1][sorted_idx]
+            topk_indices = valid_indices[1][sorted_idx]
             topk_values = valid_scores[sorted_idx]
-            topk_indices = valid_indices
         else:
-            topk_values = attn_scores[valid_indices].tolist()
             topk_indices = valid_indices[1]
+            topk_values = attn_scores[valid_indices]
 
         # topk_values, topk_indices = attn_scores.topk(top_n, dim=-1)
         if n_width * n_height != attn_scores.shape[1]:
             n_width = n_width // 2
             n_height = n_height // 2
 
-
         # transform the topk_indices into coordinates
-        topk_coords = []
-        for idx in topk_indices:
-            x = idx % n_width
-            y = idx // n_width
-            topk_coords.append((int(y), int(x), int(idx)))
-        
-        # divide the topk_coords into regions based on connectivity
-        regions = []
-        visited = set()
-        
-        for i, (y, x, idx) in enumerate(topk_coords):
-            if idx in visited:
-                continue
-                
-            region = [(y, x, idx, topk_values[i])]
-            visited.add(idx)
-            queue = [(y, x, idx, topk_values[i])]
-            
-            # BFS
-            while queue:
-                cy, cx, c_idx, c_val = queue.pop(0)
-                
-                # check four directions
-                for dy, dx in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                    ny, nx = cy + dy, cx + dx
-                    n_idx = ny * n_width + nx
-                    
-                    # check whether the new coordinates are within bounds
-                    for j, (ty, tx, t_idx) in enumerate(topk_coords):
-                        if ty == ny and tx == nx and t_idx not in visited:
-                            visited.add(t_idx)
-                            region.append((ny, nx, t_idx, topk_values[j]))
-                            queue.append((ny, nx, t_idx, topk_values[j]))
-            
-            regions.append(region)
-        
-        region_scores = []
-        region_centers = []
-        region_points = []
-        
-        for region in regions:
-            # calculate the average score of the region
-            avg_score = sum(item[3] for item in region) / len(region)
-            region_scores.append(avg_score)
-
-
-            # calculate the normalized center of the region
-            normalized_centers = []
-            weights = []
-            y_coords = set()
-            x_coords = set()
-
-            for y, x, _, score in region:
-                center_y = (y + 0.5) / n_height
-                center_x = (x + 0.5) / n_width
-                normalized_centers.append((center_x, center_y))
-                weights.append(score)
-
-
-                y_coords.add(center_y)
-                x_coords.add(center_x)
-
-
-            region_points.append(normalized_centers)
-
-
-            # calculate the average center of the region
-            if not rect_center:
-                # weighted average
-                total_weight = sum(weights)
-                weighted_x = sum(nc[0] * w for nc, w in zip(normalized_centers, weights)) / total_weight
-                weighted_y = sum(nc[1] * w for nc, w in zip(normalized_centers, weights)) / total_weight
-                avg_center_x, avg_center_y = weighted_x, weighted_y
-            else:
-                avg_center_x = sum(x_coords) / len(x_coords)
-                avg_center_y = sum(y_coords) / len(y_coords)
-            region_centers.append((avg_center_x, avg_center_y))
-            
-        # select top regions based on scores
-        sorted_indices = sorted(range(len(region_scores)), key=lambda i: region_scores[i], reverse=True)
-        sorted_scores = [region_scores[i] for i in sorted_indices]
-        sorted_centers = [region_centers[i] for i in sorted_indices]
+        xs = topk_indices % n_width
+        ys = topk_indices // n_width
+        center_x = (xs + 0.5) / n_width
+        center_y = (ys + 0.5) / n_height
+
+        # divide the selected patches into 4-connected regions on the patch grid; a patch selected more than once
+        # (several attention rows) counts once, with its first value
+        _, first = np.unique(topk_indices, return_index=True)
+        first = np.sort(first)
+        grid = np.zeros((max(n_height, int(ys.max()) + 1), n_width), dtype=bool)
+        grid[ys[first], xs[first]] = True
+        labels = label_connected_regions(torch.from_numpy(grid)).numpy()[ys[first], xs[first]]
+        # number the regions in the order of their first patch in the top-n order
+        _, region_first, patch_region = np.unique(labels, return_index=True, return_inverse=True)
+        region_rank = np.empty_like(region_first)
+        region_rank[np.argsort(region_first, kind='stable')] = np.arange(len(region_first))
+        patch_region = region_rank[patch_region.reshape(-1)]
+        n_regions = len(region_first)
+
+        # calculate the average score and the (weighted) average center of every region
+        patch_scores = topk_values[first]
+        region_sizes = np.bincount(patch_region, minlength=n_regions)
+        region_sums = np.bincount(patch_region, weights=patch_scores, minlength=n_regions)
+        region_scores = region_sums / region_sizes
+        if not rect_center:
+            # weighted average
+            region_x = np.bincount(patch_region, weights=center_x[first] * patch_scores, minlength=n_regions) / region_sums
+            region_y = np.bincount(patch_region, weights=center_y[first] * patch_scores, minlength=n_regions) / region_sums
+        else:
+            # average of the distinct column / row centers covered by the region
+            covered_x = np.zeros((n_regions, n_width), dtype=bool)
+            covered_x[patch_region, xs[first]] = True
+            covered_y = np.zeros((n_regions, grid.shape[0]), dtype=bool)
+            covered_y[patch_region, ys[first]] = True
+            region_x = (covered_x @ ((np.arange(n_width) + 0.5) / n_width)) / covered_x.sum(axis=1)
+            region_y = (covered_y @ ((np.arange(grid.shape[0]) + 0.5) / n_height)) / covered_y.sum(axis=1)
+
+        # select top regions based on scores (stable, like sorted())
+        sorted_indices = np.argsort(-region_scores, kind='stable')
+        sorted_scores = region_scores[sorted_indices].tolist()
+        sorted_centers = list(zip(region_x[sorted_indices].tolist(), region_y[sorted_indices].tolist()))
+        region_points = [[] for _ in range(n_regions)]
+        for region, point in zip(patch_region.tolist(), zip(center_x[first].tolist(), center_y[first].tolist())):
+            region_points[region].append(point)
         sorted_points = [region_points[i] for i in sorted_indices]
         best_point = sorted_centers[0]
 
 
         if no_groups:
             if return_all_regions:
-                return sorted_centers + [[(x[1] + 0.5) / n_width, (x[0] + 0.5) /n_height] for x in topk_coords] 
+                return sorted_centers + [list(point) for point in zip(center_x.tolist(), center_y.tolist())]
             else:
-                return sorted_centers + [(topk_coords[0][1]+ 0.5) / n_width, (topk_coords[0][0]+ 0.5) / n_height]
+                return sorted_centers + [center_x[0].item(), center_y[0].item()]
 
         if return_all_regions:
             return best_point, sorted_centers, sorted_scores, sorted_points
@@ -295,10 +371,10 @@ class GroundingVerifier():
         if isinstance(image, str):
             image_path = image
             assert os.path.exists(image_path) and os.path.isfile(image_path), "Invalid input image path."
-            image = Image.open(image_path).convert('RGB')
+            image = load_image(image_path)
         else:
             assert isinstance(image, Image.Image)
-            image_path = image_to_temp_filename(image)
+            image_path = image_to_key_filename(image)
         
         width, height = image.size
         
@@ -317,7 +393,7 @@ class GroundingVerifier():
             predictions = self.json_prediction[index]['topk_points']
             predictions = [predictions[0]] # only the first one
         else:
-            attn_scores = self.json_prediction[index]['attn_scores']
+            attn_scores = self.attention_store.attn_scores(index)
             if 'n_width' in self.json_prediction[index]:
                 n_width, n_height = self.json_prediction[index]['n_width'], self.json_prediction[index]['n_height']
             elif 'img_size_crop' in self.json_prediction[index]:
@@ -333,10 +409,14 @@ class GroundingVerifier():
         print(predictions, len(predictions))
         if len(predictions) > 1:
             if self.method == 'score':
-                for point in pred_points_list[len(score_list):]:
-                    score = self.verifier_score(instruction, image, point)
-                    score_list.append(score)
-                    if score >= self.threshold: 
+                # candidates are in priority order: score them chunk by chunk and stop at the first one that
+                # passes the threshold (the scores after it are dropped, as if they were scored one by one)
+                while len(score_list) < len(pred_points_list):
+                    chunk = pred_points_list[len(score_list):len(score_list) + self.verifier_batch_size]
+                    score_list.extend(self.verifier_score_batch(instruction, image, chunk))
+                    passed = [i for i, score in enumerate(score_list) if score >= self.threshold]
+                    if passed:
+                        score_list = score_list[:passed[0] + 1]
                         break
                 # get the max score
                 print(score_list, len(score_list))